@@ -0,0 +1,90 @@
+"""Compares the coin selections of the lightnode API (see lightnode_api.COIN_SELECTIONS) on the same history of a
+wallet, and reports the average size, inputs and validation time of its transactions, and the outputs it is left
+with.
+
+The wallet receives a few small payments in each block, and makes a payment of a random amount after each of them,
+built with lightnode_api.create_transaction, signed and validated by the full node validation before being added to
+the chain. The history is drawn from a seeded generator, hence the same for every coin selection. With the idle
+consolidation, the wallet also consolidates its smallest outputs every few blocks, as it would when it has nothing
+else to do (see lightnode_api.create_consolidation) : these transactions are counted as well.
+
+Usage, from the root of the repository :
+    python -m benchmarks.coin_selection [number_of_blocks] [--payments-per-block=3] [--consolidate-every=10]
+                                        [--seed=0]
+"""
+from tools import classes, crypto, database, exceptions, fullnode_api, keyring, lightnode_api, validation
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+
+
+def _simulate(coin_selection, nb_blocks, payments_per_block, consolidate_every, seed):
+    """Runs the history of the wallet with the coin selection, consolidating every consolidate_every blocks if not 0,
+    and returns the (size, number of inputs, validation time) of its transactions and its outputs at the end."""
+
+    generator = random.Random(seed)
+    wallet = keyring.Keyring(str(seed))
+    address = wallet.get_address(0)
+    lightnode_api.set_coin_selection(address, coin_selection)
+    fullnode_api.add_genesis_block(classes.GenesisBlock(address))
+    lightnode_api.init_lightnode_api()  # The full node and the lightnode share the chain of the database file
+
+    measures = []
+    for height in range(1, nb_blocks + 1):
+        # The payments received, each from a transaction of its own
+        received = [classes.Transaction({"%064x" % generator.getrandbits(256): 0},
+                                        {address: generator.randint(1, 20)}) for _ in range(payments_per_block)]
+        fullnode_api.add_block_to_db(classes.Block(received))
+
+        transactions = []
+        balance = lightnode_api.get_balance_from_address(address)
+        transactions.append(lightnode_api.create_transaction(address, crypto.get_address(str(height)),
+                                                             generator.randint(1, max(1, balance // 2))))
+        if consolidate_every and height % consolidate_every == 0:
+            try:
+                transactions.append(lightnode_api.create_consolidation(address))
+            except exceptions.APIError:
+                pass  # Nothing to consolidate
+
+        for t in transactions:
+            wallet.sign(t, address)
+            start = time.perf_counter()
+            validation.validate_transaction(t)
+            measures.append((len(pickle.dumps(t)), len(t.internals["dict_of_inputs"]), time.perf_counter() - start))
+        fullnode_api.add_block_to_db(classes.Block(transactions))
+
+    validation.clear_validation_cache()
+    return measures, len(lightnode_api.get_spendable_outputs_from_address(address))
+
+
+def run(nb_blocks, payments_per_block=3, consolidate_every=10, seed=0):
+    directory = tempfile.mkdtemp(prefix="coin_selection_")
+    runs = [(name, name, 0) for name in lightnode_api.COIN_SELECTIONS] + [
+        ("branch_and_bound, idle consolidation", "branch_and_bound", consolidate_every)]
+
+    print("{} blocks, {} payments received per block, one made".format(nb_blocks, payments_per_block))
+    try:
+        for n, (label, coin_selection, every) in enumerate(runs):
+            database.init_database_path(os.path.join(directory, f"db{n}"))
+            measures, nb_outputs = _simulate(coin_selection, nb_blocks, payments_per_block, every, seed)
+            database.reinit_database_path()
+
+            sizes, inputs, durations = zip(*measures)
+            print("{:>38} : {:6.0f} bytes, {:5.1f} inputs, validated in {:5.2f} ms per transaction, {} outputs left"
+                  .format(label, sum(sizes) / len(sizes), sum(inputs) / len(inputs),
+                          1000 * sum(durations) / len(durations), nb_outputs))
+    finally:
+        database.reinit_database_path()
+        for file_name in os.listdir(directory):
+            os.remove(os.path.join(directory, file_name))
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    run(int(args[0]) if args else 200, payments_per_block=int(options.get("payments-per-block", 3)),
+        consolidate_every=int(options.get("consolidate-every", 10)), seed=int(options.get("seed", 0)))
@@ -0,0 +1,67 @@
+"""Measures the bytes sent to relay a block to a neighbor, as full blocks and as compact blocks, depending on the share
+of its transactions the neighbor already has in its mempool. With compact blocks, the neighbor also requests the
+transactions it is missing, which are counted as well.
+
+Usage, from the root of the repository :
+    python -m benchmarks.compact_blocks [transactions_per_block ...]
+"""
+from tools import chain_sync, classes, crypto, validation
+import json
+import pickle
+import sys
+import time
+
+
+def _make_block(nb_transactions):
+    seed = crypto.new_seed()
+    address = crypto.get_address(seed)
+    genesis_block = classes.GenesisBlock(address)
+
+    transactions = []
+    previous_txhash = genesis_block.block_content[0].txhash
+    for i in range(nb_transactions):
+        tx = classes.Transaction({previous_txhash: 0}, {address: 100})
+        tx.sign(seed)
+        # As received by a full node, each from its own message, so that they share no object with one another
+        transactions.append(pickle.loads(pickle.dumps(tx)))
+        previous_txhash = tx.txhash
+
+    block = classes.Block(transactions)
+    block.metadata["id"] = 1
+    block.metadata["prev_block_hash"] = validation.get_block_hash(genesis_block)
+    return [genesis_block, block]
+
+
+def run(nb_transactions):
+    db = _make_block(nb_transactions)
+    headers = chain_sync.get_headers(db, 0)
+    block_hashes = [validation.get_header_hash(header) for header in headers]
+
+    full_size = len(pickle.dumps(chain_sync.get_blocks(db, block_hashes)))
+    print("{:>5} transactions, full block : {} bytes".format(nb_transactions, full_size))
+
+    for known_share in (1, 0.9, 0.5):
+        known = db[1].block_content[:int(nb_transactions * known_share)]
+        mempool = {chain_sync.get_short_id(t.txhash): t for t in known}
+
+        start = time.perf_counter()
+        compact_message = pickle.dumps(chain_sync.get_compact_blocks(db, block_hashes))
+        contents, missing = chain_sync.rebuild_block_contents(pickle.loads(compact_message), mempool)
+        size = len(compact_message)
+        block_transactions = {}
+        if missing:
+            request = json.dumps({"missing": missing}).encode("utf-8")
+            response = pickle.dumps(chain_sync.get_block_transactions(db, missing))
+            size += len(request) + len(response)
+            block_transactions = pickle.loads(response)
+        blocks = chain_sync.fill_compact_blocks(pickle.loads(compact_message), contents, block_transactions)
+        chain_sync.check_blocks(blocks, headers)
+        duration = time.perf_counter() - start
+
+        print("{:>5} transactions, {:>3.0%} in mempool, compact block : {} bytes ({:.1f}x smaller), rebuilt in "
+              "{:.1f} ms".format(nb_transactions, known_share, size, full_size / size, duration * 1000))
+
+
+if __name__ == '__main__':
+    for nb in (sys.argv[1:] or ["10", "100", "1000"]):
+        run(int(nb))
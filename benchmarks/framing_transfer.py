@@ -0,0 +1,92 @@
+"""Measures the transfer of one large message (e.g. a database) between two non-blocking sockets, with the
+FrameReader/FrameWriter buffers of the connection classes and with the former bytes buffers, which were extended
+with += on each 4 KB recv and re-sliced after each send.
+
+Usage, from the root of the repository :
+    python -m benchmarks.framing_transfer [payload_size_in_MB ...]
+"""
+from network import framing
+import selectors
+import socket
+import sys
+import time
+
+
+def _transfer_with_bytes_buffers(sender, receiver, message):
+    """The former implementation of _write and _read."""
+    send_buffer = message
+    recv_buffer = b""
+    sel = selectors.DefaultSelector()
+    sel.register(sender, selectors.EVENT_WRITE)
+    sel.register(receiver, selectors.EVENT_READ)
+    while len(recv_buffer) < len(message):
+        for key, mask in sel.select():
+            if key.fileobj is sender and send_buffer:
+                try:
+                    sent = sender.send(send_buffer)
+                except BlockingIOError:
+                    pass
+                else:
+                    send_buffer = send_buffer[sent:]
+            elif key.fileobj is receiver:
+                try:
+                    data = receiver.recv(4096)
+                except BlockingIOError:
+                    pass
+                else:
+                    recv_buffer += data
+        if not send_buffer and sender in sel.get_map():
+            sel.unregister(sender)
+    sel.close()
+    return recv_buffer
+
+
+def _transfer_with_frame_buffers(sender, receiver, message_parts):
+    send_buffer = framing.FrameWriter()
+    send_buffer.append(*message_parts)
+    recv_buffer = framing.FrameReader()
+    total_length = len(send_buffer)
+    sel = selectors.DefaultSelector()
+    sel.register(sender, selectors.EVENT_WRITE)
+    sel.register(receiver, selectors.EVENT_READ)
+    while len(recv_buffer) < total_length:
+        for key, mask in sel.select():
+            if key.fileobj is sender and send_buffer:
+                try:
+                    send_buffer.send_to(sender)
+                except BlockingIOError:
+                    pass
+            elif key.fileobj is receiver:
+                try:
+                    recv_buffer.recv_from(receiver)
+                except BlockingIOError:
+                    pass
+        if not send_buffer and sender in sel.get_map():
+            sel.unregister(sender)
+    sel.close()
+    return recv_buffer.read(total_length)
+
+
+def run(payload_size):
+    content = bytes(payload_size)
+    header = framing.create_header("database_content", len(content))
+
+    for name, transfer, message in (("bytes buffers", _transfer_with_bytes_buffers, header + content),
+                                    ("frame buffers", _transfer_with_frame_buffers, [header, content])):
+        sender, receiver = socket.socketpair()
+        sender.setblocking(False)
+        receiver.setblocking(False)
+        start = time.perf_counter()
+        received = transfer(sender, receiver, message)
+        duration = time.perf_counter() - start
+        sender.close()
+        receiver.close()
+
+        assert len(received) == len(header) + len(content)
+        print("{:>5} MB with {} : {:.3f} s, {:.0f} MB/s".format(payload_size // 10 ** 6, name, duration,
+                                                              payload_size / 10 ** 6 / duration))
+
+
+if __name__ == '__main__':
+    for size in (sys.argv[1:] or ["1", "10", "50"]):
+        run(int(size) * 10 ** 6)
@@ -0,0 +1,143 @@
+"""Measures the latency of database requests sent to a running full node by many concurrent clients.
+
+Usage, from the root of the repository and with a full node running :
+    python -m benchmarks.fullnode_latency [number_of_clients] [requests_per_client] [--persistent]
+                                          [--under-load=SEED]
+
+With --persistent, each client sends all its requests through one connection, tagged with request-ids, instead of
+opening a connection per request.
+
+With --under-load, a chain of valid transactions is submitted during the measurement, spending the output of the
+genesis block owned by SEED and then each other's output. The requests are thus measured while the node is busy
+validating transactions and mining blocks.
+"""
+from network import json_tools, lightnode_connections
+from tools import classes, crypto
+import asyncio
+import json
+import pickle
+import statistics
+import struct
+import sys
+import time
+
+
+async def _database_request(host, port):
+    """Sends one db_request and waits for the complete database message. Returns the latency in seconds."""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.writelines(lightnode_connections.FullNodeConnection._create_client_message(content_type="db_request"))
+    await writer.drain()
+
+    jsonheader_len = struct.unpack(">H", await reader.readexactly(2))[0]
+    jsonheader = json_tools.json_decode(await reader.readexactly(jsonheader_len), "utf-8")
+    await reader.readexactly(jsonheader["content-length"])
+    writer.close()
+    return time.perf_counter() - start
+
+
+async def _client(host, port, requests_per_client, latencies):
+    for _ in range(requests_per_client):
+        latencies.append(await _database_request(host, port))
+
+
+async def _persistent_client(host, port, requests_per_client, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    for request_id in range(requests_per_client):
+        start = time.perf_counter()
+        writer.writelines(lightnode_connections.FullNodeConnection._create_client_message(content_type="db_request",
+                                                                                          request_id=request_id))
+        await writer.drain()
+
+        jsonheader_len = struct.unpack(">H", await reader.readexactly(2))[0]
+        jsonheader = json_tools.json_decode(await reader.readexactly(jsonheader_len), "utf-8")
+        await reader.readexactly(jsonheader["content-length"])
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def _create_transactions(host, port, seed, count):
+    """Returns count signed transactions, the first one spending the output of the genesis block owned by the seed,
+    and each following one spending the output of the previous one."""
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.writelines(lightnode_connections.FullNodeConnection._create_client_message(content_type="db_request"))
+    await writer.drain()
+    jsonheader_len = struct.unpack(">H", await reader.readexactly(2))[0]
+    jsonheader = json_tools.json_decode(await reader.readexactly(jsonheader_len), "utf-8")
+    genesis_transaction = pickle.loads(await reader.readexactly(jsonheader["content-length"]))[0].block_content[0]
+    writer.close()
+
+    address = crypto.get_address(seed)
+    previous_txhash = genesis_transaction.txhash
+    amount = list(genesis_transaction.internals["dict_of_outputs"].values())[0]
+    transactions = []
+    for _ in range(count):
+        t = classes.Transaction({previous_txhash: 0}, {address: amount})
+        t.sign(seed)
+        transactions.append(pickle.dumps(t))
+        previous_txhash = t.txhash
+    return transactions
+
+
+async def _transaction_load(host, port, transactions, stop_event, submitted):
+    """Submits the transactions in order through one persistent connection, each once the previous one has been
+    processed, until stop_event is set. Submitting them without waiting would only fill the connection slots of the
+    node with transactions waiting for processing, and the measured requests would be refused."""
+
+    reader, writer = await asyncio.open_connection(host, port)
+    for request_id, transaction_bytes in enumerate(transactions):
+        if stop_event.is_set():
+            break
+        writer.writelines(lightnode_connections.FullNodeConnection._create_client_message(
+            content_type="transaction_content", content_bytes=transaction_bytes, request_id=request_id))
+        await writer.drain()
+
+        jsonheader_len = struct.unpack(">H", await reader.readexactly(2))[0]
+        jsonheader = json_tools.json_decode(await reader.readexactly(jsonheader_len), "utf-8")
+        await reader.readexactly(jsonheader["content-length"])  # The status of the transaction
+        submitted[0] += 1
+    writer.close()
+
+
+async def run(host, port, number_of_clients, requests_per_client, persistent=False, load_seed=None):
+    latencies = []
+    client = _persistent_client if persistent else _client
+
+    stop_event = asyncio.Event()
+    submitted = [0]
+    load = None
+    if load_seed is not None:
+        transactions = await _create_transactions(host, port, load_seed, 1000)
+        load = asyncio.ensure_future(_transaction_load(host, port, transactions, stop_event, submitted))
+        await asyncio.sleep(1)  # The node is busy validating and mining when the measurement starts
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, requests_per_client, latencies) for _ in range(number_of_clients)))
+    duration = time.perf_counter() - start
+
+    if load is not None:
+        stop_event.set()
+        await load
+        print("Transactions submitted : {}".format(submitted[0]))
+
+    latencies.sort()
+    print("Clients : {}, requests : {}, duration : {:.2f} s".format(number_of_clients, len(latencies), duration))
+    print("Throughput : {:.1f} requests/s".format(len(latencies) / duration))
+    print("Latency p50 : {:.1f} ms, p99 : {:.1f} ms, max : {:.1f} ms".format(
+        1000 * statistics.median(latencies), 1000 * latencies[int(0.99 * (len(latencies) - 1))], 1000 * latencies[-1]))
+
+
+if __name__ == '__main__':
+    with open('network/config.json') as cfg_file:
+        cfg = json.load(cfg_file)
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    clients = int(args[0]) if len(args) > 0 else 50
+    requests = int(args[1]) if len(args) > 1 else 20
+    load_seed = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--under-load="):
+            load_seed = arg[len("--under-load="):]
+    asyncio.run(run(cfg["FullnodeInfo"]["host"], cfg["FullnodeInfo"]["clients_listening_port"], clients, requests,
+                    persistent="--persistent" in sys.argv, load_seed=load_seed))
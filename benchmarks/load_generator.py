@@ -0,0 +1,183 @@
+"""Floods a full node with valid transactions, built with the lightnode API, and reports the accepted transactions
+per second, the rejections and the latency of the submissions.
+
+The output of a genesis block is split between many funded addresses. Each round, every address pays one coin to
+the next one with lightnode_api.create_transaction, from a local copy of the chain kept up to date with the full node
+(see lightnode.synchronize_chain). The transactions of a round are submitted across many concurrent connections,
+either as fast as the node answers (closed loop) or at a target rate whatever the node answers (open loop). The next
+round is built once the node has confirmed the previous one, since the lightnode API only spends confirmed outputs.
+
+Usage, from the root of the repository :
+    python -m benchmarks.load_generator [number_of_transactions] [--addresses=100] [--connections=8] [--rate=0]
+                                        [--port=PORT --seed=SEED]
+
+Without --port, a full node is started for the run, with a new genesis block. With --port, the transactions are sent
+to the full node running on that port, whose genesis output belongs to SEED. The rate is in transactions per
+second, 0 for the closed loop. The genesis output holds 100 coins, hence at most 100 addresses.
+"""
+from benchmarks import testnet as tn
+from network import lightnode
+from tools import classes, crypto, database, exceptions, keyring, lightnode_api
+import concurrent.futures
+import contextlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+class LoadGenerator:
+    """This class submits transactions to a full node through a pool of connections, and records the status and the
+    latency of each submission. In the open loop, the latency runs from the time the transaction was due to be sent,
+    so that it includes the time waiting for a free connection when the node falls behind."""
+
+    def __init__(self, pool, connections=8, rate=0):
+        self.pool = pool
+        self.connections = connections
+        self.rate = rate
+        self.statuses = []
+        self.latencies = []
+        self.busy_time = 0.0  # Time spent submitting, excluding the waits for confirmations
+        self._lock = threading.Lock()
+
+    def _submit(self, transaction, due_time):
+        broadcasting = lightnode.TransactionBroadcasting(transaction, pool=self.pool)
+        broadcasting.broadcast()
+        with self._lock:
+            self.statuses.append(broadcasting.status)
+            self.latencies.append(time.monotonic() - due_time)
+        return broadcasting.status
+
+    def submit(self, transactions):
+        """Submits the transactions and returns their statuses, in the same order (None if the submission failed)."""
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.connections) as executor:
+            futures = []
+            for n, t in enumerate(transactions):
+                if self.rate:
+                    due_time = start + n / self.rate
+                    time.sleep(max(0, due_time - time.monotonic()))
+                else:
+                    # Closed loop : a transaction is only sent once a connection is free
+                    pending_futures = [future for future in futures if not future.done()]
+                    if len(pending_futures) >= self.connections:
+                        concurrent.futures.wait(pending_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    due_time = time.monotonic()
+                futures.append(executor.submit(self._submit, t, due_time))
+        self.busy_time += time.monotonic() - start
+        return [future.result() for future in futures]
+
+
+def _wait_for_confirmation(pool, txhashes, timeout):
+    """Brings the local copy of the chain up to date until the transactions are in it. Returns False on timeout."""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        lightnode.synchronize_chain(pool=pool)  # Only the new blocks are received
+        if all(_is_confirmed(txhash) for txhash in txhashes):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def _is_confirmed(txhash):
+    try:
+        lightnode_api.get_transaction_by_txhash(txhash)
+    except exceptions.APIError:
+        return False
+    return True
+
+
+def _percentiles(values):
+    if not values:
+        return "no measure"
+    values = sorted(values)
+    return "p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+        *(1000 * values[int(q * (len(values) - 1))] for q in (0.5, 0.9, 0.99, 1)))
+
+
+def run(nb_transactions, nb_addresses=100, connections=8, rate=0, port=None, seed=None, timeout=120):
+    testnet = None
+    local_directory = tempfile.mkdtemp(prefix="load_generator_")
+    local_database_path = os.path.join(local_directory, "db")
+
+    # The nodes and the lightnode functions print every connection : only the report is shown
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            if port is None:
+                seed = crypto.new_seed()
+                genesis_block = classes.GenesisBlock(crypto.get_address(seed))
+                # A round of transactions fits in one block
+                testnet = tn.Testnet(1, genesis_block, config_overrides={
+                    "BlockAssemblyInfo": {"max_transactions": max(nb_addresses, 10), "max_wait_seconds": 1}})
+                testnet.start()
+                pool = lightnode.ConnectionPool(port=testnet.get_client_port(0), max_connections=connections)
+            else:
+                pool = lightnode.ConnectionPool(port=port, max_connections=connections)
+                genesis_request = lightnode.DatabaseRequest(pool=pool)
+                genesis_request.request()
+                genesis_block = genesis_request.database[0]
+
+            # The funded addresses, of one keyring
+            wallet = keyring.Keyring(crypto.new_seed())
+            addresses = wallet.derive(nb_addresses)
+            split_transaction = tn.split_genesis_output(genesis_block, seed, addresses)
+            lightnode.TransactionBroadcasting(split_transaction, pool=pool).broadcast()
+
+            database.init_database_path(local_database_path)
+            lightnode_api.init_lightnode_api()
+            funded = _wait_for_confirmation(pool, [split_transaction.txhash], timeout)
+
+            generator = LoadGenerator(pool, connections=connections, rate=rate)
+            confirmed = funded
+            while confirmed and len(generator.statuses) < nb_transactions:
+                transactions = []
+                for k in range(min(nb_addresses, nb_transactions - len(generator.statuses))):
+                    try:
+                        t = lightnode_api.create_transaction(addresses[k], addresses[(k + 1) % nb_addresses],
+                                                             amount=1)
+                    except exceptions.APIError:
+                        continue  # The coin of the address has not been confirmed
+                    wallet.sign(t, addresses[k])
+                    transactions.append(t)
+                if not transactions:
+                    break
+
+                statuses = generator.submit(transactions)
+                accepted_txhashes = [t.txhash for t, status in zip(transactions, statuses) if status == "accepted"]
+                confirmed = _wait_for_confirmation(pool, accepted_txhashes, timeout)
+        finally:
+            database.reinit_database_path()
+            if testnet is not None:
+                testnet.stop()
+            pool.close()
+            for file_name in os.listdir(local_directory):
+                os.remove(os.path.join(local_directory, file_name))
+            os.rmdir(local_directory)
+
+    if not funded:
+        print("The genesis output could not be split between the addresses within {} s.".format(timeout))
+        return
+
+    nb_accepted = generator.statuses.count("accepted")
+    print("Transactions : {} submitted in {:.2f} s, over {} connections, {}".format(
+        len(generator.statuses), generator.busy_time, connections,
+        "at {} tx/s".format(rate) if rate else "closed loop"))
+    print("Accepted : {} ({:.1f} tx/s)".format(nb_accepted, nb_accepted / generator.busy_time
+                                              if generator.busy_time else 0))
+    print("Rejected : {}, orphaned : {}, failed : {}".format(generator.statuses.count("rejected"),
+                                                              generator.statuses.count("orphaned"),
+                                                              generator.statuses.count(None)))
+    print("Latency : " + _percentiles(generator.latencies))
+    if not confirmed:
+        print("(stopped : a round was not confirmed within {} s)".format(timeout))
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    run(int(args[0]) if args else 500, nb_addresses=int(options.get("addresses", 100)),
+        connections=int(options.get("connections", 8)), rate=float(options.get("rate", 0)),
+        port=int(options["port"]) if "port" in options else None, seed=options.get("seed"))
@@ -0,0 +1,253 @@
+"""Simulates a network of many full nodes in one process, over the in-memory transport of network/memory_transport.py,
+and measures block propagation and fork rate.
+
+Each simulated node runs the processing of a real full node (fullnode_processing : header-first synchronization,
+compact blocks, peers manager) with a state of its own, installed in the modules whenever it processes a message.
+Its messages go through the real connection classes, over links with the given latency, bandwidth and loss. Blocks
+are found by each node after random (exponential) virtual times, so that the whole network finds one every
+block_interval seconds on average, then really mined (proof of work) and announced. The run is driven by a virtual
+clock, hence reproducible for a given seed, and takes as much real time as the processing of the messages and the
+mining of the blocks.
+
+Usage, from the root of the repository :
+    python -m benchmarks.network_simulation [number_of_nodes] [number_of_blocks] [--degree=4] [--latency=0.05]
+                                            [--bandwidth=1000000] [--loss=0] [--block-interval=10] [--seed=0]
+
+Latency is one-way, in seconds, bandwidth in bytes per second, loss the probability of losing a segment. Each node
+connects to degree random neighbors.
+"""
+from network import fullnode_connections, fullnode_processing, memory_transport, peer_manager, response_cache
+from tools import classes, crypto, database, fullnode_api, mempool as mp, validation
+import contextlib
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# The port the nodes listen for their neighbors on, announced to them, see fullnode_processing._announce_tip
+NEIGHBORS_PORT = fullnode_processing._cfg["FullnodeInfo"]["neighbors_listening_port"]
+
+
+class SimulatedNode:
+    """This class is a full node of the simulation. fullnode_processing keeps the state of the node in module
+    globals : the state of this node is installed in them by activate(), around each processing."""
+
+    def __init__(self, simulation, index, neighbors, directory):
+        self.simulation = simulation
+        self.index = index
+        self.host = f"node{index}"
+        self.address_tuple = (self.host, NEIGHBORS_PORT)
+        self.database_path = os.path.join(directory, f"db{index}")
+        self.mining_address = crypto.get_address(self.host)  # A seed known by all, but nothing is spent here
+        self.tips = []  # (virtual time, tip hash) each time the chain of the node changes
+
+        self._state = {
+            "mempool": mp.Mempool(),
+            "orphan_pool": mp.OrphanPool(),
+            "peers": peer_manager.PeerManager(peers=neighbors, fanout=simulation.fanout),
+            "responses": response_cache.ResponseCache(),
+            "received_databases_stack": []
+        }
+        self._validated_transactions = {}
+
+        with self.activate():
+            fullnode_api.add_genesis_block(simulation.genesis_block)
+        simulation.network.listen(self.address_tuple, self._accept)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Installs the state of the node in the modules, for the time of the with block."""
+
+        database.reinit_database_path()
+        database.init_database_path(self.database_path)
+        for name, value in self._state.items():
+            setattr(fullnode_processing, name, value)
+        validation._validated_transactions = self._validated_transactions
+        try:
+            yield
+        finally:
+            # Replaced rather than modified by fullnode_processing.process
+            self._state["received_databases_stack"] = fullnode_processing.received_databases_stack
+            self._record_tip()
+
+    def _record_tip(self):
+        tip_hash = self._state["responses"].get_tip()
+        if tip_hash is not None and (not self.tips or self.tips[-1][1] != tip_hash):
+            self.tips.append((self.simulation.clock.now, tip_hash))
+
+    def _accept(self, sock, address_tuple):
+        memory_transport.drive(fullnode_connections.NeighborConnection(sock, sock, address_tuple), sock,
+                               self._process)
+
+    def _process(self, connection):
+        # As fullnode_socket_manager._drive : only once a message has been received
+        if connection.message_received is not None or connection.database_received is not None:
+            with self.activate():
+                fullnode_processing.process(connection, self.gossip)
+
+    def gossip(self, content_type, content_bytes, exclude=()):
+        for address_tuple in self._state["peers"].select_peers(exclude=exclude):
+            self.simulation.clock.call_soon(self._start_gossip, address_tuple, content_type, content_bytes)
+
+    def _start_gossip(self, address_tuple, content_type, content_bytes):
+        try:
+            sock = self.simulation.network.connect(self.host, address_tuple)
+        except ConnectionRefusedError:
+            self._state["peers"].record_failure(address_tuple)
+            return
+        sock.events = memory_transport.selectors.EVENT_WRITE  # We start by sending the first message
+        memory_transport.drive(fullnode_connections.NeighborConnection(sock, sock, address_tuple,
+                                                                       first_message=(content_type, content_bytes)),
+                               sock, self._process)
+
+    def mine(self):
+        """Called when the node finds a block : the block is mined on top of its chain and announced."""
+
+        with self.activate():
+            db = fullnode_api.get_database()
+            # A transaction of its own, so that the blocks of different nodes differ
+            block = classes.Block([classes.Transaction({"%064x" % self.simulation.random.getrandbits(256): 0},
+                                                       {self.mining_address: 100})])
+            mined_block = fullnode_api.mine_block(block, db[-1])
+            fullnode_api.add_block_to_db(mined_block)
+            block_hash = validation.get_block_hash(mined_block)
+            self._state["responses"].set_tip(block_hash)
+            fullnode_processing._announce_tip(self.gossip, db + [mined_block])
+
+        self.simulation.blocks[block_hash] = (mined_block.metadata["prev_block_hash"], self.simulation.clock.now)
+        self.simulation.schedule_next_block()
+
+
+class Simulation:
+    """This class sets up the nodes of a simulation, their neighbors and the network between them."""
+
+    def __init__(self, nb_nodes, degree=4, latency=0.05, bandwidth=None, loss=0.0, block_interval=10, fanout=8,
+                 seed=0):
+        random.seed(seed)  # Used by the peers manager and by mining
+        self.random = random.Random(seed)
+        self.clock = memory_transport.VirtualClock()
+        self.network = memory_transport.MemoryNetwork(self.clock, latency=latency, bandwidth=bandwidth, loss=loss,
+                                                      seed=seed)
+        self.block_interval = block_interval
+        self.fanout = fanout
+        self.genesis_block = classes.GenesisBlock(crypto.get_address(f"simulation {seed}"))
+        self.blocks = {validation.get_block_hash(self.genesis_block): (None, 0.0)}  # hash -> (previous hash, time)
+        self.directory = tempfile.mkdtemp(prefix="simulation_")
+        self.nb_blocks = 0  # Blocks to find, see run
+
+        self.nodes = []
+        for i in range(nb_nodes):
+            others = [j for j in range(nb_nodes) if j != i]
+            neighbors = self.random.sample(others, min(degree, len(others)))
+            self.nodes.append(SimulatedNode(self, i, [(f"node{j}", NEIGHBORS_PORT) for j in neighbors],
+                                            self.directory))
+
+    def schedule_next_block(self):
+        """The network finds a block every block_interval on average, by any of the nodes, until nb_blocks have been
+        found."""
+        if len(self.blocks) - 1 < self.nb_blocks:
+            node = self.random.choice(self.nodes)
+            self.clock.call_later(self.random.expovariate(1 / self.block_interval), node.mine)
+
+    def run(self, nb_blocks):
+        """Runs until nb_blocks have been found, and the network is quiet again."""
+        self.nb_blocks = nb_blocks
+        self.schedule_next_block()
+        self.clock.run()
+
+    def close(self):
+        database.reinit_database_path()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def get_adoption_times(self):
+        """Returns, for each node, the virtual time at which each block was first in its chain (hash -> time)."""
+
+        adoption_times = []
+        for node in self.nodes:
+            adopted = {}
+            for when, tip_hash in node.tips:
+                block_hash = tip_hash
+                while block_hash is not None and block_hash not in adopted:
+                    adopted[block_hash] = when
+                    block_hash = self.blocks.get(block_hash, (None,))[0]
+            adoption_times.append(adopted)
+        return adoption_times
+
+    def get_best_chain(self):
+        """Returns the hash of the tip of the best chain found, the one the nodes converge to, and the set of the
+        hashes of its blocks."""
+
+        def length(block_hash):
+            height = 0
+            while self.blocks[block_hash][0] is not None:
+                block_hash = self.blocks[block_hash][0]
+                height += 1
+            return height
+
+        tip_hash = min(self.blocks, key=lambda block_hash: (-length(block_hash), block_hash))
+        chain = set()
+        block_hash = tip_hash
+        while block_hash is not None:
+            chain.add(block_hash)
+            block_hash = self.blocks[block_hash][0]
+        return tip_hash, chain
+
+
+def _percentiles(values):
+    if not values:
+        return "no measure"
+    values = sorted(values)
+    return "p50 {:.0f} ms, p90 {:.0f} ms, max {:.0f} ms".format(
+        *(1000 * values[int(q * (len(values) - 1))] for q in (0.5, 0.9, 1)))
+
+
+def run(nb_nodes, nb_blocks, **options):
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        simulation = Simulation(nb_nodes, **options)
+        try:
+            simulation.run(nb_blocks)
+        finally:
+            simulation.close()
+    duration = time.perf_counter() - start
+
+    mined = [block_hash for block_hash, (previous_hash, when) in simulation.blocks.items() if previous_hash is not None]
+    best_tip_hash, best_chain = simulation.get_best_chain()
+    stale = [block_hash for block_hash in mined if block_hash not in best_chain]
+    adoption_times = simulation.get_adoption_times()
+
+    # Time for a block of the best chain to reach half of the nodes, 90% of them, all of them
+    reach = {0.5: [], 0.9: [], 1: []}
+    for block_hash in mined:
+        if block_hash not in best_chain:
+            continue
+        found_time = simulation.blocks[block_hash][1]
+        delays = sorted(adopted[block_hash] - found_time for adopted in adoption_times if block_hash in adopted)
+        for share, values in reach.items():
+            needed = math.ceil(share * nb_nodes)
+            if len(delays) >= needed:
+                values.append(delays[needed - 1])
+
+    print("Nodes : {}, virtual time : {:.0f} s, real time : {:.1f} s".format(nb_nodes, simulation.clock.now,
+                                                                              duration))
+    print("Blocks : {} found, {} stale, fork rate {:.1%}".format(len(mined), len(stale),
+                                                                 len(stale) / len(mined) if mined else 0))
+    print("Nodes on the best tip at the end : {}/{}".format(
+        sum(bool(node.tips) and node.tips[-1][1] == best_tip_hash for node in simulation.nodes), nb_nodes))
+    for share, values in reach.items():
+        print("Block propagation to {:.0%} of the nodes : {}".format(share, _percentiles(values)))
+    print("Network : {} connections, {:.1f} MB sent, {} segments lost".format(
+        simulation.network.connections, simulation.network.bytes_sent / 1e6, simulation.network.segments_lost))
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    run(int(args[0]) if args else 100, int(args[1]) if len(args) > 1 else 20,
+        degree=int(options.get("degree", 4)), latency=float(options.get("latency", 0.05)),
+        bandwidth=float(options["bandwidth"]) if "bandwidth" in options else None,
+        loss=float(options.get("loss", 0)), block_interval=float(options.get("block-interval", 10)),
+        seed=int(options.get("seed", 0)))
@@ -0,0 +1,48 @@
+"""Measures the throughput of each stage of the pipeline of the full node on its own, outside of any running node :
+the verification of signatures at admission (by the admission workers), the validation of blocks, mining (by a
+mining worker) and storage. A running node logs the same stats for the traffic it actually gets.
+
+Usage, from the root of the repository :
+    python -m benchmarks.pipeline_stages [number_of_transactions] [transactions_per_block]
+"""
+from network import fullnode_workers
+from tools import classes, crypto, database, fullnode_api, validation
+import os
+import sys
+
+
+def run(nb_transactions, transactions_per_block):
+    seed = crypto.new_seed()
+    address = crypto.get_address(seed)
+    database.init_database_path('database/db_benchmark')
+    genesis_block = fullnode_api.add_genesis_block(classes.GenesisBlock(address))
+    fullnode_workers.start()
+
+    transactions = []
+    previous_txhash = genesis_block.block_content[0].txhash
+    for _ in range(nb_transactions):
+        t = classes.Transaction({previous_txhash: 0}, {address: 100})
+        t.sign(seed)
+        transactions.append(t)
+        previous_txhash = t.txhash
+
+    with fullnode_workers.admission.measure(len(transactions)):
+        assert all(fullnode_workers.verify_signatures(transactions))
+
+    for start in range(0, nb_transactions, transactions_per_block):
+        block = classes.Block(transactions[start:start + transactions_per_block])
+        with fullnode_workers.validation.measure():
+            validation.validate_block(block)
+        mined_block = fullnode_workers.mine_block(block)
+        with fullnode_workers.storage.measure():
+            fullnode_api.add_block_to_db(mined_block)
+
+    for name, stats in fullnode_workers.get_stats().items():
+        print("{:>10} : {} items in {:.2f} s, {} items/s".format(name, stats["items"], stats["busy_seconds"],
+                                                                 stats["items_per_second"]))
+    database.reinit_database_path()
+    os.remove('database/db_benchmark')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100, int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,288 @@
+"""Starts a local testnet of full nodes and measures end-to-end transaction confirmation latency and block
+propagation time across them.
+
+Each node runs network/fullnode.py in a directory of its own, with a generated network/config.json (ports,
+neighbors) and its own database, all starting from the same genesis block. The output of the genesis block is first
+split between the nodes, then each node is sent a chain of transactions spending its share, at the given rate. The
+chains of all the nodes are polled meanwhile, to see when each block and transaction reaches each node.
+
+Usage, from the root of the repository :
+    python -m benchmarks.testnet [number_of_nodes] [number_of_transactions] [--topology=ring] [--rate=10]
+                                 [--block-wait=1] [--keep]
+
+Topologies : line, ring, star (every node connected to the first one) and mesh. The rate is in transactions per
+second, for the whole testnet (0 for as fast as possible). Block-wait is the maximum waiting time of a transaction
+before its block is assembled. With --keep, the directory of the nodes (printed) is kept, e.g. to read their logs.
+"""
+from network import lightnode
+from tools import classes, crypto, database, fullnode_api, validation
+import contextlib
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+TOPOLOGIES = ("line", "ring", "star", "mesh")
+
+_REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_neighbors(nb_nodes, topology):
+    """Returns, for each node, the list of the indexes of the nodes it gossips with. Gossip goes both ways : a node
+    announcing itself is added to the neighbors of the other one."""
+
+    if topology == "line":
+        return [[i + 1] if i + 1 < nb_nodes else [] for i in range(nb_nodes)]
+    if topology == "ring":
+        return [[(i + 1) % nb_nodes] if nb_nodes > 1 else [] for i in range(nb_nodes)]
+    if topology == "star":
+        return [[] if i == 0 else [0] for i in range(nb_nodes)]
+    if topology == "mesh":
+        return [[j for j in range(nb_nodes) if j != i] for i in range(nb_nodes)]
+    raise ValueError(f"Unknown topology {topology}, expected one of {TOPOLOGIES}.")
+
+
+class Testnet:
+    """This class starts full nodes on localhost, node i listening for clients on base_port + 2 * i and for
+    neighbors on base_port + 2 * i + 1. Each node gets a directory of its own in directory (a temporary one by
+    default), holding its config, database and log. config_overrides ({section: {key: value}}) are applied to the
+    config of every node, on top of network/config.json."""
+
+    def __init__(self, nb_nodes, genesis_block, topology="ring", base_port=61000, directory=None,
+                 config_overrides=None):
+        self.nb_nodes = nb_nodes
+        self.genesis_block = genesis_block
+        self.topology = topology
+        self.base_port = base_port
+        self.directory = directory if directory is not None else tempfile.mkdtemp(prefix="testnet_")
+        self.config_overrides = config_overrides or {}
+        self.host = "127.0.0.1"
+        self.pools = []
+        self._processes = []
+
+    def get_client_port(self, i):
+        return self.base_port + 2 * i
+
+    def get_node_directory(self, i):
+        return os.path.join(self.directory, f"node{i}")
+
+    def start(self, timeout=30):
+        """Writes the config and the database of each node, starts them, and waits until they all accept
+        clients."""
+
+        with open(os.path.join(_REPOSITORY_PATH, 'network/config.json')) as cfg_file:
+            base_cfg = json.load(cfg_file)
+
+        for i, neighbors in enumerate(get_neighbors(self.nb_nodes, self.topology)):
+            node_directory = self.get_node_directory(i)
+            os.makedirs(os.path.join(node_directory, "network"))
+            os.makedirs(os.path.join(node_directory, "database"))
+
+            cfg = json.loads(json.dumps(base_cfg))  # A deep copy
+            for section, values in self.config_overrides.items():
+                cfg[section].update(values)
+            cfg["FullnodeInfo"].update(host=self.host, clients_listening_port=self.get_client_port(i),
+                                       neighbors_listening_port=self.get_client_port(i) + 1,
+                                       database_path="database/db2")
+            cfg["NeighborsInfo"]["neighbors"] = [[self.host, self.get_client_port(j) + 1] for j in neighbors]
+            with open(os.path.join(node_directory, "network/config.json"), "w") as cfg_file:
+                json.dump(cfg, cfg_file, indent=4)
+
+            database.init_database_path(os.path.join(node_directory, cfg["FullnodeInfo"]["database_path"]))
+            fullnode_api.add_genesis_block(self.genesis_block)
+            database.reinit_database_path()
+
+            # The modules of the node read network/config.json from the working directory, i.e. the node directory
+            with open(os.path.join(node_directory, "node.log"), "w") as log_file:
+                self._processes.append(subprocess.Popen(
+                    [sys.executable, "-u", os.path.join(_REPOSITORY_PATH, "network/fullnode.py")],
+                    cwd=node_directory, stdout=log_file, stderr=subprocess.STDOUT,
+                    env=dict(os.environ, PYTHONPATH=_REPOSITORY_PATH)))
+
+        deadline = time.monotonic() + timeout
+        for i in range(self.nb_nodes):
+            while True:
+                try:
+                    socket.create_connection((self.host, self.get_client_port(i)), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline or self._processes[i].poll() is not None:
+                        self.stop()
+                        raise RuntimeError(f"Node {i} did not start, see {self.get_node_directory(i)}/node.log.")
+                    time.sleep(0.1)
+            self.pools.append(lightnode.ConnectionPool(host=self.host, port=self.get_client_port(i)))
+
+    def get_chain(self, i):
+        """Returns the chain of node i, None if it could not be requested."""
+        request = lightnode.DatabaseRequest(pool=self.pools[i])
+        request.request()
+        return request.database
+
+    def stop(self, keep=False):
+        """Stops the nodes, as with Ctrl+C so that their worker processes stop as well, and removes their directory
+        unless keep."""
+
+        for pool in self.pools:
+            pool.close()
+        for process in self._processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in self._processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not keep:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ChainObserver:
+    """This class polls the chain of every node of a testnet in a thread, and records when each block and each
+    transaction is first seen in the chain of each node. The measures are as precise as the polling interval."""
+
+    def __init__(self, testnet, interval=0.1):
+        self.testnet = testnet
+        self.interval = interval
+        self.block_seen = {}  # block hash -> {node: time}
+        self.transaction_seen = {}  # txhash -> {node: time}
+        self.final_chains = [None] * testnet.nb_nodes
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _poll(self):
+        while not self._stop.is_set():
+            for i in range(self.testnet.nb_nodes):
+                chain = self.testnet.get_chain(i)
+                if chain is None:
+                    continue
+                now = time.monotonic()
+                self.final_chains[i] = chain
+                for b in chain[1:]:
+                    self.block_seen.setdefault(validation.get_block_hash(b), {}).setdefault(i, now)
+                    for t in b.block_content:
+                        self.transaction_seen.setdefault(t.txhash, {}).setdefault(i, now)
+            self._stop.wait(self.interval)
+
+    def wait_for_transactions(self, txhashes, timeout):
+        """Waits until the transactions are in the chain of every node. Returns False on timeout."""
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(len(self.transaction_seen.get(txhash, ())) == self.testnet.nb_nodes for txhash in txhashes):
+                return True
+            time.sleep(self.interval)
+        return False
+
+
+def split_genesis_output(genesis_block, seed, addresses):
+    """Returns the signed transaction sharing the output of the genesis block between the addresses."""
+
+    genesis_transaction = genesis_block.block_content[0]
+    amount = list(genesis_transaction.internals["dict_of_outputs"].values())[0]
+    share = amount // len(addresses)
+    outputs = {address: share for address in addresses}
+    outputs[addresses[0]] += amount - share * len(addresses)
+    t = classes.Transaction({genesis_transaction.txhash: 0}, outputs)
+    t.sign(seed)
+    return t
+
+
+def _percentiles(values):
+    if not values:
+        return "no measure"
+    values = sorted(values)
+    return "p50 {:.0f} ms, p90 {:.0f} ms, max {:.0f} ms".format(1000 * values[int(0.5 * (len(values) - 1))],
+                                                                 1000 * values[int(0.9 * (len(values) - 1))],
+                                                                 1000 * values[-1])
+
+
+def run(nb_nodes, nb_transactions, topology="ring", rate=10, block_wait=1, keep=False, timeout=300):
+    seed = crypto.new_seed()
+    genesis_block = classes.GenesisBlock(crypto.get_address(seed))
+    testnet = Testnet(nb_nodes, genesis_block, topology=topology,
+                      config_overrides={"BlockAssemblyInfo": {"max_wait_seconds": block_wait}})
+    print("Starting {} nodes ({}) in {}".format(nb_nodes, topology, testnet.directory))
+
+    # The nodes and the lightnode functions print every connection : only the report is shown
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        testnet.start()
+        observer = ChainObserver(testnet)
+        observer.start()
+        try:
+            # Each node is given a share of the genesis output, spent by the transactions it is sent
+            node_seeds = [crypto.new_seed() for _ in range(nb_nodes)]
+            node_addresses = [crypto.get_address(node_seed) for node_seed in node_seeds]
+            split_transaction = split_genesis_output(genesis_block, seed, node_addresses)
+            lightnode.TransactionBroadcasting(split_transaction, pool=testnet.pools[0]).broadcast()
+            funded = observer.wait_for_transactions([split_transaction.txhash], timeout)
+
+            submitted = {}  # txhash -> (node, time of submission)
+            previous_txhashes = [split_transaction.txhash] * nb_nodes
+            amounts = list(split_transaction.internals["dict_of_outputs"].values())
+            start = time.monotonic()
+            for n in range(nb_transactions if funded else 0):
+                i = n % nb_nodes
+                # Each node spends its own output, then the output of the previous transaction it was sent
+                t = classes.Transaction({previous_txhashes[i]: i if n < nb_nodes else 0},
+                                        {node_addresses[i]: amounts[i]})
+                t.sign(node_seeds[i])
+                previous_txhashes[i] = t.txhash
+                if rate:
+                    time.sleep(max(0, start + n / rate - time.monotonic()))
+                submitted[t.txhash] = (i, time.monotonic())
+                lightnode.TransactionBroadcasting(t, pool=testnet.pools[i]).broadcast()
+
+            confirmed = funded and observer.wait_for_transactions(list(submitted), timeout)
+        finally:
+            observer.stop()
+            testnet.stop(keep=keep)
+
+    if not funded:
+        print("The genesis output could not be split between the nodes within {} s.".format(timeout))
+        return
+
+    # Confirmation : in the chain of the node the transaction was sent to, then in the chains of all the nodes
+    local_latencies = []
+    global_latencies = []
+    for txhash, (i, submission_time) in submitted.items():
+        seen = observer.transaction_seen.get(txhash, {})
+        if i in seen:
+            local_latencies.append(seen[i] - submission_time)
+        if len(seen) == nb_nodes:
+            global_latencies.append(max(seen.values()) - submission_time)
+
+    # Propagation : from the first node having a block in its chain to the last one. Blocks abandoned in a fork do
+    # not reach every node
+    final_hashes = {validation.get_block_hash(b) for b in (observer.final_chains[0] or [])[1:]}
+    propagation_times = [max(seen.values()) - min(seen.values()) for block_hash, seen in observer.block_seen.items()
+                         if len(seen) == nb_nodes]
+    abandoned_blocks = [block_hash for block_hash in observer.block_seen if block_hash not in final_hashes]
+
+    print("Transactions : {} submitted, {} confirmed on every node{}".format(
+        len(submitted), len(global_latencies), "" if confirmed else " (timed out)"))
+    print("Confirmation latency, on the node it was sent to : " + _percentiles(local_latencies))
+    print("Confirmation latency, on every node : " + _percentiles(global_latencies))
+    print("Blocks : {} in the final chain, {} abandoned in forks".format(len(final_hashes), len(abandoned_blocks)))
+    print("Block propagation to every node : " + _percentiles(propagation_times))
+    print("(measured by polling the chains every {:.0f} ms)".format(1000 * observer.interval))
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    run(int(args[0]) if len(args) > 0 else 4, int(args[1]) if len(args) > 1 else 100,
+        topology=options.get("topology", "ring"), rate=float(options.get("rate", 10)),
+        block_wait=float(options.get("block-wait", 1)), keep="--keep" in sys.argv)
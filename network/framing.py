@@ -0,0 +1,225 @@
+from network import json_tools
+import collections
+import itertools
+import os
+import struct
+import sys
+
+# Maximum number of buffers given to one sendmsg call, below the IOV_MAX of the usual OSes
+_MAX_SEND_PARTS = 64
+
+# Bytes of a file part read at once when it cannot be sent with os.sendfile, so that it is never loaded whole
+FILE_CHUNK_SIZE = 262144
+
+
+def create_header(content_type, content_length, extra_headers=None):
+    """Returns the fixed header and the json header of a message, consistent with our application-layer protocol :
+    2 bytes for the length of the json header, the json header, then the content."""
+
+    jsonheader = {
+        "byteorder": sys.byteorder,  # For the endianness of the OS
+        "content-type": content_type,
+        "content-length": content_length,
+    }
+    if extra_headers:
+        jsonheader.update(extra_headers)
+    jsonheader_bytes = json_tools.json_encode(jsonheader, "utf-8")
+    return struct.pack(">H", len(jsonheader_bytes)) + jsonheader_bytes
+
+
+def pack_batch(items):
+    """Returns the content of a batch message, e.g. a transaction_batch : each item (bytes) preceded by its length on
+    4 bytes."""
+    return b"".join(struct.pack(">I", len(item)) + item for item in items)
+
+
+def unpack_batch(content):
+    """Returns the items of the content of a batch message, as memoryviews of the content, without copying them.
+    Raises a ValueError if the content is truncated."""
+
+    items = []
+    view = memoryview(content)
+    offset = 0
+    while offset < len(view):
+        if offset + 4 > len(view):
+            raise ValueError("Truncated length of item in batch message.")
+        item_length = struct.unpack_from(">I", view, offset)[0]
+        offset += 4
+        if offset + item_length > len(view):
+            raise ValueError("Truncated item in batch message.")
+        items.append(view[offset:offset + item_length])
+        offset += item_length
+    return items
+
+
+class FrameReader:
+    """This class is the receive buffer of the connection classes. Data is received with recv_into in a preallocated
+    bytearray, which only grows when a message does not fit, and it is parsed in place. Contrary to appending each
+    received chunk to a bytes object and slicing it after each parsed part, a message is copied once from the socket
+    to the buffer and once out of it, whatever its size."""
+
+    def __init__(self, initial_size=65536):
+        self._buffer = bytearray(initial_size)
+        self._start = 0  # First byte received but not yet read
+        self._end = 0  # End of the received bytes
+
+    def __len__(self):
+        return self._end - self._start
+
+    def reserve(self, nbytes):
+        """Makes room for nbytes unread bytes in the buffer, e.g. once the content-length of a message is known."""
+
+        unread = self._end - self._start
+        if nbytes <= len(self._buffer) - self._start:
+            return  # It already fits
+
+        if nbytes <= len(self._buffer):
+            # We move the unread bytes to the front of the buffer
+            self._buffer[:unread] = self._buffer[self._start:self._end]
+        else:
+            new_buffer = bytearray(max(nbytes, 2 * len(self._buffer)))
+            new_buffer[:unread] = self._buffer[self._start:self._end]
+            self._buffer = new_buffer
+        self._start = 0
+        self._end = unread
+
+    def recv_from(self, sock):
+        """Receives as much as the free space of the buffer allows from the socket. Returns the number of received
+        bytes, 0 meaning that the peer closed. Raises BlockingIOError like the socket."""
+
+        if self._end == len(self._buffer):
+            # No free space left at the end : we compact the buffer, or grow it if it is full of unread bytes
+            self.reserve(len(self) + 4096)
+
+        with memoryview(self._buffer) as view:
+            nbytes = sock.recv_into(view[self._end:])
+        self._end += nbytes
+        return nbytes
+
+    def unpack(self, fmt):
+        """Reads a struct of the given format, the caller having checked that enough bytes were received."""
+        values = struct.unpack_from(fmt, self._buffer, self._start)
+        self._start += struct.calcsize(fmt)
+        return values
+
+    def read(self, nbytes):
+        """Reads nbytes bytes, None if they have not yet been received."""
+
+        view = self.read_view(nbytes)
+        if view is None:
+            return None
+        with view:
+            return bytes(view)  # The only copy out of the buffer
+
+    def read_view(self, nbytes):
+        """Reads nbytes bytes as a memoryview of the buffer, without copying them, None if they have not yet been
+        received. The view is only valid until the next recv_from, and should be released by the caller."""
+
+        if len(self) < nbytes:
+            return None
+        with memoryview(self._buffer) as view:
+            data = view[self._start:self._start + nbytes]
+        self._start += nbytes
+        if self._start == self._end:
+            # Everything has been read, the next message starts at the front of the buffer
+            self._start = self._end = 0
+        return data
+
+
+class FilePart:
+    """This class is a part of a message sent straight from a file, e.g. the database sent to a client, so that
+    the send buffer never holds its content. It is sent with os.sendfile when the socket has a file descriptor, by
+    chunks of FILE_CHUNK_SIZE bytes otherwise. The file is closed once the part is sent."""
+
+    def __init__(self, file, size, offset=0):
+        self.file = file
+        self.size = size
+        self.offset = offset  # Position of the part in the file
+
+    def __len__(self):
+        return self.size
+
+    def send_to(self, sock, sent):
+        """Sends what follows the first sent bytes of the part, as much as the socket accepts, and returns the number
+        of sent bytes. Raises BlockingIOError like the socket."""
+
+        count = self.size - sent
+        if hasattr(sock, "send_file"):
+            nbytes = sock.send_file(self.file, self.offset + sent, count)  # See fullnode_socket_manager.StreamSocket
+        elif hasattr(os, "sendfile") and hasattr(sock, "fileno"):
+            nbytes = os.sendfile(sock.fileno(), self.file.fileno(), self.offset + sent, count)
+        else:
+            self.file.seek(self.offset + sent)
+            nbytes = sock.send(self.file.read(min(count, FILE_CHUNK_SIZE)))
+
+        if not nbytes:
+            raise EOFError("File ended before its part of the message was sent.")
+        return nbytes
+
+    def close(self):
+        self.file.close()
+
+
+class FrameWriter:
+    """This class is the send buffer of the connection classes. Messages are queued as a list of parts (typically
+    the header and the content) which are never concatenated nor re-sliced : they are sent with sendmsg
+    scatter-gather when the socket supports it, from memoryviews at the current offset otherwise. A part may also
+    be a FilePart, sent from the file without being loaded in memory."""
+
+    def __init__(self):
+        self._parts = collections.deque()
+        self._offset = 0  # Bytes of the first part already sent
+        self._pending = 0  # Bytes left to send
+
+    def __len__(self):
+        return self._pending
+
+    def append(self, *parts):
+        """Queues the parts of a message."""
+        for part in parts:
+            if part:
+                self._parts.append(part)
+                self._pending += len(part)
+            elif isinstance(part, FilePart):
+                part.close()
+
+    def clear(self):
+        """Drops the parts not yet sent, e.g. when the connection is closed, closing their files."""
+        for part in self._parts:
+            if isinstance(part, FilePart):
+                part.close()
+        self._parts.clear()
+        self._offset = 0
+        self._pending = 0
+
+    def send_to(self, sock):
+        """Sends as much as the socket accepts and returns the number of sent bytes. Raises BlockingIOError like the
+        socket."""
+
+        if not self._parts:
+            return 0
+
+        if isinstance(self._parts[0], FilePart):
+            sent = self._parts[0].send_to(sock, self._offset)
+        elif hasattr(sock, "sendmsg"):
+            # The parts up to the next file part, if any
+            buffers = itertools.takewhile(lambda part: not isinstance(part, FilePart),
+                                          itertools.islice(self._parts, 1, _MAX_SEND_PARTS))
+            sent = sock.sendmsg([memoryview(self._parts[0])[self._offset:]] + list(buffers))
+        else:
+            sent = sock.send(memoryview(self._parts[0])[self._offset:])
+
+        self._pending -= sent
+        sent_left = sent
+        while sent_left:
+            left_in_first_part = len(self._parts[0]) - self._offset
+            if sent_left < left_in_first_part:
+                self._offset += sent_left
+                break
+            sent_left -= left_in_first_part
+            part = self._parts.popleft()
+            if isinstance(part, FilePart):
+                part.close()
+            self._offset = 0
+
+        return sent
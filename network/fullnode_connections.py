@@ -1,90 +1,143 @@
-from tools import database
-from network import json_tools
-import pickle
+from network import framing, json_tools, response_cache
 import selectors
-import struct
-import sys
+
+
+# The messages exchanged by two neighbors to synchronize their chains and mempools, see NeighborConnection
+SYNC_CONTENT_TYPES = ("tip_announcement", "headers_request", "headers", "blocks_request", "blocks", "compact_blocks",
+                      "block_transactions_request", "block_transactions", "transaction_batch")
+
+# The requests of a client answered from the chain of the node, e.g. by a lightnode keeping a copy of the chain up to
+# date, see ClientConnection.answer_query
+QUERY_CONTENT_TYPES = ("chain_update_request", "header_update_request", "merkle_proofs_request", "get_balance",
+                       "get_utxos", "get_tx", "get_tip")
 
 
 class ClientConnection:
-    """This class is used to process one connection with a client. There are two possible interactions :
-    Either a client sends us a new transaction that he created,
-    either it is a request for the full database."""
+    """This class is used to process one connection with a client. There are three possible interactions :
+    Either a client sends us a new transaction that he created (or a batch of them),
+    either it is a request for the full database,
+    either it is a query on our chain, e.g. for the blocks following the ones the client knows.
+    When the messages of the client carry a "request-id" header, the connection is persistent : it carries many
+    requests, one after the other, and each response carries the request-id of the request it answers."""
     def __init__(self, selector, sock, addr):
         self.selector = selector
         self.sock = sock
         self.addr = addr
 
         # Here we initalize all the class properties (for tx and db) as we cannot yet know which one will be the case
-        self._recv_buffer = b""  # Used both for receiving transactions and request to send the database
-        self._send_buffer = b""  # For when we send the database to a client
+        self._recv_buffer = framing.FrameReader()  # Used both for receiving transactions and requests for the database
+        self._send_buffer = framing.FrameWriter()  # For when we send the database to a client
 
         self._jsonheader_len = None
         self.jsonheader = None
 
         self._database_queued = False  # To ensure we started to send the database to a client
+        self.database_requested = False  # True when the client waits for the database, see queue_database()
+        self.database_encoding = None  # The encoding the client requested the database in, e.g. "gzip", if any
         self.transaction_received = None  # Filled when we have successfully received a new transaction from a client
+        self.transaction_batch_received = None  # The list of transactions (bytes-like) of a received batch
+        self.query_received = None  # The (content_type, content) of a received query, see answer_query()
+        self._response_queued = False  # To ensure we started to send the answer to the query of a one-shot connection
+
+        self.persistent = False  # True once the client has tagged a message with a request-id
+        self.request_id = None  # The request-id of the message being processed
 
         self.is_closed = False  # To indicate that it has consciously been closed
 
     def _read(self):
         """Internal function called by read() to manage the socket."""
         try:
-            # Should be ready to read
-            data = self.sock.recv(4096)
+            # Should be ready to read. Receives directly in the free space of the buffer
+            nbytes = self._recv_buffer.recv_from(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK), skipping it for now
             # select() will eventually call us again
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not nbytes:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
         """Internal function called by write() to manage the socket."""
         if self._send_buffer:
-            print("Sending database to", self.addr)
             try:
-                # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                # Should be ready to write. Sends from the offset of the queued parts, without copying them
+                self._send_buffer.send_to(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK), skipping it for now
                 # select() will eventually call us again
                 pass
-            else:  # If no errors were raised
-                self._send_buffer = self._send_buffer[sent:]
 
     def _set_selector_to_write(self):
-        """Set selector to listen for write events once we are ready to send the database."""
+        """Set selector to listen for write events once the database is queued."""
 
         event = selectors.EVENT_WRITE
         self.selector.modify(self.sock, event, data=self)
 
-    def _queue_database(self):
-        """Reads the database, calls _create_message_message and adds the created database message (now in the
-        correct formatting for broadcasting) to the send_buffer. Marks _database_queued as True."""
+    def _set_selector_to_read_write(self):
+        """Set selector to listen for both read and write events, when a persistent connection has a response to
+        send while the client may keep sending requests."""
+
+        event = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.selector.modify(self.sock, event, data=self)
+
+    def _set_selector_to_read(self):
+        """Set selector to listen for read events once a persistent connection has sent all its responses."""
+
+        event = selectors.EVENT_READ
+        self.selector.modify(self.sock, event, data=self)
 
-        db = pickle.dumps(database.read_from_db())
-        db_message = ClientConnection._create_database_message(content_bytes=db)  # Static method
-        self._send_buffer += db_message
+    def queue_database(self, database_content, content_encoding=None):
+        """Called by the fullnode with the serialized database once the client has requested it : calls
+        _create_database_message and adds the created database message (now in the correct formatting for
+        broadcasting) to the send_buffer. Marks _database_queued as True. The database is usually a FilePart of the
+        database file, streamed to the client straight from the disk without being loaded in memory, however many
+        clients request it. If the client has requested an encoding, it is the cached encoded database (bytes)."""
+
+        print("Sending database to", self.addr)
+        db_message = ClientConnection._create_database_message(content_bytes=database_content,
+                                                               request_id=self.request_id,
+                                                               content_encoding=content_encoding)  # Static method
+        self._send_buffer.append(*db_message)
         self._database_queued = True
+        self.database_requested = False
+
+        if self.persistent:
+            # We go on with the next messages of the client while the database is sent
+            self._set_selector_to_read_write()
+            self._reset_message()
+            self._process_received_messages()
+        else:
+            self._set_selector_to_write()
+
+    def _queue_response(self, message):
+        """Adds a response of a persistent connection to the send_buffer, and starts listening for write events."""
+
+        self._send_buffer.append(*message)
+        self._set_selector_to_read_write()
+
+    @staticmethod
+    def _create_message(content_type, content_bytes, request_id=None, content_encoding=None):
+        """Returns the 3-parts message, given the content to include, consistent with out application-layer
+        protocol that we have defined for broadcasting messages between full nodes and clients. The request-id is
+        only included for the responses of a persistent connection, the content-encoding for encoded contents. The
+        message is returned as the list of its [headers, content] parts, to be queued in the send buffer without
+        concatenating them."""
+
+        extra_headers = {}
+        if request_id is not None:
+            extra_headers["request-id"] = request_id
+        if content_encoding is not None:
+            extra_headers["content-encoding"] = content_encoding
+        return [framing.create_header(content_type, len(content_bytes), extra_headers), content_bytes]
 
     @staticmethod
-    def _create_database_message(content_bytes):
-        """Returns the 3-parts database message, given the database, consistent with out application-layer
-        protocol that we have defined for broadcasting messages between full nodes and clients."""
-
-        jsonheader = {
-            "byteorder": sys.byteorder,  # For the endianness of the OS
-            "content-type": "database_content",
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = json_tools.json_encode(jsonheader, "utf-8")
-        database_message_fixed_hdr = struct.pack(">H", len(jsonheader_bytes))
-        database_message = database_message_fixed_hdr + jsonheader_bytes + content_bytes
-        return database_message
+    def _create_database_message(content_bytes, request_id=None, content_encoding=None):
+        """Returns the 3-parts database message, given the serialized database (bytes or a FilePart), consistent
+        with out application-layer protocol that we have defined for broadcasting messages between full nodes and
+        clients."""
+        return ClientConnection._create_message("database_content", content_bytes, request_id=request_id,
+                                                content_encoding=content_encoding)
 
     def process_events(self, mask):
         """Entry point when the socket is ready for reading or writing."""
@@ -97,41 +150,127 @@ class ClientConnection:
         """Manages the reading of the client message through the socket, while maintaining the state. In addition,
         it interprets the different parts of the message."""
         self._read()
+        self._process_received_messages()
+
+    def _process_received_messages(self):
+        """Interprets the messages of the receive buffer. A persistent connection may have received several of
+        them at once, a one-shot connection stops after the first one."""
+
+        while not self.is_closed:
+            if self._jsonheader_len is None:
+                self.process_jsonheader_length()  # Triggers once we have received 2 bytes
 
-        if self._jsonheader_len is None:
-            self.process_jsonheader_length()  # Triggers once we have received 2 bytes
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()  # Triggers once we have received jsonheader_len bytes
 
-        if self._jsonheader_len is not None:
             if self.jsonheader is None:
-                self.process_jsonheader()  # Triggers once we have received jsonheader_len bytes
+                return  # We wait for more data
 
-        if self.jsonheader is not None:
+            self.request_id = self.jsonheader.get("request-id")
+            if self.request_id is not None:
+                self.persistent = True
 
-            # If what we received is a database request, we change the events that the selectors is listening to write
+            # If what we received is a database request, we wait for the fullnode to serialize the database
             if self.jsonheader["content-type"] == "db_request":
-                self._set_selector_to_write()
+                if self.persistent:
+                    request_content = self.process_request_message()
+                    if request_content is None:
+                        return  # We wait for the content of the request
+                    self.database_encoding = ClientConnection._get_requested_encoding(request_content)
+                self.database_requested = True
+                return  # See queue_database()
 
             # If what we received is a transaction
             elif self.jsonheader["content-type"] == "transaction_content":
                 if self.transaction_received is None:
                     self.process_transaction_message()  # Triggers if we have recv'd jsonheader["content-length"] bytes
+                # In any case we wait for the fullnode to process the transaction, see acknowledge_transaction()
+                return
+
+            # If what we received is a batch of transactions, e.g. from an exchange
+            elif self.jsonheader["content-type"] == "transaction_batch":
+                if self.transaction_batch_received is None:
+                    self.process_transaction_batch_message()
+                # In any case we wait for the fullnode to process the transactions, see acknowledge_transaction_batch()
+                return
+
+            # If what we received is a query on the chain
+            elif self.jsonheader["content-type"] in QUERY_CONTENT_TYPES:
+                if self.query_received is None:
+                    query_content = self.process_request_message()
+                    if query_content is None:
+                        return  # We wait for the content of the query
+                    self.query_received = (self.jsonheader["content-type"], query_content)
+                # In any case we wait for the fullnode to answer it, see answer_query()
+                return
 
             else:
                 # Unrecognized content-type.
                 print(f'Unrecognized content-type from : {self.addr}')
                 self.close()
 
+    def _reset_message(self):
+        """Gets a persistent connection ready for the next message of the client."""
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self._database_queued = False
+
+    def acknowledge_transaction(self, status):
+        """Called by the fullnode once it has processed the received transaction. On a persistent connection, the
+        client is told whether the transaction has been accepted, held until its parents are known or rejected (see
+        fullnode_processing.admit_transaction), and the next messages are interpreted."""
+
+        self.transaction_received = None
+        if self.persistent and not self.is_closed:
+            result_bytes = json_tools.json_encode({"status": status}, "utf-8")
+            self._queue_response(ClientConnection._create_message("transaction_result", result_bytes,
+                                                                  request_id=self.request_id))
+            self._reset_message()
+            self._process_received_messages()
+
+    def acknowledge_transaction_batch(self, statuses):
+        """Called by the fullnode once it has processed the received batch of transactions, with the status of each
+        of them, in the same order. On a persistent connection, they are sent to the client, and the next messages
+        are interpreted."""
+
+        self.transaction_batch_received = None
+        if self.persistent and not self.is_closed:
+            result_bytes = json_tools.json_encode({"statuses": statuses}, "utf-8")
+            self._queue_response(ClientConnection._create_message("transaction_batch_result", result_bytes,
+                                                                  request_id=self.request_id))
+            self._reset_message()
+            self._process_received_messages()
+
+    def answer_query(self, content_type, content_bytes):
+        """Called by the fullnode with the answer to the received query. It is sent to the client, with the request-id
+        of the query. A persistent connection goes on with the next messages, a one-shot connection is closed once
+        the answer is sent."""
+
+        self.query_received = None
+        if self.is_closed:
+            return
+        message = ClientConnection._create_message(content_type, content_bytes, request_id=self.request_id)
+        if self.persistent:
+            self._queue_response(message)
+            self._reset_message()
+            self._process_received_messages()
+        else:
+            self._send_buffer.append(*message)
+            self._response_queued = True
+            self._set_selector_to_write()
+
     def write(self):
         """Manages the writing of the database through the socket, while maintaining the state."""
-        if not self._database_queued:  # We have not yet init the sending process. Ensures that we init only once.
-            self._queue_database()  # Initializes the sending process.
-
         self._write()
 
-        if self._database_queued:
-            if not self._send_buffer:  # We started AND finished the sending.
-                # We are done sending the database, we can now call close().
-                print(f'Finished sending the database to : {self.addr}')
+        if not self._send_buffer:  # We started AND finished the sending.
+            if self.persistent:
+                # We keep the connection open for the next requests of the client
+                self._set_selector_to_read()
+            elif self._database_queued or self._response_queued:
+                # We are done sending the database or the answer, we can now call close().
+                print(f'Finished sending the response to : {self.addr}')
                 self.close()
 
     def close(self):
@@ -158,25 +297,22 @@ class ClientConnection:
             # Delete reference to socket object for garbage collection
             self.is_closed = True
             self.sock = None
+            self._send_buffer.clear()  # Closes the database file if it was not completely sent
 
     def process_jsonheader_length(self):
         """Reads the 2 bytes containing the length of the header."""
 
         fixed_header_length = 2
         if len(self._recv_buffer) >= fixed_header_length:  # Check if we already have received enough data
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:fixed_header_length]
-            )[0]
-            self._recv_buffer = self._recv_buffer[fixed_header_length:]
+            self._jsonheader_len = self._recv_buffer.unpack(">H")[0]
 
     def process_jsonheader(self):
         """Reads the json_header of the actual transaction message."""
 
         if len(self._recv_buffer) >= self._jsonheader_len:  # Check if we already have received enough data
-            self.jsonheader = json_tools.json_decode(
-                self._recv_buffer[:self._jsonheader_len], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[self._jsonheader_len:]
+            # Decoded straight from the receive buffer
+            with self._recv_buffer.read_view(self._jsonheader_len) as jsonheader_view:
+                self.jsonheader = json_tools.json_decode(jsonheader_view, "utf-8")
             for required_header in (
                 "byteorder",
                 "content-type",
@@ -192,8 +328,7 @@ class ClientConnection:
 
         # Check if we already have received enough data, or wait for more buffer.
         if len(self._recv_buffer) >= content_len:
-            data = self._recv_buffer[:content_len]
-            self._recv_buffer = self._recv_buffer[content_len:]
+            data = self._recv_buffer.read(content_len)
 
             print(
                 f'Received a message from',
@@ -201,112 +336,201 @@ class ClientConnection:
             )
 
             self.transaction_received = data
-            self.close()
+            if not self.persistent:
+                self.close()
+
+    def process_transaction_batch_message(self):
+        """Reads the message of a batch of transactions, each of them preceded by its length."""
+
+        content_len = self.jsonheader["content-length"]
+
+        # Check if we already have received enough data, or wait for more buffer.
+        if len(self._recv_buffer) >= content_len:
+            data = self._recv_buffer.read(content_len)
+
+            print(
+                f'Received a batch of transactions from',
+                self.addr,
+            )
+
+            self.transaction_batch_received = framing.unpack_batch(data)
+            if not self.persistent:
+                self.close()
+
+    @staticmethod
+    def _get_requested_encoding(request_content):
+        """Returns the encoding requested in the content of a db_request, e.g. {"encoding": "gzip"}, None if the
+        client requested none (e.g. an empty content) or one we do not know."""
+
+        try:
+            request = json_tools.json_decode(request_content, "utf-8")
+        except ValueError:
+            return None
+        if isinstance(request, dict) and request.get("encoding") in response_cache.ENCODINGS:
+            return request["encoding"]
+        return None
+
+    def process_request_message(self):
+        """Reads the content of a request message, e.g. the encoding requested for the database or a query. Returns
+        None if we have not yet received it."""
+
+        content_len = self.jsonheader["content-length"]
+
+        # Check if we already have received enough data, or wait for more buffer.
+        if len(self._recv_buffer) >= content_len:
+            data = self._recv_buffer.read(content_len)
+            return data
+        return None
 
 
 class NeighborConnection:
-    """This class is used to process one connection with a neighbor.
-    For now, it can either send or receive the database from a neighbor."""
-    def __init__(self, selector, sock, addr, database_bytes=None):
+    """This class is used to process one connection with a neighbor. The neighbor that opens it sends a first message,
+    usually the announcement of its tip. The two nodes may then exchange several messages, e.g. headers and blocks
+    requests and their responses, until the one that was behind has the blocks it was missing, see
+    fullnode_processing. Each received message is kept in message_received until the node has processed it. As a
+    fallback, a whole database is received in database_received, and the connection is then closed."""
+    def __init__(self, selector, sock, addr, first_message=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
 
         # Here we initalize all the class properties
-        self._recv_buffer = b""  # Used for receiving a database
-        self._send_buffer = b""  # For when we send the database to a neighbor
+        self._recv_buffer = framing.FrameReader()  # Used for receiving the messages of the neighbor
+        self._send_buffer = framing.FrameWriter()  # For when we send messages to the neighbor
 
         self._jsonheader_len = None
         self.jsonheader = None
 
-        self._database_queued = False  # To ensure we started to send the database to a neighbor
+        self.message_received = None  # (content-type, content bytes) of a received message not yet processed
         self.database_received = None  # Filled when we have successfully received a new database from a neighbor
-        self.database_sent = False  # Filled when we have successfully sent a database to a neighbor
+        self.sync_headers = None  # The headers received from the neighbor, whose blocks we have requested
+        self.sync_compact_blocks = None  # (compact blocks, contents rebuilt) waiting for their missing transactions
+        self.peer_address = None  # The (host, listening port) of the neighbor, if it has announced it
+
+        # Measured by the peers manager
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._close_when_sent = False  # True once we have nothing more to tell the neighbor, see finish()
 
         self.is_closed = False  # To indicate that it has consciously been closed
 
-        if database_bytes is not None:  # If we are sending the database
-            self.database_bytes = database_bytes
+        if first_message is not None:  # If we are the one opening the connection
+            self._send_buffer.append(*NeighborConnection._create_message(*first_message))
 
     def _read(self):
         """Internal function called by read() to manage the socket."""
         try:
-            # Should be ready to read
-            data = self.sock.recv(4096)
+            # Should be ready to read. Receives directly in the free space of the buffer
+            nbytes = self._recv_buffer.recv_from(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK), skipping it for now
             # select() will eventually call us again
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
-                raise RuntimeError("Peer closed.")
+            self.bytes_received += nbytes
+            if not nbytes:
+                if self._jsonheader_len is None and not self._recv_buffer:
+                    # The neighbor has nothing more to tell us, between two messages
+                    self.close()
+                else:
+                    raise RuntimeError("Peer closed.")
 
     def _write(self):
         """Internal function called by write() to manage the socket."""
         if self._send_buffer:
             print("Sending...")
             try:
-                # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                # Should be ready to write. Sends from the offset of the queued parts, without copying them
+                self.bytes_sent += self._send_buffer.send_to(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK), skipping it for now
                 # select() will eventually call us again
                 pass
-            else:  # If no errors were raised
-                self._send_buffer = self._send_buffer[sent:]
+
+    def _set_selector_to_read(self):
+        """Set selector to listen for read events once everything has been sent."""
+
+        event = selectors.EVENT_READ
+        self.selector.modify(self.sock, event, data=self)
+
+    def _set_selector_to_read_write(self):
+        """Set selector to listen for both read and write events, when a message has been queued."""
+
+        event = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.selector.modify(self.sock, event, data=self)
 
     @staticmethod
-    def _create_database_message(content_type, content_bytes):
-        """Returns the 3-parts database message, given the content to include, consistent with out application-layer
-        protocol that we have defined for broadcasting messages."""
-
-        jsonheader = {
-            "byteorder": sys.byteorder,  # For the endianness of the OS
-            "content-type": content_type,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = json_tools.json_encode(jsonheader, "utf-8")
-        database_message_fixed_hdr = struct.pack(">H", len(jsonheader_bytes))
-        database_message = database_message_fixed_hdr + jsonheader_bytes + content_bytes
-        return database_message
-
-    def _queue_database(self):
-        """Calls _create_database_message and adds the created message (now in the
-        correct formatting for broadcasting) to the send_buffer. Marks _database_queued as True."""
-
-        database_message = NeighborConnection._create_database_message(content_type="database_content",
-                                                                       content_bytes=self.database_bytes)
-        self._send_buffer += database_message
-        self._database_queued = True
+    def _create_message(content_type, content_bytes):
+        """Returns the 3-parts message, given the content to include, consistent with out application-layer
+        protocol that we have defined for broadcasting messages. The message is returned as the list of its
+        [headers, content] parts, to be queued in the send buffer without concatenating them."""
+        return [framing.create_header(content_type, len(content_bytes)), content_bytes]
+
+    def queue_message(self, content_type, content_bytes):
+        """Adds a message to the send_buffer, called by the fullnode when processing the messages of the
+        neighbor."""
+
+        self._send_buffer.append(*NeighborConnection._create_message(content_type, content_bytes))
+        self._set_selector_to_read_write()
+
+    def finish(self):
+        """Called by the fullnode when it has nothing more to tell the neighbor : the connection is closed once the
+        queued messages are sent. The closing is left to the loop driving the connection (see write()), since the
+        fullnode calls finish() from its processing thread."""
+
+        self._close_when_sent = True
+        self._set_selector_to_read_write()
+
+    def acknowledge_message(self):
+        """Called by the fullnode once it has processed the received message, the next ones can be interpreted."""
+
+        self.message_received = None
+        self._process_received_messages()
 
     def process_events(self, mask):
         """Entry point when the socket is ready for reading or writing."""
-        if mask & selectors.EVENT_READ:  # When receiving a database
+        if mask & selectors.EVENT_READ:
             self.read()
-        if mask & selectors.EVENT_WRITE:  # When sending the database
+        if mask & selectors.EVENT_WRITE and not self.is_closed:
             self.write()
 
     def read(self):
-        """Manages the reading of the neighbor message through the socket, while maintaining the state. In addition,
-        it interprets the different parts of the message."""
+        """Manages the reading of the neighbor messages through the socket, while maintaining the state. In addition,
+        it interprets the different parts of the messages."""
         self._read()
+        self._process_received_messages()
 
-        if self._jsonheader_len is None:
-            self.process_jsonheader_length()  # Triggers once we have received 2 bytes
+    def _process_received_messages(self):
+        """Interprets the messages of the receive buffer, one at a time : the next one is interpreted once the
+        fullnode has processed the previous one, see acknowledge_message()."""
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()  # Triggers once we have received jsonheader_len bytes
+        while not self.is_closed and self.message_received is None:
+            if self._jsonheader_len is None:
+                self.process_jsonheader_length()  # Triggers once we have received 2 bytes
 
-        if self.jsonheader is not None:
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()  # Triggers once we have received jsonheader_len bytes
+
+            if self.jsonheader is None:
+                return  # We wait for more data
 
-            # Making sure we are receiving a database
             if self.jsonheader["content-type"] == "database_content":
                 if self.database_received is None:
                     self.process_database_message()  # Triggers if we have recv'd jsonheader["content-length"] bytes
                     # Closes the socket
+                return
+
+            elif self.jsonheader["content-type"] in SYNC_CONTENT_TYPES:
+                content = self._recv_buffer.read(self.jsonheader["content-length"])
+                if content is None:
+                    return  # We wait for more data
+                self.message_received = (self.jsonheader["content-type"], content)
+
+                # We get ready for the next message
+                self._jsonheader_len = None
+                self.jsonheader = None
+
             else:
                 # Unrecognized content-type.
                 print(f'Unrecognized content-type from : {self.addr}')
@@ -314,17 +538,16 @@ class NeighborConnection:
 
     def write(self):
         """Manages the writing of what is in the sending buffer through the socket, while maintaining the state."""
-        if not self._database_queued:  # We have not yet init the sending process. Ensures that we init only once.
-            self._queue_database()  # Initializes the sending process.
 
         self._write()  # Writes what is in the sending buffer
 
-        if self._database_queued:
-            if not self._send_buffer:  # We started AND finished the sending.
-
-                # We are done sending the database, we can now call flag database_received as true.
-                print("Database transmitted to neighbor.")
-                self.database_sent = True
+        if not self._send_buffer:  # We are done sending what was queued
+            if self._close_when_sent:
+                print("Messages transmitted to neighbor.")
+                self.close()
+            else:
+                # We now wait for the response of the neighbor
+                self._set_selector_to_read()
 
     def close(self):
         """Used for unregistering the selector, closing the socket and deleting
@@ -350,25 +573,22 @@ class NeighborConnection:
             # Delete reference to socket object for garbage collection
             self.is_closed = True
             self.sock = None
+            self._send_buffer.clear()  # Closes the database file if it was not completely sent
 
     def process_jsonheader_length(self):
         """Reads the 2 bytes containing the length of the header."""
 
         fixed_header_length = 2
         if len(self._recv_buffer) >= fixed_header_length:  # Check if we already have received enough data
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:fixed_header_length]
-            )[0]
-            self._recv_buffer = self._recv_buffer[fixed_header_length:]
+            self._jsonheader_len = self._recv_buffer.unpack(">H")[0]
 
     def process_jsonheader(self):
         """Reads the json_header of the actual database message."""
 
         if len(self._recv_buffer) >= self._jsonheader_len:  # Check if we already have received enough data
-            self.jsonheader = json_tools.json_decode(
-                self._recv_buffer[:self._jsonheader_len], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[self._jsonheader_len:]
+            # Decoded straight from the receive buffer
+            with self._recv_buffer.read_view(self._jsonheader_len) as jsonheader_view:
+                self.jsonheader = json_tools.json_decode(jsonheader_view, "utf-8")
             for required_header in (
                 "byteorder",
                 "content-type",  # For the sake of consistency in the application-layer protocol
@@ -384,8 +604,7 @@ class NeighborConnection:
 
         # Check if we already have received enough data, or wait for more buffer.
         if len(self._recv_buffer) >= content_len:
-            data = self._recv_buffer[:content_len]
-            self._recv_buffer = self._recv_buffer[content_len:]
+            data = self._recv_buffer.read(content_len)
 
             print(
                 f'Received a database from neighbor : ',
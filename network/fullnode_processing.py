@@ -1,53 +1,73 @@
-import json, pickle
-from tools import classes, database, fullnode_api, validation
-from network import fullnode_socket_manager as fsm
+import collections, hashlib, json, pickle
+from network import framing, fullnode_workers, json_tools, peer_manager, response_cache
+from tools import block_assembly, chain_index as ci, chain_sync, classes, database, exceptions, fullnode_api, \
+    mempool as mp, validation
 
-# The lists that contain the transactions and databases received and not yet processed - state of the node
-received_transactions_stack = []
+with open('network/config.json') as cfg_file:
+    _cfg = json.load(cfg_file)
+
+# Outcomes of the admission of a transaction. An orphaned transaction may still be accepted once its parents are known
+TRANSACTION_ACCEPTED = "accepted"
+TRANSACTION_ORPHANED = "orphaned"
+TRANSACTION_REJECTED = "rejected"
+
+# The pool of transactions and the list of databases received and not yet processed - state of the node
+mempool = mp.Mempool(max_transactions=_cfg["MempoolInfo"]["max_transactions"],
+                     max_bytes=_cfg["MempoolInfo"]["max_bytes"])
 received_databases_stack = []
 
+# The transactions spending outputs of transactions not yet known, waiting for their parents
+orphan_pool = mp.OrphanPool(max_transactions=_cfg["OrphanPoolInfo"]["max_transactions"],
+                            max_age=_cfg["OrphanPoolInfo"]["max_age_seconds"])
 
-def process(connection, neighbors_selector):
-    """This function takes a connection as input and processes the information it yields. It manages the state of the
-    fullnode. It requires the neighbors selector to instantiate the gossip."""
+# The neighbors we gossip with, and the blocks and transactions already seen
+peers = peer_manager.PeerManager(peers=[tuple(neighbor) for neighbor in _cfg["NeighborsInfo"]["neighbors"]],
+                                 fanout=_cfg["NeighborsInfo"]["fanout"],
+                                 seen_cache_size=_cfg["NeighborsInfo"]["seen_cache_size"],
+                                 max_peers=_cfg["NeighborsInfo"]["max_neighbors"])
 
-    global received_transactions_stack
-    global received_databases_stack
+# The encoded versions of the database sent to the clients, for the current tip
+responses = response_cache.ResponseCache()
 
-    with open('network/config.json') as cfg_file:
-        cfg = json.load(cfg_file)
+# The index of our chain the queries of the clients are answered from, and the version of the database file it was
+# last brought up to date with, see _get_chain_index
+chain_index = ci.ChainIndex()
+_indexed_db_version = None
 
-    neighbor_address = cfg["NeighborsInfo"]["neighbor_address"]
-    neighbor_port = cfg["NeighborsInfo"]["neighbor_port"]
+# Decides when the transactions of the mempool are assembled into a block
+block_assembly_policy = block_assembly.BlockAssemblyPolicy(
+    max_transactions=_cfg["BlockAssemblyInfo"]["max_transactions"],
+    max_bytes=_cfg["BlockAssemblyInfo"]["max_bytes"],
+    max_wait=_cfg["BlockAssemblyInfo"]["max_wait_seconds"])
+
+
+def process(connection, gossip):
+    """This function takes a connection as input and processes the information it yields. It manages the state of the
+    fullnode. It requires the gossip function, called with (content_type, content_bytes, exclude=()), to send a
+    message to the neighbors chosen by the peers manager (except those in exclude)."""
+
+    global received_databases_stack
 
     # ---------- Clients Processing------------------
 
     # Processing received transaction
     if hasattr(connection, "transaction_received"):  # Is it a ClientConnection ?
         if connection.transaction_received is not None:
-            received_transactions_stack.append(pickle.loads(connection.transaction_received))
             print("New transaction received.")
+            status, = _receive_transactions([connection.transaction_received], gossip)
 
-    # ---------- Block Creation ------------------
-    if len(received_transactions_stack) >= 1:  # A block contains 10 transactions
-        print("Creating a new block")
-        # We mine a block
-        new_block = classes.Block(received_transactions_stack)
-
-        # We check if the transactions of the block are valid
-        if validation.validate_block(new_block):
-            print("Block is valid, now mining.")
-            mined_new_block = fullnode_api.mine_block(new_block)
-            fullnode_api.add_block_to_db(mined_new_block)
-            received_transactions_stack = []
-        else:
-            print("Invalid new block, discarding transactions")
-            received_transactions_stack = []
+            # A persistent connection tells the client, and goes on with its next messages
+            connection.acknowledge_transaction(status)
 
-        # We start the broadcasting procedure with the serialized database
-        database_bytes = pickle.dumps(fullnode_api.get_database())
-        fsm.start_gossip(address_tuple=(neighbor_address, neighbor_port),
-                         database_bytes=database_bytes, selector=neighbors_selector)
+        # Processing received batch of transactions, admitted in order so that they may spend from one another
+        if connection.transaction_batch_received is not None:
+            print("New batch of {} transactions received.".format(len(connection.transaction_batch_received)))
+            statuses = _receive_transactions(connection.transaction_batch_received, gossip)
+            connection.acknowledge_transaction_batch(statuses)
+
+        # Answering a query on our chain
+        if connection.query_received is not None:
+            connection.answer_query(*_answer_query(*connection.query_received))
 
     # ---------- Neighbors Processing------------------
 
@@ -57,25 +77,461 @@ def process(connection, neighbors_selector):
         # from None when we have successfully received a database message
         if connection.database_received is not None:
             received_databases_stack.append(pickle.loads(connection.database_received))
+            connection.database_received = None  # Processed only once
             print("New database received from a neighbor.")
 
-    # Checking if a database has been successfully sent
-    if hasattr(connection, "database_sent"):
-        # Every NeighborConnection has a "database_sent" property but it is only True
-        # when we have successfully sent a database message
-        if connection.database_sent:
-            # We now know that the sending process is over, we can close the connection and empty stack
-            connection.close()
-            received_transactions_stack = []
-
     # Consensus : choosing the longest chain
     if len(received_databases_stack) == 1:
-        if len(received_databases_stack[0]) > len(fullnode_api.get_database()):
+        db = fullnode_api.get_database()
+        if len(received_databases_stack[0]) > len(db):
             # The received database replaces our database
             print("Received database is the longest chain, copying.")
-            database.write_to_db(received_databases_stack[0])
+            _replace_chain(db, received_databases_stack[0], chain_sync.get_fork_point(db, received_databases_stack[0]))
+            _announce_tip(gossip, received_databases_stack[0], exclude=[connection.peer_address])
         else:
             print("Received database is not the longest chain, discarding.")
 
         # In any case we empty the stack
-        received_databases_stack = []
\ No newline at end of file
+        received_databases_stack = []
+
+    # Processing the other messages of a neighbor, to synchronize our chains
+    if hasattr(connection, "message_received"):  # Is it a NeighborConnection ?
+        if connection.message_received is not None:
+            if not connection.is_closed:
+                _process_sync_message(connection, gossip)
+            connection.acknowledge_message()
+
+    # ---------- Block Creation ------------------
+
+    assemble_block(gossip)
+
+
+def _get_chain_index():
+    """Returns the index of our chain, brought up to date first if the database has been written since : only the
+    blocks that changed are (un)indexed."""
+    global _indexed_db_version
+
+    db_version = database.get_db_file_version()
+    if db_version != _indexed_db_version:
+        chain_index.update(fullnode_api.get_database())
+        _indexed_db_version = db_version
+    return chain_index
+
+
+def _answer_query(content_type, content):
+    """Returns the (content_type, content_bytes) answer to a query of a client on our chain, from the index of our
+    chain. A lightnode keeping a copy of the chain sends the locator of its copy, and gets the blocks following the
+    last one we have in common only. A lightnode in SPV mode gets the headers only, then the transactions concerning
+    its addresses with their Merkle proofs. The balance, the unspent outputs of an address, a transaction or the tip
+    of our chain are answered in a few bytes."""
+
+    index = _get_chain_index()
+    db = index.blocks
+    query = json_tools.json_decode(content, "utf-8")
+
+    if content_type == "chain_update_request":
+        return "chain_update", pickle.dumps(chain_sync.get_chain_update(db, query["locator"]))
+
+    elif content_type == "header_update_request":
+        return "header_update", pickle.dumps(chain_sync.get_header_update(db, query["locator"]))
+
+    elif content_type == "merkle_proofs_request":
+        return "merkle_proofs", pickle.dumps(chain_sync.get_merkle_proofs(db, query["addresses"],
+                                                                          query["from_height"], query["to_height"]))
+
+    elif content_type == "get_balance":
+        answer = {"address": query["address"], "balance": index.get_balance(query["address"]),
+                  "height": len(index) - 1}
+        return "balance", json_tools.json_encode(answer, "utf-8")
+
+    elif content_type == "get_utxos":
+        utxos = [[tx_hash, pos, amount] for (tx_hash, pos), amount
+                 in index.get_unspent_outputs(query["address"]).items()]
+        answer = {"address": query["address"], "utxos": utxos, "height": len(index) - 1}
+        return "utxos", json_tools.json_encode(answer, "utf-8")
+
+    elif content_type == "get_tx":
+        # The height of its block, None if it is in our mempool only
+        height, t = index.get_transaction(query["txhash"]) or (None, mempool.get(query["txhash"]))
+        return "transaction", pickle.dumps({"transaction": t, "height": height})
+
+    elif content_type == "get_tip":
+        answer = {"height": len(index) - 1, "hash": index.block_hashes[-1]}
+        return "tip", json_tools.json_encode(answer, "utf-8")
+
+
+def _process_sync_message(connection, gossip):
+    """Answers a message of the header-first synchronization of chains. The neighbor that mined or received a new
+    block announces its tip. If it is ahead of us, we send it a locator of our chain, it sends back the headers
+    following our last block in common, we check them and request the corresponding blocks only. These come as
+    compact blocks, i.e. headers and short IDs of transactions, rebuilt from our mempool : only the transactions we
+    miss are requested. If our chains have nothing in common, the whole database is sent instead. Once we have a new
+    chain, we announce it in turn. Neighbors also relay the transactions they accept."""
+
+    content_type, content = connection.message_received
+
+    if content_type == "transaction_batch":
+        # Relayed by a neighbor, so that our mempool holds them when they are included in a block
+        _receive_transactions(framing.unpack_batch(content), gossip)
+        connection.finish()
+        return
+
+    if content_type == "tip_announcement":
+        announcement = json_tools.json_decode(content, "utf-8")
+        if "port" in announcement:
+            # The neighbor tells us where it listens, so that we can gossip with it as well
+            connection.peer_address = (connection.addr[0], announcement["port"])
+            peers.add_peer(connection.peer_address)
+
+        if peers.is_seen(announcement["tip_hash"]):
+            # We already have this chain, or are getting it from another neighbor : no need to read our database
+            connection.finish()
+            return
+
+    db = fullnode_api.get_database()
+
+    if content_type == "tip_announcement":
+        if chain_sync.is_better_chain(announcement["length"], announcement["tip_hash"], db):
+            print("Neighbor announced a better chain, requesting its headers.")
+            _request_headers(connection, db)
+        else:
+            connection.finish()
+
+    elif content_type == "headers_request":
+        fork_height = chain_sync.find_fork_point(db, json_tools.json_decode(content, "utf-8")["locator"])
+        if fork_height is None:
+            # Bootstrap fallback : the neighbor cannot know any of our blocks. The database is streamed from its file,
+            # as to the clients
+            connection.queue_message("database_content", framing.FilePart(*database.open_db_file()))
+            connection.finish()
+        else:
+            connection.queue_message("headers", pickle.dumps(chain_sync.get_headers(db, fork_height)))
+
+    elif content_type == "headers":
+        headers = pickle.loads(content)
+        try:
+            fork_height = chain_sync.check_headers(db, headers)
+        except exceptions.ValidationError:
+            print("Invalid headers received from neighbor, discarding.")
+            connection.finish()
+            return
+
+        if chain_sync.is_better_chain(fork_height + 1 + len(headers), validation.get_header_hash(headers[-1]), db):
+            connection.sync_headers = headers
+            _request_blocks(connection, compact=True)
+        else:
+            connection.finish()
+
+    elif content_type == "blocks_request":
+        request = json_tools.json_decode(content, "utf-8")
+        if request.get("compact"):
+            connection.queue_message("compact_blocks",
+                                     pickle.dumps(chain_sync.get_compact_blocks(db, request["hashes"])))
+        else:
+            connection.queue_message("blocks", pickle.dumps(chain_sync.get_blocks(db, request["hashes"])))
+
+    elif content_type == "compact_blocks":
+        compact_blocks = pickle.loads(content)
+        headers = connection.sync_headers
+        if headers is None or [compact_block["header"] for compact_block in compact_blocks] != headers:
+            print("Invalid compact blocks received from neighbor, discarding.")
+            connection.sync_headers = None
+            connection.finish()
+            return
+
+        # Most transactions of the blocks are usually in our mempool already
+        known_transactions = {chain_sync.get_short_id(t.txhash): t for t in mempool.get_transactions()}
+        contents, missing = chain_sync.rebuild_block_contents(compact_blocks, known_transactions)
+        if missing:
+            connection.sync_compact_blocks = (compact_blocks, contents)
+            connection.queue_message("block_transactions_request",
+                                     json_tools.json_encode({"missing": missing}, "utf-8"))
+        else:
+            _receive_blocks(connection, gossip, db, chain_sync.fill_compact_blocks(compact_blocks, contents, {}),
+                            compact=True)
+
+    elif content_type == "block_transactions_request":
+        missing = json_tools.json_decode(content, "utf-8")["missing"]
+        connection.queue_message("block_transactions", pickle.dumps(chain_sync.get_block_transactions(db, missing)))
+
+    elif content_type == "block_transactions":
+        if connection.sync_compact_blocks is None:
+            print("Transactions received without requesting them, discarding.")
+            connection.finish()
+            return
+        compact_blocks, contents = connection.sync_compact_blocks
+        connection.sync_compact_blocks = None
+        try:
+            blocks = chain_sync.fill_compact_blocks(compact_blocks, contents, pickle.loads(content))
+        except exceptions.ValidationError:
+            blocks = None
+        _receive_blocks(connection, gossip, db, blocks, compact=True)
+
+    elif content_type == "blocks":
+        _receive_blocks(connection, gossip, db, pickle.loads(content))
+
+
+def _receive_blocks(connection, gossip, db, blocks, compact=False):
+    """Checks the blocks received from a neighbor against the headers it sent, and adopts them if they make the
+    longest chain. If blocks rebuilt from compact blocks do not match, e.g. because a short ID matched another
+    transaction of our mempool, the full blocks are requested instead."""
+
+    headers = connection.sync_headers
+    connection.sync_headers = None
+    try:
+        if headers is None:
+            raise exceptions.ValidationError("Blocks received without requesting them.")
+        if blocks is None:
+            raise exceptions.ValidationError("Blocks could not be rebuilt from compact blocks.")
+        chain_sync.check_blocks(blocks, headers)
+        # Our chain may have changed since the headers were checked
+        fork_height = chain_sync.check_headers(db, headers)
+    except exceptions.ValidationError:
+        if compact and headers is not None:
+            print("Could not rebuild the blocks from compact blocks, requesting full blocks.")
+            connection.sync_headers = headers
+            _request_blocks(connection, compact=False)
+        else:
+            print("Invalid blocks received from neighbor, discarding.")
+            connection.finish()
+        return
+
+    new_db = db[:fork_height + 1] + blocks
+    if chain_sync.is_better_chain(len(new_db), validation.get_block_hash(new_db[-1]), db):
+        print("Received blocks make the best chain, copying.")
+        _replace_chain(db, new_db, fork_height)
+        _announce_tip(gossip, new_db, exclude=[connection.peer_address])
+
+    if len(headers) == chain_sync.MAX_HEADERS:
+        _request_headers(connection, new_db)  # The neighbor may have more headers
+    else:
+        connection.finish()
+
+
+def _request_blocks(connection, compact):
+    block_hashes = [validation.get_header_hash(header) for header in connection.sync_headers]
+    connection.queue_message("blocks_request",
+                             json_tools.json_encode({"hashes": block_hashes, "compact": compact}, "utf-8"))
+
+
+def _request_headers(connection, db):
+    locator = chain_sync.get_locator(db)
+    connection.queue_message("headers_request", json_tools.json_encode({"locator": locator}, "utf-8"))
+
+
+def _announce_tip(gossip, db, exclude=()):
+    """Announces the tip of our chain to our neighbors, except those in exclude. The neighbors then request what they
+    miss."""
+
+    tip_hash = validation.get_block_hash(db[-1])
+    peers.mark_seen(tip_hash)  # So that the announcement coming back is dropped
+    announcement = {"length": len(db), "tip_hash": tip_hash, "port": _cfg["FullnodeInfo"]["neighbors_listening_port"]}
+    gossip(content_type="tip_announcement", content_bytes=json_tools.json_encode(announcement, "utf-8"),
+           exclude=[address_tuple for address_tuple in exclude if address_tuple is not None])
+
+
+def _replace_chain(db, new_db, fork_height):
+    """Replaces our chain by a longer one, whose blocks after fork_height are not in our chain."""
+
+    with fullnode_workers.storage.measure(len(new_db) - fork_height - 1):
+        database.write_to_db(new_db)
+    responses.set_tip(validation.get_block_hash(new_db[-1]))
+
+    if fork_height < len(db) - 1:
+        # Some of our blocks are abandoned, the outputs spent by the validated transactions may not exist anymore
+        validation.clear_validation_cache()
+
+    # The transactions confirmed by the new blocks leave the pool, and their orphans can be admitted
+    for b in new_db[fork_height + 1:]:
+        mempool.remove_confirmed(b)
+        _release_orphans(b.block_content)
+
+
+def _receive_transactions(transactions_bytes, gossip):
+    """Admits the serialized transactions received from a client or relayed by a neighbor, in order, and returns
+    the list of their statuses. The newly accepted transactions are relayed to the neighbors in one batch, so that
+    they can rebuild the blocks including them from compact blocks. A transaction seen again is answered without
+    being deserialized, unless it was rejected since it may be valid by now. The signatures, the costliest check,
+    are verified all at once by the admission workers, before the transactions are admitted one by one."""
+
+    transaction_ids = [hashlib.sha256(transaction_bytes).hexdigest() for transaction_bytes in transactions_bytes]
+    statuses = {}  # transaction id -> status
+    transactions_to_admit = {}  # transaction id -> serialized transaction, in order
+    for transaction_id, transaction_bytes in zip(transaction_ids, transactions_bytes):
+        if transaction_id in statuses or transaction_id in transactions_to_admit:
+            continue  # Sent twice in the batch, answered with the status of the first one
+        status = peers.mark_seen(transaction_id, TRANSACTION_REJECTED)
+        if status is None or status == TRANSACTION_REJECTED:
+            transactions_to_admit[transaction_id] = transaction_bytes
+        else:
+            statuses[transaction_id] = status
+
+    accepted_transactions_bytes = []
+    with fullnode_workers.admission.measure(len(transactions_to_admit)):
+        transactions = [pickle.loads(transaction_bytes) for transaction_bytes in transactions_to_admit.values()]
+        valid_signatures = fullnode_workers.verify_signatures(transactions) if transactions else []
+
+        for (transaction_id, transaction_bytes), transaction, valid_signature in zip(transactions_to_admit.items(),
+                                                                                     transactions, valid_signatures):
+            if valid_signature:
+                status = admit_transaction(transaction, size=len(transaction_bytes), signature_checked=True)
+            else:
+                print("Transaction with hash {} rejected.".format(transaction.txhash))
+                status = TRANSACTION_REJECTED
+            peers.update_seen(transaction_id, status)
+            statuses[transaction_id] = status
+            if status == TRANSACTION_ACCEPTED:
+                accepted_transactions_bytes.append(transaction_bytes)
+
+    if accepted_transactions_bytes:
+        gossip(content_type="transaction_batch", content_bytes=framing.pack_batch(accepted_transactions_bytes))
+    return [statuses[transaction_id] for transaction_id in transaction_ids]
+
+
+def admit_transaction(transaction, size=None, signature_checked=False):
+    """Validates a transaction received from a client and admits it in the mempool. Invalid transactions are rejected
+    right away instead of invalidating a whole block later on. Transactions spending outputs of unknown transactions
+    are held in the orphan pool until their parents arrive. The signature is not verified again if
+    signature_checked, e.g. by the admission workers. Returns TRANSACTION_ACCEPTED, TRANSACTION_ORPHANED or
+    TRANSACTION_REJECTED."""
+
+    status = _admit(transaction, size=size, signature_checked=signature_checked)
+    if status == TRANSACTION_ACCEPTED:
+        # The orphans waiting for this transaction can now be admitted as well
+        _release_orphans([transaction])
+    return status
+
+
+def _admit(transaction, size=None, signature_checked=False):
+    """Admission of a single transaction, without releasing its orphans, see admit_transaction."""
+
+    if size is None:
+        size = len(pickle.dumps(transaction))
+
+    try:
+        # Duplicates and double-spends of the pool are rejected first, since it is cheap, see MempoolError
+        mempool.check(transaction)
+
+        # A transaction that cannot fit in any block would stay in the pool forever
+        if not block_assembly_policy.fits_in_block(size):
+            raise exceptions.MempoolError("Transaction with hash {} is larger than a block."
+                                          .format(transaction.txhash))
+
+        # A transaction may spend the outputs of a transaction of the mempool, but not of an unknown one
+        missing_parents = validation.get_missing_parents(transaction, unconfirmed_transactions=mempool)
+        if missing_parents:
+            if transaction.txhash not in orphan_pool:
+                orphan_pool.add(transaction, missing_parents, size=size)
+                print("Transaction with hash {} held until its parents are known.".format(transaction.txhash))
+            return TRANSACTION_ORPHANED
+
+        # Then hash, signature, ownership and balance against the chain. The result is kept for block assembly
+        validation.validate_transaction(transaction, unconfirmed_transactions=mempool,
+                                        signature_checked=signature_checked)
+
+        evicted_transactions = mempool.add(transaction, size=size)
+    except (exceptions.MempoolError, exceptions.ValidationError, exceptions.APIError):
+        print("Transaction with hash {} rejected.".format(transaction.txhash))
+        return TRANSACTION_REJECTED
+
+    for t in evicted_transactions:
+        validation.forget_transaction(t.txhash)
+    if evicted_transactions:
+        print("Mempool full, evicted {} transaction(s).".format(len(evicted_transactions)))
+
+    return TRANSACTION_ACCEPTED
+
+
+def _release_orphans(transactions):
+    """Submits again for admission the orphans waiting for the given (admitted or confirmed) transactions, and in
+    turn the orphans waiting for the admitted ones. A queue is used instead of recursion, since a chain of orphans
+    may be arbitrarily long."""
+
+    transactions_to_release = collections.deque(transactions)
+    while transactions_to_release:
+        t = transactions_to_release.popleft()
+        for orphan, size in orphan_pool.release(t.txhash):
+            if _admit(orphan, size=size) == TRANSACTION_ACCEPTED:
+                transactions_to_release.append(orphan)
+
+
+def _discard_invalid_transactions(transactions):
+    """Validates again, one by one, the transactions selected for a block, against the current chain and the
+    transactions kept before them. The invalid ones leave the mempool with their descendants. Returns the list of
+    the valid transactions, in the same order."""
+
+    valid_transactions = {}  # txhash -> transaction, so that a transaction may spend from one kept before it
+    for t in transactions:
+        if t.txhash not in mempool:
+            continue  # Already discarded as the descendant of an invalid transaction
+        try:
+            validation.validate_transaction(t, unconfirmed_transactions=valid_transactions)
+        except (exceptions.ValidationError, exceptions.APIError):
+            print("Transaction with hash {} is not valid anymore, discarding it.".format(t.txhash))
+            for removed_transaction in mempool.remove_with_descendants(t.txhash):
+                validation.forget_transaction(removed_transaction.txhash)
+        else:
+            valid_transactions[t.txhash] = t
+
+    return list(valid_transactions.values())
+
+
+def assemble_block(gossip):
+    """Creates, validates, mines and gossips a new block when the block assembly policy says so. Called after each
+    processed connection and periodically by the main loop, so that the maximum waiting time is also honored when
+    no transaction arrives. It requires the gossip function to instantiate the gossip."""
+
+    # The orphans whose parents never arrived are dropped
+    orphan_pool.expire()
+
+    if not block_assembly_policy.is_ready(mempool):
+        return
+
+    selected_transactions = block_assembly_policy.select_transactions(mempool)
+    if not selected_transactions:
+        return  # An empty block would only be mined and gossiped for nothing
+
+    print("Creating a new block")
+    # We mine a block
+    new_block = classes.Block(selected_transactions)
+
+    # We check if the transactions of the block are valid
+    block_is_valid = _validate_new_block(new_block)
+
+    if not block_is_valid:
+        # The chain may have changed since admission : only the transactions that became invalid are discarded
+        print("Invalid new block, discarding its invalid transactions")
+        selected_transactions = _discard_invalid_transactions(selected_transactions)
+        if not selected_transactions:
+            return
+
+        new_block = classes.Block(selected_transactions)
+        block_is_valid = _validate_new_block(new_block)
+
+    if block_is_valid:
+        print("Block is valid, now mining.")
+        # In a mining worker : the event loop keeps serving the connections in the meantime
+        mined_new_block = fullnode_workers.mine_block(new_block)
+        with fullnode_workers.storage.measure():
+            fullnode_api.add_block_to_db(mined_new_block)
+        responses.set_tip(validation.get_block_hash(mined_new_block))
+        for t in mempool.remove_confirmed(mined_new_block):
+            validation.forget_transaction(t.txhash)
+        _release_orphans(mined_new_block.block_content)
+    else:
+        print("Invalid new block, discarding transactions")
+        for t in new_block.block_content:
+            for removed_transaction in mempool.remove_with_descendants(t.txhash):
+                validation.forget_transaction(removed_transaction.txhash)
+
+    # We announce our new tip, the neighbors then request what they miss
+    _announce_tip(gossip, fullnode_api.get_database())
+
+
+def _validate_new_block(block):
+    """Returns True if the transactions of the block are valid, False otherwise."""
+    with fullnode_workers.validation.measure():
+        try:
+            return validation.validate_block(block)
+        except (exceptions.ValidationError, exceptions.APIError):
+            return False
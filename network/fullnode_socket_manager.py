@@ -1,39 +1,356 @@
-from network import fullnode_connections
-import socket
+from network import framing, fullnode_connections, fullnode_processing, response_cache
+from tools import database
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
 import selectors
+import time
+import traceback
+
+# Caps on the number of connections, watermarks of the send buffers and timeouts, see _drive
+with open('network/config.json') as cfg_file:
+    _limits = json.load(cfg_file)["ConnectionLimits"]
+
+# Counters of the connections, see get_stats, and current number of connections of each kind
+counters = collections.Counter()
+_active_connections = {"client": 0, "neighbor": 0}
 
 # --------- WRAPPERS FUNCTIONS TO MANAGE SOCKETS -----------------
 
+# The state of the node is only modified by this single worker thread, one connection after the other. Processing
+# thus never blocks the event loop, which keeps serving the sockets in the meantime. The CPU-bound stages (signatures
+# at admission, mining) run in worker processes, so that they do not hold the GIL either, see fullnode_workers.
+_processing_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="processing")
+
+# The database requested in an encoding (e.g. compressed) is encoded by this thread, once per tip, see
+# response_cache. (tip hash, encoding) -> future of the encoding in progress
+_encoding_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="encoding")
+_pending_encodings = {}
+
+
+class StreamSocket:
+    """This class exposes an asyncio stream with the socket and selector methods used by the connection classes of
+    fullnode_connections, so that they can be driven by the event loop without any change to their framing. The
+    same object is given to a connection as its socket and as its selector. Its methods may also be called from the
+    processing thread, e.g. when processing closes a connection : the stream itself is only touched on the loop."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._loop = asyncio.get_running_loop()
+        self.events = selectors.EVENT_READ  # What the connection is currently waiting for
+
+        self._pending_data = bytearray()  # Read from the stream but not yet recv'd by the connection
+        self._eof = False
+
+        # Once more than the high watermark is buffered for sending, drain() waits until it is back under the low one
+        writer.transport.set_write_buffer_limits(high=_limits["send_buffer_high_watermark"],
+                                                 low=_limits["send_buffer_low_watermark"])
+
+    # ------ Socket side, used by the connection ------
+
+    def recv(self, bufsize):
+        if self._pending_data:
+            data = bytes(self._pending_data[:bufsize])
+            del self._pending_data[:bufsize]
+            return data
+        if self._eof:
+            return b""
+        raise BlockingIOError
+
+    def recv_into(self, buffer, nbytes=0):
+        if self._pending_data:
+            nbytes = min(nbytes or len(buffer), len(self._pending_data))
+            with memoryview(self._pending_data) as pending_view:
+                buffer[:nbytes] = pending_view[:nbytes]
+            del self._pending_data[:nbytes]
+            return nbytes
+        if self._eof:
+            return 0
+        raise BlockingIOError
+
+    def send(self, data):
+        self.writer.write(data)  # Buffered by the transport, see drain()
+        return len(data)
+
+    def sendmsg(self, buffers):
+        self.writer.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    def send_file(self, file, offset, count):
+        """Sends up to count bytes of the file from offset, see framing.FilePart. They go straight from the file to
+        the socket with os.sendfile while the transport has nothing buffered. Otherwise, or once the socket would
+        block, one chunk is read and given to the transport, which sends it when the socket is ready : drain() waits
+        for it, so that at most one chunk per connection is in memory."""
+
+        sock = self.writer.get_extra_info("socket")
+        if hasattr(os, "sendfile") and sock is not None and self.writer.transport.get_write_buffer_size() == 0:
+            try:
+                return os.sendfile(sock.fileno(), file.fileno(), offset, count)
+            except BlockingIOError:
+                pass
+
+        file.seek(offset)
+        chunk = file.read(min(count, framing.FILE_CHUNK_SIZE))
+        self.writer.write(chunk)
+        return len(chunk)
+
+    def close(self):
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:  # No running loop in this thread
+            on_loop = False
+        if on_loop:
+            self.writer.close()
+        else:
+            self._loop.call_soon_threadsafe(self.writer.close)
+
+    # ------ Selector side, used by the connection ------
+
+    def register(self, fileobj, events, data=None):
+        self.events = events
+
+    def modify(self, fileobj, events, data=None):
+        self.events = events
+
+    def unregister(self, fileobj):
+        self.events = 0
+
+    # ------ Event loop side ------
+
+    def has_pending_data(self):
+        return bool(self._pending_data) or self._eof
+
+    async def fill(self):
+        """Waits until data (or the end of the stream) is available for recv()."""
+        data = await self.reader.read(65536)
+        if data:
+            self._pending_data += data
+        else:
+            self._eof = True
+
+    async def drain(self):
+        if not self.writer.is_closing():
+            await self.writer.drain()
+
+
+async def _drive(connection, stream, gossip):
+    """Feeds the events of the stream to the connection until it is closed, in the manner of the former selector
+    loop. Once the connection has received a complete message, the node processes it in the processing executor.
+    Returns False if the connection has been dropped, because the peer stayed idle or did not read what we send for
+    too long, True otherwise."""
+
+    while not connection.is_closed:
+        if stream.events & selectors.EVENT_WRITE:
+            mask = selectors.EVENT_WRITE
+        elif stream.events & selectors.EVENT_READ:
+            if not stream.has_pending_data():
+                try:
+                    await asyncio.wait_for(stream.fill(), _limits["idle_timeout_seconds"])
+                except asyncio.TimeoutError:
+                    counters["idle_timeouts"] += 1
+                    print("Closing idle connection", connection.addr)
+                    connection.close()
+                    return False
+            mask = selectors.EVENT_READ
+        else:
+            break
 
-def accept_client_connection(sock, selector):
-    conn, address_tuple = sock.accept()  # We spawn a new socket through which the client connection will happen
+        # Process_events is the entry point
+        connection.process_events(mask)
+        try:
+            # Above the high watermark of the send buffer, we neither read nor send more until the peer has caught up
+            await asyncio.wait_for(stream.drain(), _limits["slow_consumer_timeout_seconds"])
+        except asyncio.TimeoutError:
+            counters["slow_consumers_dropped"] += 1
+            print("Dropping slow connection", connection.addr)
+            connection.close()
+            return False
+
+        # The fullnode processes the received data. Answering a request of a persistent connection may reveal the
+        # next one, already in the receive buffer
+        while True:
+            if getattr(connection, "transaction_received", None) is not None \
+                    or getattr(connection, "transaction_batch_received", None) is not None \
+                    or getattr(connection, "query_received", None) is not None \
+                    or getattr(connection, "database_received", None) is not None \
+                    or getattr(connection, "message_received", None) is not None:
+                # Also once a one-shot connection has been closed after receiving its transaction
+                await run_processing(fullnode_processing.process, connection, gossip)
+            elif getattr(connection, "database_requested", False) and not connection.is_closed:
+                if connection.database_encoding is None:
+                    # The database file is streamed as is : neither read nor serialized on the event loop, nor waiting
+                    # for the processing of the node. Database writes are atomic, see database.open_db_file
+                    connection.queue_database(framing.FilePart(*database.open_db_file()))
+                else:
+                    connection.queue_database(await _get_encoded_database(connection.database_encoding),
+                                              content_encoding=connection.database_encoding)
+            else:
+                break
+
+    return True
+
+
+def _take_connection_slot(kind):
+    """Returns True if one more connection of the kind ("client" or "neighbor") is allowed, and counts it in. Counts
+    the refusal and returns False otherwise. The slot is given back with _release_connection_slot."""
+
+    if _active_connections[kind] >= _limits[f"max_{kind}_connections"]:
+        counters[f"{kind}_connections_refused"] += 1
+        return False
+    _active_connections[kind] += 1
+    counters[f"{kind}_connections_accepted"] += 1
+    return True
+
+
+def _release_connection_slot(kind):
+    _active_connections[kind] -= 1
+
+
+def get_stats():
+    """Returns the counters of the connections of the node, e.g. to see when its limits are hit, along with the
+    current number of connections of each kind."""
+    stats = dict(counters)
+    stats.update({f"active_{kind}_connections": nb for kind, nb in _active_connections.items()})
+    return stats
+
+
+async def _get_encoded_database(encoding):
+    """Returns the database in the given encoding, from the responses cache of the node. On a miss, it is encoded in
+    the encoding executor, once for all the clients requesting it meanwhile."""
+
+    tip_hash = fullnode_processing.responses.get_tip()
+    content = fullnode_processing.responses.get(tip_hash, encoding)
+    if content is not None:
+        return content
+
+    key = (tip_hash, encoding)
+    if key not in _pending_encodings:
+        loop = asyncio.get_running_loop()
+        _pending_encodings[key] = loop.run_in_executor(_encoding_executor, response_cache.encode_database,
+                                                       database.open_db_file()[0], encoding)
+    try:
+        content = await asyncio.shield(_pending_encodings[key])
+    finally:
+        _pending_encodings.pop(key, None)
+    fullnode_processing.responses.put(tip_hash, encoding, content)
+    return content
+
+
+async def serve_client(reader, writer, gossip):
+    # Used for every new client connection on the clients listening socket
+    address_tuple = writer.get_extra_info("peername")
+    if not _take_connection_slot("client"):
+        print("Too many clients, refusing : ", address_tuple)
+        writer.close()
+        return
     print("Client connected on : ", address_tuple)
-    conn.setblocking(False)
-    # We instantiate a new ClientConnection
-    c_conn = fullnode_connections.ClientConnection(selector, conn, address_tuple)
-    selector.register(conn, selectors.EVENT_READ, data=c_conn)  # We start by registering the socket in read mode
+    stream = StreamSocket(reader, writer)
 
+    # We instantiate a new ClientConnection, which starts in read mode
+    c_conn = fullnode_connections.ClientConnection(stream, stream, address_tuple)
+    try:
+        await _drive(c_conn, stream, gossip)
+    except Exception:
+        print(
+            "main: error: exception for",
+            f"{c_conn.addr}:\n{traceback.format_exc()}",
+        )
+        # It is possible that fullnode_processing encounters an exception on an already closed connection
+        if not c_conn.is_closed:
+            c_conn.close()
+    finally:
+        _release_connection_slot("client")
 
-def accept_gossip(sock, selector):
+
+async def serve_neighbor(reader, writer, gossip):
     # Used for receiving the database from a neighbor
-    conn, address_tuple = sock.accept()  # We spawn a new socket through which the neighbor connection will happen
+    address_tuple = writer.get_extra_info("peername")
+    if not _take_connection_slot("neighbor"):
+        print("Too many neighbors, refusing : ", address_tuple)
+        writer.close()
+        return
     print("Neighbor gossipping : ", address_tuple)
-    conn.setblocking(False)
+    stream = StreamSocket(reader, writer)
+
+    # We instantiate a new NeighborConnection, without first message : the neighbor speaks first
+    n_conn = fullnode_connections.NeighborConnection(stream, stream, address_tuple)
+    try:
+        await _drive(n_conn, stream, gossip)
+    except Exception:
+        print(
+            "main: error: exception for",
+            f"{n_conn.addr}:\n{traceback.format_exc()}",
+        )
+        print("Lost gossipping connection to neighbor !")
+        if not n_conn.is_closed:
+            n_conn.close()
+    finally:
+        _release_connection_slot("neighbor")
 
-    # We instantiate a new NeighborConnection, but without database_bytes, = receiving mode
-    # We only want to monitor read events
-    n_conn = fullnode_connections.NeighborConnection(selector, conn, address_tuple)
-    selector.register(conn, selectors.EVENT_READ, data=n_conn)  # We start by registering the socket in read mode
 
+async def start_gossip(address_tuple, content_type, content_bytes, gossip):
+    # Used for starting a conversation with a neighbor, e.g. to announce our tip
+    if not _take_connection_slot("neighbor"):
+        print("Too many neighbors, not gossipping to", address_tuple)
+        return
+    try:
+        await _gossip(address_tuple, content_type, content_bytes, gossip)
+    finally:
+        _release_connection_slot("neighbor")
 
-def start_gossip(address_tuple, database_bytes, selector):
-    # Used for sending the database to a neighbor
+
+async def _gossip(address_tuple, content_type, content_bytes, gossip):
     print("Starting gossip to", address_tuple)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setblocking(False)
-    sock.connect_ex(address_tuple)
-    # We instantiate a new NeighborConnection, this time with database_bytes, = sending mode
-    # We only want to monitor write events
-    database_message = fullnode_connections.NeighborConnection(selector, sock, address_tuple,
-                                                               database_bytes=database_bytes)
-    selector.register(sock, selectors.EVENT_WRITE, data=database_message)
+    start = time.monotonic()
+    try:
+        reader, writer = await asyncio.open_connection(*address_tuple)
+    except OSError as e:
+        print(f"Cannot gossip to {address_tuple}: {repr(e)}")
+        fullnode_processing.peers.record_failure(address_tuple)
+        return
+    latency = time.monotonic() - start  # The time to connect, close to a round-trip
+
+    stream = StreamSocket(reader, writer)
+    stream.events = selectors.EVENT_WRITE  # We start by sending the first message
+
+    # We instantiate a new NeighborConnection, this time with a first message to send
+    n_conn = fullnode_connections.NeighborConnection(stream, stream, address_tuple,
+                                                     first_message=(content_type, content_bytes))
+    try:
+        completed = await _drive(n_conn, stream, gossip)
+    except Exception:
+        print(
+            "main: error: exception for",
+            f"{n_conn.addr}:\n{traceback.format_exc()}",
+        )
+        print("Lost gossipping connection to neighbor !")
+        fullnode_processing.peers.record_failure(address_tuple)
+        if not n_conn.is_closed:
+            n_conn.close()
+    else:
+        if completed:
+            fullnode_processing.peers.record_transfer(address_tuple, latency,
+                                                      nbytes=n_conn.bytes_sent + n_conn.bytes_received,
+                                                      duration=time.monotonic() - start)
+        else:
+            fullnode_processing.peers.record_failure(address_tuple)  # Too slow
+
+
+def threadsafe_gossip(loop):
+    """Returns the gossip function given to fullnode_processing : it sends a message to the neighbors chosen by the
+    peers manager, except those in exclude. It can be called from the processing executor and starts the gossip on
+    the event loop."""
+
+    def gossip(content_type, content_bytes, exclude=()):
+        for address_tuple in fullnode_processing.peers.select_peers(exclude=exclude):
+            asyncio.run_coroutine_threadsafe(start_gossip(address_tuple, content_type, content_bytes, gossip), loop)
+
+    return gossip
+
+
+async def run_processing(function, *args):
+    """Runs a function of fullnode_processing in the processing executor, after the pending ones."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_processing_executor, function, *args)
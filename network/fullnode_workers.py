@@ -0,0 +1,128 @@
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from tools import crypto, fullnode_api
+
+# Number of worker processes of each stage, see Stage
+with open('network/config.json') as cfg_file:
+    _cfg = json.load(cfg_file)["WorkersInfo"]
+
+
+class Stage:
+    """This class is a stage of the pipeline of the full node : the admission of transactions, the validation of
+    blocks, mining or storage. It counts the items it processed and the time it spent on them, so that its
+    throughput can be measured on its own, see get_stats. A stage given workers runs its CPU-bound work in worker
+    processes, fed through the queues of a process pool : the work then no longer holds the GIL needed by the event
+    loop (network I/O) and by the processing thread (the state of the node), which keep running in the meantime.
+    Used both by the processing thread and by the event loop (for the stats), hence the lock."""
+
+    def __init__(self, name, workers=0):
+        self.name = name
+        self.workers = workers
+        self._executor = None  # Started by start(), or on first use
+        self._lock = threading.Lock()
+        self.items = 0
+        self.busy_time = 0.0
+
+    def start(self):
+        """Starts the worker processes. They are forked, so that they inherit the modules already set up (e.g. the
+        path of the database) : the node starts them before starting any thread."""
+
+        with self._lock:
+            if not self.workers or self._executor is not None:
+                return
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("fork"),
+                initializer=_watch_parent, initargs=(os.getpid(),))
+        self._executor.submit(int).result()  # The processes are forked on the first submission
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def map(self, function, *iterables):
+        """Runs the function on each item of the iterables and returns the list of the results, in the same order.
+        The items are shared between the worker processes of the stage, if it has any. The time is counted by the
+        caller, see measure."""
+
+        if not self.workers:
+            return list(map(function, *iterables))
+        self.start()
+        return list(self._executor.map(function, *iterables))
+
+    def run(self, function, *args):
+        """Runs the function on one item, see map."""
+        return self.map(function, *[[arg] for arg in args])[0]
+
+    @contextlib.contextmanager
+    def measure(self, items=1):
+        """Counts the time spent in the with block, by the stage, on the given number of items."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.items += items
+                self.busy_time += time.perf_counter() - start
+
+    def get_stats(self):
+        """Returns the number of items processed, the time spent and the resulting throughput in items per second."""
+        with self._lock:
+            return {
+                "items": self.items,
+                "busy_seconds": round(self.busy_time, 3),
+                "items_per_second": round(self.items / self.busy_time, 1) if self.busy_time else None
+            }
+
+
+# The stages of the pipeline. Admission and mining have worker processes; validation and storage read and write the
+# chain, part of the state of the node, hence run in the processing thread
+admission = Stage("admission", workers=_cfg["admission_workers"])
+validation = Stage("validation")
+mining = Stage("mining", workers=_cfg["mining_workers"])
+storage = Stage("storage")
+stages = (admission, validation, mining, storage)
+
+
+def _watch_parent(parent_pid):
+    """Run by each worker process when it starts : it exits once the node is gone, e.g. killed, instead of waiting
+    for work forever."""
+
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def start():
+    """Starts the worker processes of all the stages, see Stage.start."""
+    for stage in stages:
+        stage.start()
+
+
+def get_stats():
+    """Returns the stats of each stage, see Stage.get_stats."""
+    return {stage.name: stage.get_stats() for stage in stages}
+
+
+def verify_signatures(transactions):
+    """Returns, for each transaction, whether its signature is valid [check 2 of validation], verified by the
+    admission workers. Only the signed hash, the signature and the verifying key are sent to them. The time is counted
+    as part of the admission, by the caller."""
+    return admission.map(crypto.verify_signing, [t.txhash for t in transactions], [t.signature for t in transactions],
+                         [t.verifying_key for t in transactions])
+
+
+def mine_block(block):
+    """Returns a mined copy of the block following the last block of the chain, mined by a mining worker."""
+    with mining.measure():
+        return mining.run(fullnode_api.mine_block, block, fullnode_api.get_last_block())
@@ -1,112 +1,437 @@
-from network import lightnode_connections
+from network import framing, json_tools, lightnode_connections
+from tools import exceptions, lightnode_api, spv_api
+import contextlib
+import gzip
+import os
 import pickle
 import socket
 import selectors
+import shutil
+import tempfile
+import threading
+import time
 import traceback
 
 
-class TransactionBroadcasting:
+class PersistentConnection:
+    """This class is used to keep one long-lived connection with a full node, through which many requests and their
+    responses are carried. Requests can be pipelined : several of them are sent before waiting for the responses."""
 
-    def __init__(self, transaction):
-        self.transaction = transaction
+    def __init__(self, host, port):
         self.sel = selectors.DefaultSelector()
-        self._HOST = '127.0.0.1'
-        self._PORT = 60001
-        self._broadcasting_done = False
-
-    def _start_connection(self, transaction_bytes):
-        address_tuple = (self._HOST, self._PORT)
+        address_tuple = (host, port)
         print("starting connection to", address_tuple)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.create_connection(address_tuple)
         sock.setblocking(False)
-        sock.connect_ex(address_tuple)
-        events = selectors.EVENT_WRITE  # We only want to write to the socket in this case
-        transaction_message = lightnode_connections.FullNodeConnection(self.sel, sock, address_tuple,
-                                                                       connection_type="transaction_broadcast",
-                                                                       transaction_bytes=transaction_bytes)
-        self.sel.register(sock, events, data=transaction_message)
+        self.connection = lightnode_connections.FullNodeConnection(self.sel, sock, address_tuple,
+                                                                   connection_type="persistent")
+        self.sel.register(sock, selectors.EVENT_READ, data=self.connection)
+
+    @property
+    def is_closed(self):
+        return self.connection.is_closed
+
+    def send_requests(self, requests):
+        """Queues the (content_type, content_bytes) requests and returns their request-ids."""
+        return [self.connection.queue_request(content_type, content_bytes) for content_type, content_bytes in requests]
+
+    def wait_for_responses(self, request_ids):
+        """Sends the queued requests and waits for the responses to the given request-ids. Returns the list of
+        (jsonheader, content bytes) responses, in the same order. Raises a ConnectionError if the connection is
+        lost."""
+
+        while not all(request_id in self.connection.responses for request_id in request_ids):
+            if self.connection.is_closed:
+                raise ConnectionError("Connection to the full node lost.")
+            self._process_events(timeout=1)
+
+        return [self.connection.responses.pop(request_id) for request_id in request_ids]
+
+    def poll(self):
+        """Processes what the full node has sent meanwhile, without waiting : e.g. is_closed becomes True if it has
+        closed an idle connection."""
+        if not self.connection.is_closed:
+            self._process_events(timeout=0, quiet=True)
+
+    def _process_events(self, timeout, quiet=False):
+        events = self.sel.select(timeout=timeout)
+        for key, mask in events:
+            try:
+                self.connection.process_events(mask)
+            except Exception:
+                if not quiet:
+                    print(
+                        "Error occurred on the connection to the full node : ",
+                        f"{self.connection.addr}:\n{traceback.format_exc()}",
+                    )
+                self.connection.close()
+
+    def request(self, content_type, content_bytes=b"0", sink=None):
+        """Sends one request and returns its (jsonheader, content bytes) response. If a sink (a binary file) is
+        given, the content is written to it as it is received instead, see FullNodeConnection.queue_request."""
+        return self.wait_for_responses([self.connection.queue_request(content_type, content_bytes, sink=sink)])[0]
+
+    def close(self):
+        if not self.connection.is_closed:
+            self.connection.close()
+        self.sel.close()
+
+
+class ConnectionPool:
+    """This class lends persistent connections with a full node to the requests of the lightnode, so that they do
+    not pay a connection setup and teardown each. At most max_connections are opened, a request waits up to timeout
+    seconds for one to be available otherwise. Connections lost along the way are replaced."""
+
+    def __init__(self, host='127.0.0.1', port=60001, max_connections=4, timeout=30):
+        self._HOST = host
+        self._PORT = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self._idle_connections = []  # The last one is the most recently used, so the most likely alive
+        self._condition = threading.Condition()  # Notified whenever a connection is returned or closed
+        self._nb_of_connections = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Lends a PersistentConnection for the duration of the with block. Raises a TimeoutError if none is
+        available in time."""
+
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._condition:
+                while not self._idle_connections and self._nb_of_connections >= self.max_connections:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("No connection to the full node available.")
+                    self._condition.wait(remaining)
+
+                if self._idle_connections:
+                    conn = self._idle_connections.pop()
+                else:
+                    self._nb_of_connections += 1  # We open a new one, outside of the lock
+                    conn = None
+
+            if conn is None:
+                try:
+                    return PersistentConnection(self._HOST, self._PORT)
+                except OSError:
+                    self._forget_connection()
+                    raise
+
+            # The full node may have closed it meanwhile, e.g. after its idle timeout : we take another one
+            conn.poll()
+            if not conn.is_closed:
+                return conn
+            conn.close()
+            self._forget_connection()
+
+    def _release(self, conn):
+        if conn.is_closed:
+            conn.close()
+            self._forget_connection()
+        else:
+            with self._condition:
+                self._idle_connections.append(conn)
+                self._condition.notify()
+
+    def _forget_connection(self):
+        """Frees the room of a lost connection, so that a waiting request can open a new one."""
+        with self._condition:
+            self._nb_of_connections -= 1
+            self._condition.notify()
+
+    def close(self):
+        """Closes the idle connections of the pool."""
+        with self._condition:
+            idle_connections = self._idle_connections
+            self._idle_connections = []
+        for conn in idle_connections:
+            conn.close()
+            self._forget_connection()
+
+
+_default_pool = None
+
+
+def get_default_pool():
+    """Returns the connection pool shared by the requests that are not given one."""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ConnectionPool()
+    return _default_pool
+
+
+class TransactionBroadcasting:
+
+    def __init__(self, transaction, pool=None):
+        self.transaction = transaction
+        self.pool = pool if pool is not None else get_default_pool()
+        self._broadcasting_done = False
+        self.status = None  # "accepted", "orphaned" (held until its parents are known) or "rejected" by the full node
+        self.accepted = None  # Whether the full node has accepted the transaction
 
     def broadcast(self):
 
         # We start the broadcasting procedure with the serialized transaction
         transaction_bytes = pickle.dumps(self.transaction)
-        self._start_connection(transaction_bytes)
 
         try:
-            while True:
-                events = self.sel.select(timeout=1)
-                for key, mask in events:
-                    transaction_to_send = key.data  # Transaction that has been plugged in the transaction_message obj
-                    try:
-                        transaction_to_send.process_events(mask)
-                    except Exception:
-                        print(
-                            "Error occured during broadcasting of transaction : ",
-                            f"{transaction_to_send.addr}:\n{traceback.format_exc()}",
-                        )
-                        transaction_to_send.close()
-                # Check for a socket being monitored to continue.
-                if not self.sel.get_map():
-                    self._broadcasting_done = True
-                    print("Broadcasting of transaction done.")
-                    break
-        except KeyboardInterrupt:
-            print("caught keyboard interrupt, exiting")
-        finally:
-            self.sel.close()
+            with self.pool.connection() as connection:
+                jsonheader, content = connection.request("transaction_content", transaction_bytes)
+        except (OSError, ConnectionError):
+            print(f"Error occured during broadcasting of transaction :\n{traceback.format_exc()}")
+            return
+
+        self.status = json_tools.json_decode(content, "utf-8")["status"]
+        self.accepted = self.status == "accepted"
+        self._broadcasting_done = True
+        print("Broadcasting of transaction done.")
+
+
+def broadcast_many(transactions, pool=None, batch_size=1000):
+    """Broadcasts many transactions at once, e.g. for an exchange paying its customers. They are sent in
+    transaction_batch messages of at most batch_size transactions, pipelined on one connection, and admitted in order
+    by the full node : a transaction may spend the outputs of the ones before it. Returns the list of their statuses,
+    in the same order (see TransactionBroadcasting), None for each of them if the broadcasting failed."""
+
+    pool = pool if pool is not None else get_default_pool()
+    requests = [("transaction_batch", framing.pack_batch([pickle.dumps(t) for t in transactions[i:i + batch_size]]))
+                for i in range(0, len(transactions), batch_size)]
+
+    try:
+        with pool.connection() as connection:
+            responses = connection.wait_for_responses(connection.send_requests(requests))
+    except (OSError, ConnectionError):
+        print(f"Error occured during broadcasting of transactions :\n{traceback.format_exc()}")
+        return [None] * len(transactions)
+
+    print("Broadcasting of {} transactions done.".format(len(transactions)))
+    return [status for jsonheader, content in responses
+            for status in json_tools.json_decode(content, "utf-8")["statuses"]]
 
 
 class DatabaseRequest:
+    """Requests the database of the full node. It is received in a temporary file as it arrives rather than in
+    memory, then either loaded in self.database, or copied to destination_path (e.g. the local database of the
+    lightnode, replaced once the database is complete, as in database.write_to_db). If compressed, the full node
+    sends it in gzip, compressed once per tip for all its clients, see response_cache."""
 
-    def __init__(self):
-        self.sel = selectors.DefaultSelector()
-        self._HOST = '127.0.0.1'
-        self._PORT = 60001
+    def __init__(self, pool=None, destination_path=None, compressed=False):
+        self.pool = pool if pool is not None else get_default_pool()
+        self.destination_path = destination_path
+        self.compressed = compressed
         self._database_received = False
         self.database = None
 
-    def _start_connection(self):
-        address_tuple = (self._HOST, self._PORT)
-        print("starting connection to", address_tuple)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setblocking(False)
-        sock.connect_ex(address_tuple)
-        events = selectors.EVENT_WRITE  # We only want to write to the socket in this case
-        database_request = lightnode_connections.FullNodeConnection(self.sel, sock, address_tuple,
-                                                                    connection_type="database_request", )
-        self.sel.register(sock, events, data=database_request)
+    def request(self):
+
+        request_bytes = json_tools.json_encode({"encoding": "gzip"}, "utf-8") if self.compressed else b"0"
+
+        with tempfile.TemporaryFile() as sink:
+            try:
+                with self.pool.connection() as connection:
+                    jsonheader, content = connection.request("db_request", request_bytes, sink=sink)
+            except (OSError, ConnectionError):
+                print(f"Error occurred during requesting of database :\n{traceback.format_exc()}")
+                return
+
+            self._database_received = True
+            if jsonheader["content-type"] != "database_content":
+                return
+
+            sink.seek(0)
+            # The full node may ignore the requested encoding
+            database_file = gzip.GzipFile(fileobj=sink) if jsonheader.get("content-encoding") == "gzip" else sink
+            if self.destination_path is None:
+                self.database = pickle.load(database_file)
+            else:
+                with open(self.destination_path + '.tmp', 'wb') as destination_file:
+                    shutil.copyfileobj(database_file, destination_file)
+                os.replace(self.destination_path + '.tmp', self.destination_path)
+
+
+def _query(pool, content_type, query):
+    """Sends a query on the chain of the full node (see fullnode_connections.QUERY_CONTENT_TYPES) and returns the
+    (content_type, content bytes) of its answer, None if the full node could not be reached."""
+
+    pool = pool if pool is not None else get_default_pool()
+    try:
+        with pool.connection() as connection:
+            jsonheader, content = connection.request(content_type, json_tools.json_encode(query, "utf-8"))
+    except (OSError, ConnectionError):
+        print(f"Error occurred during query {content_type} :\n{traceback.format_exc()}")
+        return None
+    return jsonheader["content-type"], content
+
+
+def get_balance(address, pool=None):
+    """Returns the balance of the address in the chain of the full node, answered from its index without
+    downloading the chain. None if the full node could not be reached."""
+
+    answer = _query(pool, "get_balance", {"address": address})
+    if answer is None or answer[0] != "balance":
+        return None
+    return json_tools.json_decode(answer[1], "utf-8")["balance"]
+
+
+def get_utxos(address, pool=None):
+    """Returns the list of the (txhash, position, amount) unspent outputs of the address in the chain of the full
+    node, None if the full node could not be reached."""
+
+    answer = _query(pool, "get_utxos", {"address": address})
+    if answer is None or answer[0] != "utxos":
+        return None
+    return [tuple(utxo) for utxo in json_tools.json_decode(answer[1], "utf-8")["utxos"]]
+
+
+def get_transaction(txhash, pool=None):
+    """Returns the (transaction, height of its block) of the transaction with the given hash, known by the full node.
+    The height is None if the transaction is not yet in a block, (None, None) if the full node does not know it.
+    None if the full node could not be reached."""
+
+    answer = _query(pool, "get_tx", {"txhash": txhash})
+    if answer is None or answer[0] != "transaction":
+        return None
+    transaction = pickle.loads(answer[1])
+    return transaction["transaction"], transaction["height"]
+
+
+def get_tip(pool=None):
+    """Returns the (height, hash) of the last block of the chain of the full node, None if it could not be
+    reached."""
+
+    answer = _query(pool, "get_tip", {})
+    if answer is None or answer[0] != "tip":
+        return None
+    tip = json_tools.json_decode(answer[1], "utf-8")
+    return tip["height"], tip["hash"]
+
+
+class ChainUpdateRequest:
+    """Requests the blocks of the chain of the full node that follow the last block it has in common with the local
+    copy of the lightnode, given the locator of the copy (see lightnode_api.get_locator) : only the blocks the
+    lightnode misses are sent, at most chain_sync.MAX_BLOCKS of them. fork_height is the height of the last block in
+    common, length the length of the chain of the full node."""
+
+    def __init__(self, locator, pool=None):
+        self.locator = locator
+        self.pool = pool if pool is not None else get_default_pool()
+        self.fork_height = None
+        self.blocks = None
+        self.length = None
 
     def request(self):
 
-        # We start the broadcasting procedure with the serialized transaction
-        self._start_connection()
+        answer = _query(self.pool, "chain_update_request", {"locator": self.locator})
+        if answer is None or answer[0] != "chain_update":
+            return
+
+        chain_update = pickle.loads(answer[1])
+        self.fork_height = chain_update["fork_height"]
+        self.blocks = chain_update["blocks"]
+        self.length = chain_update["length"]
+
+
+class HeaderUpdateRequest:
+    """Requests the headers of the chain of the full node that follow the last block it has in common with the
+    headers of a lightnode in SPV mode, in the manner of ChainUpdateRequest : at most chain_sync.MAX_HEADERS of
+    them."""
+
+    def __init__(self, locator, pool=None):
+        self.locator = locator
+        self.pool = pool if pool is not None else get_default_pool()
+        self.fork_height = None
+        self.headers = None
+        self.length = None
+
+    def request(self):
+
+        answer = _query(self.pool, "header_update_request", {"locator": self.locator})
+        if answer is None or answer[0] != "header_update":
+            return
+
+        header_update = pickle.loads(answer[1])
+        self.fork_height = header_update["fork_height"]
+        self.headers = header_update["headers"]
+        self.length = header_update["length"]
+
+
+class MerkleProofsRequest:
+    """Requests the transactions of the blocks from from_height to to_height concerning the addresses, each with the
+    Merkle proof of its inclusion in its block, for a lightnode in SPV mode (see chain_sync.get_merkle_proofs)."""
+
+    def __init__(self, addresses, from_height, to_height, pool=None):
+        self.addresses = list(addresses)
+        self.from_height = from_height
+        self.to_height = to_height
+        self.pool = pool if pool is not None else get_default_pool()
+        self.proofs = None
+
+    def request(self):
+
+        answer = _query(self.pool, "merkle_proofs_request", {"addresses": self.addresses,
+                                                             "from_height": self.from_height,
+                                                             "to_height": self.to_height})
+        if answer is None or answer[0] != "merkle_proofs":
+            return
+
+        self.proofs = pickle.loads(answer[1])
+
+
+def synchronize_chain(pool=None):
+    """Brings the local copy of the chain of the lightnode (see lightnode_api) up to date with the chain of the full
+    node, receiving only the blocks it misses : a refresh costs the new blocks rather than the whole chain. Returns
+    the number of blocks received, None if the full node could not be reached."""
+
+    nb_of_blocks = 0
+    while True:
+        chain_update = ChainUpdateRequest(lightnode_api.get_locator(), pool=pool)
+        chain_update.request()
+        if chain_update.blocks is None:
+            return None
+
+        lightnode_api.apply_chain_update(chain_update.fork_height, chain_update.blocks)
+        nb_of_blocks += len(chain_update.blocks)
+        if not chain_update.blocks or chain_update.fork_height + 1 + len(chain_update.blocks) >= chain_update.length:
+            return nb_of_blocks
 
-        try:
-            while True:
-                events = self.sel.select(timeout=1)
-                for key, mask in events:
-                    db_request = key.data  # Transaction that has been plugged in the transaction_message obj
-                    try:
-                        db_request.process_events(mask)
-                    except Exception:
-                        print(
-                            "Error occurred during requesting of database : ",
-                            f"{db_request.addr}:\n{traceback.format_exc()}",
-                        )
-                        db_request.close()
-                # Check for a socket being monitored to continue.
-                if not self.sel.get_map():
-                    self._database_received = True
-                    if db_request.database_received is not None:
-                        self.database = db_request.database_received
-                    break
-        except KeyboardInterrupt:
-            print("caught keyboard interrupt, exiting")
-        finally:
-            self.sel.close()
 
+def synchronize_headers(pool=None):
+    """Brings the headers of a lightnode in SPV mode (see spv_api) up to date with the chain of the full node, then
+    receives the transactions concerning its addresses in the new blocks, with their Merkle proofs. Returns True once
+    done, False if the full node could not be reached or sent headers or proofs that do not check out."""
 
+    try:
+        while True:
+            header_update = HeaderUpdateRequest(spv_api.get_locator(), pool=pool)
+            header_update.request()
+            if header_update.headers is None:
+                return False
 
+            spv_api.apply_header_update(header_update.fork_height, header_update.headers)
+            if not header_update.headers \
+                    or header_update.fork_height + 1 + len(header_update.headers) >= header_update.length:
+                break
 
+        to_height = spv_api.get_height()
+        if to_height > spv_api.get_proofs_height():
+            proofs_request = MerkleProofsRequest(spv_api.get_addresses(), spv_api.get_proofs_height() + 1,
+                                                 to_height, pool=pool)
+            proofs_request.request()
+            if proofs_request.proofs is None:
+                return False
+            spv_api.apply_merkle_proofs(proofs_request.proofs, to_height)
 
+    except exceptions.ValidationError:
+        print(f"Invalid answer of the full node during synchronization of headers :\n{traceback.format_exc()}")
+        return False
 
+    return True
@@ -1,22 +1,23 @@
-from network import json_tools
+from network import framing, json_tools
 import pickle
-import sys
 import selectors
-import struct
 
 
 class FullNodeConnection:
     """This class is used to process one connection with a full node. There are two possible interactions :
         Either a we broadcast a new transaction to a full node,
-        either we request the full database."""
+        either we request the full database.
+    A "persistent" connection carries many of them : each request is tagged with a request-id, and the response of
+    the full node, carrying the same request-id, is stored in the responses dict."""
     def __init__(self, selector, sock, addr, connection_type, transaction_bytes=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
         self.connection_type = connection_type
+        self.is_closed = False  # To indicate that it has been closed
 
         if self.connection_type == "database_request":
-            self._recv_buffer = b""  # For when we receive the database from the full node
+            self._recv_buffer = framing.FrameReader()  # For when we receive the database from the full node
             self.database_received = None   # Filled when we have successfully received the database from the full node
             self._jsonheader_len = None
             self.jsonheader = None
@@ -24,12 +25,21 @@ class FullNodeConnection:
         elif self.connection_type == "transaction_broadcast":
             self.transaction_bytes = transaction_bytes
 
+        elif self.connection_type == "persistent":
+            self._recv_buffer = framing.FrameReader()  # For when we receive the responses of the full node
+            self._jsonheader_len = None
+            self.jsonheader = None
+            self.responses = {}  # request-id -> (jsonheader, content bytes) of the received responses
+            self._next_request_id = 0
+            self._sinks = {}  # request-id -> file the content of the response is written to as it is received
+            self._content_streamed = 0  # Bytes of the content of the current response already written to its sink
+
         else:
             # Unrecognized connection_type.
             print(f'Unrecognized connection_type from : {self.addr}')
             self.close()
 
-        self._send_buffer = b""
+        self._send_buffer = framing.FrameWriter()
 
         self._client_message_queued = False  # To ensure we started to send the client message to the full node
 
@@ -38,28 +48,24 @@ class FullNodeConnection:
         if self._send_buffer:
             print("Sending...")
             try:
-                # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                # Should be ready to write. Sends from the offset of the queued parts, without copying them
+                self._send_buffer.send_to(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK), skipping it for now
                 # select() will eventually call us again
                 pass
-            else:  # If no errors were raised
-                self._send_buffer = self._send_buffer[sent:]
 
     def _read(self):
         """Internal function called by read() to manage the socket."""
         try:
-            # Should be ready to read
-            data = self.sock.recv(4096)
+            # Should be ready to read. Receives directly in the free space of the buffer
+            nbytes = self._recv_buffer.recv_from(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK), skipping it for now
             # select() will eventually call us again
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not nbytes:
                 raise RuntimeError("Peer closed.")
 
     def _set_selector_to_read(self):
@@ -68,20 +74,22 @@ class FullNodeConnection:
         event = selectors.EVENT_READ
         self.selector.modify(self.sock, event, data=self)
 
+    def _set_selector_to_read_write(self):
+        """Set selector to listen for both read and write events, when a persistent connection has requests to send
+        while responses may arrive."""
+
+        event = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.selector.modify(self.sock, event, data=self)
+
     @staticmethod
-    def _create_client_message(content_type, content_bytes=b"0"):
+    def _create_client_message(content_type, content_bytes=b"0", request_id=None):
         """Returns the 3-parts client message, given the content to include, consistent with out application-layer
-        protocol that we have defined for broadcasting messages."""
-
-        jsonheader = {
-            "byteorder": sys.byteorder,  # For the endianness of the OS
-            "content-type": content_type,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = json_tools.json_encode(jsonheader, "utf-8")
-        client_message_fixed_hdr = struct.pack(">H", len(jsonheader_bytes))
-        client_message = client_message_fixed_hdr + jsonheader_bytes + content_bytes
-        return client_message
+        protocol that we have defined for broadcasting messages. The request-id is only included for the requests of
+        a persistent connection. The message is returned as the list of its [headers, content] parts, to be queued in
+        the send buffer without concatenating them."""
+
+        extra_headers = {"request-id": request_id} if request_id is not None else None
+        return [framing.create_header(content_type, len(content_bytes), extra_headers), content_bytes]
 
     def _queue_client_message(self):
         """Calls _create_client_message and adds the created message (now in the
@@ -95,9 +103,25 @@ class FullNodeConnection:
             client_message = FullNodeConnection._create_client_message(content_type="transaction_content",
                                                                        content_bytes=self.transaction_bytes)
 
-        self._send_buffer += client_message
+        self._send_buffer.append(*client_message)
         self._client_message_queued = True
 
+    def queue_request(self, content_type, content_bytes=b"0", sink=None):
+        """Adds a request to the send_buffer of a persistent connection, and returns its request-id. The response
+        will be found in the responses dict under this request-id. If a sink (a binary file) is given, the content of
+        the response is written to it as it is received, e.g. a database, and its content in the responses dict is
+        None : the receive buffer never holds the whole content."""
+
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        if sink is not None:
+            self._sinks[request_id] = sink
+
+        self._send_buffer.append(*FullNodeConnection._create_client_message(content_type, content_bytes,
+                                                                            request_id=request_id))
+        self._set_selector_to_read_write()
+        return request_id
+
     def process_events(self, mask):
         """Entry point when the socket is ready for reading or writing."""
         if mask & selectors.EVENT_READ:  # When reading the database
@@ -107,6 +131,12 @@ class FullNodeConnection:
 
     def write(self):
         """Manages the writing of what is in the sending buffer through the socket, while maintaining the state."""
+        if self.connection_type == "persistent":
+            self._write()
+            if not self._send_buffer:  # All the queued requests are sent, we now only wait for the responses
+                self._set_selector_to_read()
+            return
+
         if not self._client_message_queued:  # We have not yet init the sending process. Ensures that we init only once.
             self._queue_client_message()  # Initializes the sending process.
 
@@ -128,6 +158,10 @@ class FullNodeConnection:
         it interprets the different parts of the message."""
         self._read()
 
+        if self.connection_type == "persistent":
+            self._process_responses()
+            return
+
         if self._jsonheader_len is None:
             self.process_jsonheader_length()  # Triggers once we have received 2 bytes
 
@@ -146,6 +180,45 @@ class FullNodeConnection:
                 print(f'Unrecognized content-type from : {self.addr}')
                 self.close()
 
+    def _process_responses(self):
+        """Interprets the responses of the receive buffer of a persistent connection, several of them may have been
+        received at once."""
+
+        while True:
+            if self._jsonheader_len is None:
+                self.process_jsonheader_length()  # Triggers once we have received 2 bytes
+
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()  # Triggers once we have received jsonheader_len bytes
+
+            if self.jsonheader is None:
+                return  # We wait for more data
+
+            content_len = self.jsonheader["content-length"]
+            request_id = self.jsonheader.get("request-id")
+            if request_id in self._sinks:
+                # What has been received of the content is written to the sink, and the buffer reused for the rest
+                nbytes = min(len(self._recv_buffer), content_len - self._content_streamed)
+                with self._recv_buffer.read_view(nbytes) as chunk:
+                    self._sinks[request_id].write(chunk)
+                self._content_streamed += nbytes
+                if self._content_streamed < content_len:
+                    return  # We wait for more data
+                del self._sinks[request_id]
+                self._content_streamed = 0
+                content = None
+            else:
+                content = self._recv_buffer.read(content_len)
+                if content is None:
+                    return  # We wait for more data
+
+            self.responses[request_id] = (self.jsonheader, content)
+
+            # We get ready for the next response
+            self._jsonheader_len = None
+            self.jsonheader = None
+
     def close(self):
         """Used for unregistering the selector, closing the socket and deleting
          reference to socket object for garbage collection"""
@@ -168,6 +241,7 @@ class FullNodeConnection:
             )
         finally:
             # Delete reference to socket object for garbage collection
+            self.is_closed = True
             self.sock = None
 
     def process_jsonheader_length(self):
@@ -175,19 +249,15 @@ class FullNodeConnection:
 
         fixed_header_length = 2
         if len(self._recv_buffer) >= fixed_header_length:  # Check if we already have received enough data
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:fixed_header_length]
-            )[0]
-            self._recv_buffer = self._recv_buffer[fixed_header_length:]
+            self._jsonheader_len = self._recv_buffer.unpack(">H")[0]
 
     def process_jsonheader(self):
         """Reads the json_header of the actual database message."""
 
         if len(self._recv_buffer) >= self._jsonheader_len:  # Check if we already have received enough data
-            self.jsonheader = json_tools.json_decode(
-                self._recv_buffer[:self._jsonheader_len], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[self._jsonheader_len:]
+            # Decoded straight from the receive buffer
+            with self._recv_buffer.read_view(self._jsonheader_len) as jsonheader_view:
+                self.jsonheader = json_tools.json_decode(jsonheader_view, "utf-8")
             for required_header in (
                 "byteorder",
                 "content-type",
@@ -203,8 +273,7 @@ class FullNodeConnection:
 
         # Check if we already have received enough data, or wait for more buffer.
         if len(self._recv_buffer) >= content_len:
-            data = self._recv_buffer[:content_len]
-            self._recv_buffer = self._recv_buffer[content_len:]
+            data = self._recv_buffer.read(content_len)
 
             print(
                 f'Received a database from',
@@ -0,0 +1,239 @@
+import heapq
+import itertools
+import math
+import random
+import selectors
+import traceback
+
+# Bytes of a segment, each of which may be lost on a lossy link
+SEGMENT_SIZE = 1460
+
+
+class VirtualClock:
+    """This class is the clock of a simulation. Callbacks are scheduled at virtual times and run in order, as fast
+    as possible, whatever the real time they take. Callbacks scheduled at the same time run in the order they were
+    scheduled, so that a simulation is reproducible."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._queue = []  # (time, order, callback, args)
+        self._order = itertools.count()
+
+    def call_at(self, when, callback, *args):
+        heapq.heappush(self._queue, (max(when, self.now), next(self._order), callback, args))
+
+    def call_later(self, delay, callback, *args):
+        self.call_at(self.now + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        self.call_at(self.now, callback, *args)
+
+    def run(self, until=None):
+        """Runs the scheduled callbacks, until there are none left or the next one is due after until."""
+
+        while self._queue and (until is None or self._queue[0][0] <= until):
+            when, _, callback, args = heapq.heappop(self._queue)
+            self.now = when
+            callback(*args)
+        if until is not None:
+            self.now = max(self.now, until)
+
+
+class Link:
+    """This class holds the properties of the link from one host to another : one-way latency in seconds, bandwidth
+    in bytes per second (None for unlimited) and probability of losing a segment. Like TCP, a connection never loses
+    data : a lost segment is sent again after the retransmission timeout, and delays what follows it."""
+
+    def __init__(self, latency=0.05, bandwidth=None, loss=0.0, retransmission_timeout=0.2):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.retransmission_timeout = retransmission_timeout
+        self.busy_until = 0.0  # Until when the link is busy sending what was given to it before
+
+
+class MemoryNetwork:
+    """This class is an in-memory network, driven by a virtual clock : a pluggable replacement for TCP, so that many
+    nodes can run in one process and a simulation is reproducible (losses are drawn from a seeded generator). Hosts
+    listen on (host, port) addresses with listen(), and connect() returns a MemorySocket whose other end is given to
+    the listener. The links between hosts all have the default properties, unless set otherwise with set_link."""
+
+    def __init__(self, clock, latency=0.05, bandwidth=None, loss=0.0, retransmission_timeout=0.2, seed=0):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self._default_link = {"latency": latency, "bandwidth": bandwidth, "loss": loss,
+                              "retransmission_timeout": retransmission_timeout}
+        self._links = {}  # (host, other host) -> Link
+        self._listeners = {}  # (host, port) -> function called with the socket and the address of the connection
+        self._ports = itertools.count(40000)  # Ports of the connecting ends
+
+        self.bytes_sent = 0
+        self.segments_lost = 0
+        self.connections = 0
+
+    def set_link(self, host, other_host, **properties):
+        """Sets the properties of the links between two hosts, both ways, see Link."""
+        for link_key in ((host, other_host), (other_host, host)):
+            self._links[link_key] = Link(**dict(self._default_link, **properties))
+
+    def get_link(self, host, other_host):
+        if (host, other_host) not in self._links:
+            self._links[(host, other_host)] = Link(**self._default_link)
+        return self._links[(host, other_host)]
+
+    def listen(self, address_tuple, accept):
+        """Gives the accept function, called with (socket, address of the connecting end), the connections to the
+        address."""
+        self._listeners[tuple(address_tuple)] = accept
+
+    def connect(self, host, address_tuple):
+        """Returns the socket of a new connection from the host to the address. The listener gets the other end
+        after the latency of the link, as after a handshake. Raises a ConnectionRefusedError if nobody listens."""
+
+        address_tuple = tuple(address_tuple)
+        accept = self._listeners.get(address_tuple)
+        if accept is None:
+            raise ConnectionRefusedError(f"Nobody listens on {address_tuple}.")
+
+        local_address = (host, next(self._ports))
+        sock = MemorySocket(self, local_address, address_tuple)
+        other_sock = MemorySocket(self, address_tuple, local_address)
+        sock.peer, other_sock.peer = other_sock, sock
+        self.connections += 1
+        self.clock.call_later(self.get_link(host, address_tuple[0]).latency, accept, other_sock, local_address)
+        return sock
+
+    def transmit(self, sock, data):
+        """Schedules the delivery of the data (None for the end of the stream) to the other end of the socket, after
+        what was sent before on the same link, in order."""
+
+        link = self.get_link(sock.local_address[0], sock.peer_address[0])
+        size = len(data) if data is not None else 0
+
+        start = max(self.clock.now, link.busy_until)
+        link.busy_until = start + (size / link.bandwidth if link.bandwidth else 0)
+        delivery_time = link.busy_until + link.latency
+        if link.loss:
+            lost = sum(self.random.random() < link.loss for _ in range(max(1, math.ceil(size / SEGMENT_SIZE))))
+            self.segments_lost += lost
+            delivery_time += lost * link.retransmission_timeout
+
+        # The data of a connection arrives in order, even when some of it was sent again
+        delivery_time = max(delivery_time, sock.last_delivery_time)
+        sock.last_delivery_time = delivery_time
+        self.bytes_sent += size
+        self.clock.call_at(delivery_time, sock.peer.deliver, data)
+
+
+class MemorySocket:
+    """This class is one end of a connection of a MemoryNetwork. It exposes the socket and selector methods used by
+    the connection classes (ClientConnection, NeighborConnection, FullNodeConnection), like
+    fullnode_socket_manager.StreamSocket, and is given to a connection as its socket and as its selector. Sending
+    never blocks : the data is handed to the network at once. See drive."""
+
+    def __init__(self, network, local_address, peer_address):
+        self.network = network
+        self.local_address = local_address
+        self.peer_address = peer_address
+        self.peer = None  # The other end
+        self.events = selectors.EVENT_READ  # What the connection is currently waiting for
+        self.on_ready = None  # Called when data (or the end of the stream) arrives
+        self.last_delivery_time = 0.0
+        self.is_closed = False
+
+        self._pending_data = bytearray()  # Arrived but not yet recv'd by the connection
+        self._eof = False
+
+    # ------ Socket side, used by the connection ------
+
+    def recv(self, bufsize):
+        if self._pending_data:
+            data = bytes(self._pending_data[:bufsize])
+            del self._pending_data[:bufsize]
+            return data
+        if self._eof:
+            return b""
+        raise BlockingIOError
+
+    def recv_into(self, buffer, nbytes=0):
+        if self._pending_data:
+            nbytes = min(nbytes or len(buffer), len(self._pending_data))
+            with memoryview(self._pending_data) as pending_view:
+                buffer[:nbytes] = pending_view[:nbytes]
+            del self._pending_data[:nbytes]
+            return nbytes
+        if self._eof:
+            return 0
+        raise BlockingIOError
+
+    def send(self, data):
+        self.network.transmit(self, bytes(data))
+        return len(data)
+
+    def sendmsg(self, buffers):
+        return self.send(b"".join(buffers))
+
+    def send_file(self, file, offset, count):
+        """Sends count bytes of the file from offset, see framing.FilePart."""
+        file.seek(offset)
+        return self.send(file.read(count))
+
+    def close(self):
+        if not self.is_closed:
+            self.is_closed = True
+            self.network.transmit(self, None)
+
+    # ------ Selector side, used by the connection ------
+
+    def register(self, fileobj, events, data=None):
+        self.events = events
+
+    def modify(self, fileobj, events, data=None):
+        self.events = events
+
+    def unregister(self, fileobj):
+        self.events = 0
+
+    # ------ Network side ------
+
+    def has_pending_data(self):
+        return bool(self._pending_data) or self._eof
+
+    def deliver(self, data):
+        if self.is_closed:
+            return
+        if data is None:
+            self._eof = True
+        else:
+            self._pending_data += data
+        if self.on_ready is not None:
+            self.on_ready()
+
+
+def drive(connection, sock, process=None):
+    """Feeds the events of an in-memory socket to the connection using it, in the manner of
+    fullnode_socket_manager._drive : whenever data arrives, and as long as the connection has something to send.
+    process is called with the connection after each event, e.g. for the node to process a received message."""
+
+    def step():
+        try:
+            while not connection.is_closed:
+                if sock.events & selectors.EVENT_WRITE:
+                    mask = selectors.EVENT_WRITE
+                elif sock.events & selectors.EVENT_READ and sock.has_pending_data():
+                    mask = selectors.EVENT_READ
+                else:
+                    break
+                connection.process_events(mask)
+                if process is not None:
+                    process(connection)
+        except Exception:
+            print(
+                "memory_transport: error: exception for",
+                f"{connection.addr}:\n{traceback.format_exc()}",
+            )
+            if not connection.is_closed:
+                connection.close()
+
+    sock.on_ready = step
+    sock.network.clock.call_soon(step)
@@ -0,0 +1,133 @@
+import collections
+import random
+import threading
+import time
+
+
+class PeerManager:
+    """This class holds the table of the neighbors of a full node, configured or discovered when they announce
+    themselves, with the latency and throughput measured when gossipping with each of them. An announcement is sent to
+    at most fanout neighbors, the fastest ones first, so that the cost of gossip does not grow with the number of
+    neighbors. It also remembers the hashes of the last blocks and transactions seen, so that a message coming back
+    through another neighbor is dropped before being deserialized. Used both by the event loop and by the processing
+    thread, hence the lock."""
+
+    def __init__(self, peers=(), fanout=8, seen_cache_size=10000, max_peers=64, max_failures=3):
+        self.fanout = fanout
+        self.seen_cache_size = seen_cache_size
+        self.max_peers = max_peers
+        self.max_failures = max_failures  # Consecutive failures after which a discovered peer is forgotten
+
+        self._lock = threading.Lock()
+        # (host, port) -> {"configured", "latency", "throughput", "failures", "last_seen"}. Latency and throughput are
+        # moving averages, None until measured
+        self._peers = {}
+        self._seen = collections.OrderedDict()  # hash -> value given to mark_seen, least recently seen first
+
+        for address_tuple in peers:
+            self.add_peer(address_tuple, configured=True)
+
+    def __len__(self):
+        return len(self._peers)
+
+    def add_peer(self, address_tuple, configured=False):
+        """Adds a neighbor to the table, if there is room for it. Returns True if it was not known yet."""
+
+        address_tuple = tuple(address_tuple)
+        with self._lock:
+            if address_tuple in self._peers:
+                self._peers[address_tuple]["last_seen"] = time.monotonic()
+                return False
+            if not configured and len(self._peers) >= self.max_peers:
+                return False
+            self._peers[address_tuple] = {
+                "configured": configured,
+                "latency": None,
+                "throughput": None,
+                "failures": 0,
+                "last_seen": time.monotonic()
+            }
+            return True
+
+    def get_peers(self):
+        """Returns the list of the (host, port) of the known neighbors."""
+        with self._lock:
+            return list(self._peers)
+
+    def get_stats(self, address_tuple):
+        """Returns a copy of the measurements of a neighbor, None if it is unknown."""
+        with self._lock:
+            stats = self._peers.get(tuple(address_tuple))
+            return dict(stats) if stats is not None else None
+
+    def select_peers(self, exclude=()):
+        """Returns the neighbors an announcement should be sent to : at most fanout of them, the not yet measured
+        ones first (so that they get measured), then by increasing latency. Neighbors failing lately come last."""
+
+        exclude = {tuple(address_tuple) for address_tuple in exclude}
+        with self._lock:
+            candidates = [address_tuple for address_tuple in self._peers if address_tuple not in exclude]
+            random.shuffle(candidates)  # Between equivalent neighbors, any of them
+            candidates.sort(key=lambda address_tuple: (
+                self._peers[address_tuple]["failures"],
+                self._peers[address_tuple]["latency"] is not None,
+                self._peers[address_tuple]["latency"] or 0
+            ))
+            return candidates[:self.fanout]
+
+    def record_transfer(self, address_tuple, latency, nbytes=0, duration=0):
+        """Records a successful exchange with a neighbor : the time it took to connect and, if anything was
+        transferred, its throughput in bytes per second."""
+
+        with self._lock:
+            stats = self._peers.get(tuple(address_tuple))
+            if stats is None:
+                return
+            stats["failures"] = 0
+            stats["last_seen"] = time.monotonic()
+            stats["latency"] = _moving_average(stats["latency"], latency)
+            if nbytes and duration > 0:
+                stats["throughput"] = _moving_average(stats["throughput"], nbytes / duration)
+
+    def record_failure(self, address_tuple):
+        """Records a failed exchange with a neighbor. A discovered neighbor failing too often is forgotten."""
+
+        address_tuple = tuple(address_tuple)
+        with self._lock:
+            stats = self._peers.get(address_tuple)
+            if stats is None:
+                return
+            stats["failures"] += 1
+            if not stats["configured"] and stats["failures"] >= self.max_failures:
+                del self._peers[address_tuple]
+
+    def mark_seen(self, message_hash, value=True):
+        """Remembers the hash of a block or transaction. Returns the value it was marked with if it had already been
+        seen, None otherwise (in which case it is now marked with the given value)."""
+
+        with self._lock:
+            if message_hash in self._seen:
+                self._seen.move_to_end(message_hash)
+                return self._seen[message_hash]
+
+            self._seen[message_hash] = value
+            if len(self._seen) > self.seen_cache_size:
+                self._seen.popitem(last=False)  # The least recently seen one
+            return None
+
+    def is_seen(self, message_hash):
+        """Returns True if the hash of a block or transaction has been seen lately."""
+        with self._lock:
+            return message_hash in self._seen
+
+    def update_seen(self, message_hash, value):
+        """Changes the value a seen hash is marked with, e.g. once the message has been processed."""
+        with self._lock:
+            if message_hash in self._seen:
+                self._seen[message_hash] = value
+
+
+def _moving_average(average, value, weight=0.3):
+    if average is None:
+        return value
+    return (1 - weight) * average + weight * value
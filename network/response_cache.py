@@ -0,0 +1,66 @@
+import threading
+import zlib
+
+# The encodings a client may request the database in, besides the serialized database as is
+ENCODINGS = ("gzip",)
+
+# Bytes of the database file read at once when encoding it
+_ENCODING_CHUNK_SIZE = 262144
+
+
+class ResponseCache:
+    """This class holds the encoded versions of the database sent to the clients (e.g. compressed), which only change
+    with the tip of the chain : each of them is encoded once per tip, then shared by all the clients requesting it.
+    The cache only keeps the entries of the current tip, and is cleared by set_tip whenever the chain changes. The
+    serialized database as is needs no entry, since it is streamed from the database file. Used both by the event
+    loop and by the processing thread, hence the lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tip_hash = None  # None until the chain changes after the start of the node
+        self._entries = {}  # encoding -> encoded database, for the current tip
+        self.hits = 0
+        self.misses = 0
+
+    def get_tip(self):
+        """Returns the tip the entries are kept for, to be given back to put()."""
+        with self._lock:
+            return self._tip_hash
+
+    def set_tip(self, tip_hash):
+        """Called when a block is appended or the chain replaced : the entries of the previous tip are dropped."""
+        with self._lock:
+            if tip_hash != self._tip_hash:
+                self._tip_hash = tip_hash
+                self._entries.clear()
+
+    def get(self, tip_hash, encoding):
+        """Returns the database encoded for the given tip, None if it is not in the cache."""
+        with self._lock:
+            content = self._entries.get(encoding) if tip_hash == self._tip_hash else None
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return content
+
+    def put(self, tip_hash, encoding, content):
+        """Keeps the database encoded for the given tip, unless the chain has changed since (see get_tip)."""
+        with self._lock:
+            if tip_hash == self._tip_hash:
+                self._entries[encoding] = content
+
+
+def encode_database(database_file, encoding):
+    """Returns the content of the database file in the given encoding, reading it by chunks."""
+
+    if encoding != "gzip":
+        raise ValueError(f"Unsupported encoding {encoding}.")
+
+    compressor = zlib.compressobj(level=6, wbits=31)  # wbits=31 for the gzip format, read by gzip.GzipFile
+    encoded_parts = []
+    with database_file:
+        for chunk in iter(lambda: database_file.read(_ENCODING_CHUNK_SIZE), b""):
+            encoded_parts.append(compressor.compress(chunk))
+    encoded_parts.append(compressor.flush())
+    return b"".join(encoded_parts)
@@ -0,0 +1,38 @@
+import time
+
+
+class BlockAssemblyPolicy:
+    """This class decides when a full node assembles a new block from its mempool, and which transactions go in it.
+    A block is assembled as soon as the pool holds enough transactions or bytes to fill it, or when the oldest
+    pending transaction has waited long enough. This way the cost of mining and gossiping a block is shared by many
+    transactions under load, while a lone transaction is still confirmed in bounded time."""
+
+    def __init__(self, max_transactions=10, max_bytes=1000000, max_wait=10):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait  # In seconds
+
+    def is_ready(self, mempool, now=None):
+        """Returns True if a block should be assembled from the mempool now."""
+
+        if len(mempool) == 0:
+            return False
+
+        # A block is never assembled empty, e.g. if the oldest transaction is larger than a block
+        if not self.select_transactions(mempool):
+            return False
+
+        if len(mempool) >= self.max_transactions or mempool.total_bytes >= self.max_bytes:
+            return True
+
+        if now is None:
+            now = time.monotonic()
+        return now - mempool.get_oldest_admission_time() >= self.max_wait
+
+    def fits_in_block(self, size):
+        """Returns True if a transaction of the given size in bytes can be included in a block."""
+        return size <= self.max_bytes
+
+    def select_transactions(self, mempool):
+        """Returns the oldest transactions of the mempool that fit in a block."""
+        return mempool.get_transactions(max_transactions=self.max_transactions, max_bytes=self.max_bytes)
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+from tools import validation
+
+
+class ChainColumns:
+    """This class holds a chain in columns, one table (DataFrame) per kind of record, for analytics computed over
+    whole columns at once rather than block by block :
+    - headers : height, block_hash, prev_block_hash, nonce, merkle_root, one row per block ;
+    - transactions : height, txhash, one row per transaction, in the order of the chain (tx_id is its row) ;
+    - outputs : tx_id, position, address_id, amount, spent, one row per output ;
+    - inputs : tx_id of the spending transaction, prev_tx_id and position of the output it spends, address_id and
+      amount of this output (-1 and 0 if the output is not in the chain, e.g. for a reward), one row per input.
+    Addresses are integer codes, indexes in the addresses array. See export_chain."""
+
+    def __init__(self, headers, transactions, outputs, inputs, addresses):
+        self.headers = headers
+        self.transactions = transactions
+        self.outputs = outputs
+        self.inputs = inputs
+        self.addresses = addresses
+
+    def get_summary(self):
+        """Returns one row per block : its hash, the hash of the previous block, its number of transactions and the
+        amount of their outputs, indexed by block height."""
+
+        outputs_per_block = self.outputs["amount"].groupby(
+            self.transactions["height"].to_numpy()[self.outputs["tx_id"].to_numpy()]).sum()
+        summary = pd.DataFrame({
+            "Block Height": self.headers["height"],
+            "Block Hash": self.headers["block_hash"],
+            "Previous Block Hash": self.headers["prev_block_hash"],
+            "Transactions": np.bincount(self.transactions["height"], minlength=len(self.headers)),
+            "Amount": outputs_per_block.reindex(self.headers["height"], fill_value=0).to_numpy()
+        })
+        return summary.set_index("Block Height")
+
+    def get_balances(self):
+        """Returns the balance of every address having unspent outputs : the total of these outputs, indexed by
+        address."""
+        unspent_outputs = self.outputs[~self.outputs["spent"]]
+        balances = unspent_outputs.groupby("address_id")["amount"].sum()
+        return pd.Series(balances.to_numpy(), index=pd.Index(self.addresses[balances.index], name="address"),
+                         name="balance")
+
+    def get_rich_list(self, n=10):
+        """Returns the n largest balances, from the largest, indexed by address."""
+        return self.get_balances().nlargest(n)
+
+    def get_flows(self):
+        """Returns the amounts paid from an address to another, summed over the chain, from the largest : one row per
+        (sender, recipient) pair, the change paid back to the sender excluded. The sender of a transaction is the
+        owner of the outputs it spends : the transactions spending no output of the chain (genesis, rewards) are left
+        out."""
+
+        known_inputs = self.inputs[self.inputs["address_id"] >= 0]
+        senders = known_inputs.groupby("tx_id")["address_id"].first()
+        payments = self.outputs[self.outputs["tx_id"].isin(senders.index)]
+        from_address_ids = senders.reindex(payments["tx_id"]).to_numpy()
+        to_address_ids = payments["address_id"].to_numpy()
+        not_change = from_address_ids != to_address_ids
+
+        flows = pd.DataFrame({"from_address_id": from_address_ids[not_change],
+                              "to_address_id": to_address_ids[not_change],
+                              "amount": payments["amount"].to_numpy()[not_change]})
+        flows = flows.groupby(["from_address_id", "to_address_id"], as_index=False)["amount"].sum()
+        flows = flows.sort_values("amount", ascending=False, kind="stable", ignore_index=True)
+        return pd.DataFrame({"from_address": self.addresses[flows["from_address_id"].to_numpy()],
+                             "to_address": self.addresses[flows["to_address_id"].to_numpy()],
+                             "amount": flows["amount"].to_numpy()})
+
+
+def export_chain(db, block_hashes=None):
+    """Turns the chain db (a list of blocks) into a ChainColumns, in a single pass over its blocks and transactions.
+    The hashes of the blocks are computed unless given, e.g. by a ChainIndex. The outputs spent by the inputs, and
+    whether the outputs are spent, are then found by joining the columns."""
+
+    if block_hashes is None:
+        block_hashes = [validation.get_block_hash(b) for b in db]
+
+    headers = {"nonce": [], "prev_block_hash": [], "merkle_root": []}
+    tx_heights = []
+    txhashes = []
+    output_tx_ids, output_positions, output_addresses, output_amounts = [], [], [], []
+    input_tx_ids, input_prev_txhashes, input_positions = [], [], []
+    for height, b in enumerate(db):
+        headers["nonce"].append(b.metadata["nonce"])
+        headers["prev_block_hash"].append(b.metadata["prev_block_hash"])
+        headers["merkle_root"].append(b.metadata.get("merkle_root"))
+        for t in b.block_content:
+            tx_id = len(txhashes)
+            tx_heights.append(height)
+            txhashes.append(t.txhash)
+            for tx_hash, pos in t.internals["dict_of_inputs"].items():
+                input_tx_ids.append(tx_id)
+                input_prev_txhashes.append(tx_hash)
+                input_positions.append(pos)
+            for pos, (address, amount) in enumerate(t.internals["dict_of_outputs"].items()):
+                output_tx_ids.append(tx_id)
+                output_positions.append(pos)
+                output_addresses.append(address)
+                output_amounts.append(amount)
+
+    address_ids, addresses = pd.factorize(pd.Series(output_addresses, dtype=object))
+    outputs = pd.DataFrame({
+        "tx_id": np.array(output_tx_ids, dtype=np.int64),
+        "position": np.array(output_positions, dtype=np.int64),
+        "address_id": address_ids.astype(np.int64),
+        "amount": np.array(output_amounts, dtype=np.int64)
+    })
+
+    # The outputs spent by the inputs, found by (txhash, position) : -1 when not in the chain. As in a ChainIndex,
+    # a txhash found twice in the chain refers to the last transaction
+    tx_ids = pd.Series(np.arange(len(txhashes), dtype=np.int64), index=pd.Index(txhashes, dtype=object))
+    tx_ids = tx_ids[~tx_ids.index.duplicated(keep="last")]
+    rows = tx_ids.index.get_indexer(pd.Index(input_prev_txhashes, dtype=object))
+    prev_tx_ids = np.where(rows >= 0, tx_ids.to_numpy()[rows], -1)
+    inputs = pd.DataFrame({
+        "tx_id": np.array(input_tx_ids, dtype=np.int64),
+        "prev_tx_id": prev_tx_ids.astype(np.int64),
+        "position": np.array(input_positions, dtype=np.int64)
+    })
+    output_rows = pd.MultiIndex.from_arrays([outputs["tx_id"], outputs["position"]]).get_indexer(
+        pd.MultiIndex.from_arrays([inputs["prev_tx_id"], inputs["position"]]))
+    found = output_rows >= 0
+    inputs["address_id"] = np.where(found, outputs["address_id"].to_numpy()[output_rows], -1)
+    inputs["amount"] = np.where(found, outputs["amount"].to_numpy()[output_rows], 0)
+
+    spent = np.zeros(len(outputs), dtype=bool)
+    spent[output_rows[found]] = True
+    outputs["spent"] = spent
+
+    return ChainColumns(
+        headers=pd.DataFrame({"height": np.arange(len(db), dtype=np.int64), "block_hash": list(block_hashes),
+                              "prev_block_hash": headers["prev_block_hash"], "nonce": headers["nonce"],
+                              "merkle_root": headers["merkle_root"]}),
+        transactions=pd.DataFrame({"height": np.array(tx_heights, dtype=np.int64), "txhash": txhashes}),
+        outputs=outputs,
+        inputs=inputs,
+        addresses=np.asarray(addresses, dtype=object)
+    )
@@ -0,0 +1,85 @@
+from tools import validation
+
+
+class ChainIndex:
+    """This class indexes a chain of blocks : its transactions by hash, with the height of their block, and its
+    unspent outputs by address. It is updated block by block, so that keeping it up to date costs the new blocks
+    only. Used by the full node to answer the queries of its clients, and by the lightnode for its local copy of the
+    chain."""
+
+    def __init__(self):
+        self.blocks = []
+        self.block_hashes = []
+        self._transactions = {}  # txhash -> (height, transaction)
+        self._unspent_outputs = {}  # address -> {(txhash, position): amount}
+        self._spent_outputs = {}  # (txhash, position) -> txhash of the transaction spending it
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _get_output(self, tx_hash, position):
+        return list(self._transactions[tx_hash][1].internals["dict_of_outputs"].items())[position]
+
+    def add_block(self, b):
+        """Appends a block to the chain and indexes its transactions : the outputs they spend are not unspent
+        anymore, the ones they create are."""
+
+        height = len(self.blocks)
+        for t in b.block_content:
+            self._transactions[t.txhash] = (height, t)
+            for tx_hash, pos in t.internals["dict_of_inputs"].items():
+                if tx_hash in self._transactions:
+                    address, amount = self._get_output(tx_hash, pos)
+                    self._unspent_outputs.get(address, {}).pop((tx_hash, pos), None)
+                self._spent_outputs[(tx_hash, pos)] = t.txhash
+            for pos, (address, amount) in enumerate(t.internals["dict_of_outputs"].items()):
+                self._unspent_outputs.setdefault(address, {})[(t.txhash, pos)] = amount
+
+        self.blocks.append(b)
+        self.block_hashes.append(validation.get_block_hash(b))
+
+    def remove_last_block(self):
+        """Removes the last block of the chain, undoing add_block."""
+
+        b = self.blocks.pop()
+        self.block_hashes.pop()
+        for t in reversed(b.block_content):
+            for pos, address in enumerate(t.internals["dict_of_outputs"]):
+                self._unspent_outputs.get(address, {}).pop((t.txhash, pos), None)
+            for tx_hash, pos in t.internals["dict_of_inputs"].items():
+                if tx_hash in self._transactions:
+                    address, amount = self._get_output(tx_hash, pos)
+                    self._unspent_outputs.setdefault(address, {})[(tx_hash, pos)] = amount
+                self._spent_outputs.pop((tx_hash, pos), None)
+            del self._transactions[t.txhash]
+
+    def update(self, db):
+        """Brings the index up to date with the chain db : the blocks after the last one in common are removed, and
+        the following blocks of db added. Returns the height of the last block in common, -1 if none."""
+
+        fork_height = min(len(self.blocks), len(db)) - 1
+        while fork_height >= 0 and validation.get_block_hash(db[fork_height]) != self.block_hashes[fork_height]:
+            fork_height -= 1
+
+        while len(self.blocks) > fork_height + 1:
+            self.remove_last_block()
+        for b in db[fork_height + 1:]:
+            self.add_block(b)
+        return fork_height
+
+    def get_transaction(self, tx_hash):
+        """Returns the (height of its block, transaction) of a transaction of the chain, None if it is not in it."""
+        return self._transactions.get(tx_hash)
+
+    def get_spender(self, outpoint):
+        """Returns the txhash of the transaction of the chain spending the (txhash, position) output, None if it is
+        not spent."""
+        return self._spent_outputs.get(outpoint)
+
+    def get_unspent_outputs(self, address):
+        """Returns the {(txhash, position): amount} unspent outputs of the address."""
+        return dict(self._unspent_outputs.get(address, {}))
+
+    def get_balance(self, address):
+        """Returns the balance of the address : the total of its unspent outputs."""
+        return sum(self._unspent_outputs.get(address, {}).values())
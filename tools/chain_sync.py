@@ -0,0 +1,239 @@
+from tools import classes, crypto, exceptions, fullnode_api, merkle, validation
+import hashlib
+import pickle
+
+# Maximum number of headers sent in one "headers" message, the rest being requested again once the blocks are in
+MAX_HEADERS = 2000
+# Maximum number of blocks sent to a lightnode in one "chain_update" message, the rest being requested again
+MAX_BLOCKS = 500
+# Number of hexadecimal characters of the hash of a transaction kept as its short ID in a compact block
+SHORT_ID_LENGTH = 16
+
+
+def is_better_chain(length, tip_hash, db):
+    """Returns True if a chain of the given length and tip hash should replace ours. The longest chain wins. Between
+    chains of the same length, the one whose tip has the smallest hash wins, so that neighbors having mined the same
+    transactions at the same time all end up on the same chain."""
+    return is_better_tip(length, tip_hash, len(db), validation.get_block_hash(db[-1]))
+
+
+def is_better_tip(length, tip_hash, our_length, our_tip_hash):
+    """is_better_chain, given the length and the tip hash of our chain, e.g. for a lightnode in SPV mode that only
+    has the headers."""
+
+    if length != our_length:
+        return length > our_length
+    return tip_hash < our_tip_hash
+
+
+def _get_locator_heights(length):
+    height = length - 1
+    step = 1
+    heights = []
+    while height > 0:
+        heights.append(height)
+        if len(heights) >= 10:
+            step *= 2
+        height -= step
+    heights.append(0)
+    return heights
+
+
+def get_locator(db):
+    """Returns the block locator of a chain : the hashes of the last 10 blocks, then of blocks further and further
+    back (the step doubles each time), down to the genesis block. A neighbor finds in it the last block that our
+    chains have in common, whatever their length."""
+    return [validation.get_block_hash(db[height]) for height in _get_locator_heights(len(db))]
+
+
+def get_locator_from_hashes(block_hashes):
+    """get_locator, given the hashes of the blocks of the chain, e.g. for a lightnode in SPV mode. Empty for an empty
+    chain."""
+    return [block_hashes[height] for height in _get_locator_heights(len(block_hashes))] if block_hashes else []
+
+
+def find_fork_point(db, locator):
+    """Returns the height of the first block of the locator that is also in the chain, i.e. the last block in common
+    with the neighbor that sent the locator. None if there is none, e.g. if the chains have different genesis
+    blocks."""
+
+    heights_by_hash = {validation.get_block_hash(b): height for height, b in enumerate(db)}
+    for block_hash in locator:
+        if block_hash in heights_by_hash:
+            return heights_by_hash[block_hash]
+    return None
+
+
+def get_fork_point(db, other_db):
+    """Returns the height of the last block two chains have in common, -1 if they have none."""
+
+    fork_height = -1
+    for b, other_b in zip(db, other_db):
+        if validation.get_block_hash(b) != validation.get_block_hash(other_b):
+            break
+        fork_height += 1
+    return fork_height
+
+
+def get_chain_update(db, locator, max_blocks=MAX_BLOCKS):
+    """Returns what a lightnode misses to bring its copy of the chain up to date, given the locator of its copy : the
+    height of the last block in common ("fork_height", -1 if none, e.g. for an empty copy), the blocks following it
+    (at most max_blocks) and the length of the chain."""
+
+    fork_height = find_fork_point(db, locator)
+    if fork_height is None:
+        fork_height = -1
+    return {"fork_height": fork_height, "blocks": db[fork_height + 1:fork_height + 1 + max_blocks], "length": len(db)}
+
+
+def get_header_update(db, locator, max_headers=MAX_HEADERS):
+    """Returns what a lightnode in SPV mode misses to bring its headers up to date, in the manner of
+    get_chain_update : the height of the last block in common, the headers following it (at most max_headers) and
+    the length of the chain."""
+
+    fork_height = find_fork_point(db, locator)
+    if fork_height is None:
+        fork_height = -1
+    return {"fork_height": fork_height, "headers": get_headers(db, fork_height, max_headers=max_headers),
+            "length": len(db)}
+
+
+def get_merkle_proofs(db, addresses, from_height, to_height):
+    """Returns the transactions of the blocks from from_height to to_height that concern the addresses, i.e. pay
+    them or are signed by them (spending their outputs), for a lightnode in SPV mode. Each of them comes with the
+    height of its block, its index in the block and its Merkle proof (see merkle.get_merkle_proof)."""
+
+    addresses = set(addresses)
+    proofs = []
+    for height in range(max(from_height, 0), min(to_height, len(db) - 1) + 1):
+        levels = None  # Only computed for the blocks with transactions to prove
+        for index, t in enumerate(db[height].block_content):
+            if addresses.isdisjoint(t.internals["dict_of_outputs"]) \
+                    and crypto.get_address_from_verifying_key(t.verifying_key) not in addresses:
+                continue
+            if levels is None:
+                levels = merkle.get_merkle_levels([block_t.txhash for block_t in db[height].block_content])
+            proofs.append({"height": height, "index": index, "transaction": t,
+                           "proof": merkle.get_merkle_proof(levels, index)})
+    return proofs
+
+
+def get_headers(db, fork_height, max_headers=MAX_HEADERS):
+    """Returns the headers (i.e. the metadata) of the blocks following the fork point, at most max_headers."""
+    return [b.metadata for b in db[fork_height + 1:fork_height + 1 + max_headers]]
+
+
+def check_headers(db, headers):
+    """Checks that the headers sent by a neighbor follow one another from a block of the chain, with a valid proof
+    of work each, before any of their blocks is downloaded. Returns the height of the block they follow, or raises a
+    ValidationError."""
+
+    if not headers:
+        raise exceptions.ValidationError("No headers received.")
+
+    fork_height = find_fork_point(db, [headers[0]["prev_block_hash"]])
+    if fork_height is None:
+        raise exceptions.ValidationError("Received headers do not follow any block of the chain.")
+
+    check_header_chain(headers, fork_height, headers[0]["prev_block_hash"])
+    return fork_height
+
+
+def check_header_chain(headers, fork_height, previous_hash):
+    """Checks that the headers follow one another from the block at fork_height, whose hash is previous_hash, with a
+    valid proof of work each. Raises a ValidationError otherwise."""
+
+    for height, header in enumerate(headers, start=fork_height + 1):
+        if header["id"] != height or header["prev_block_hash"] != previous_hash:
+            raise exceptions.ValidationError("Received headers do not follow one another at height {}."
+                                             .format(height))
+        previous_hash = validation.get_header_hash(header)
+        if not previous_hash.startswith(fullnode_api.PROOF_OF_WORK_PREFIX):
+            raise exceptions.ValidationError("Invalid proof of work for received header at height {}."
+                                             .format(height))
+
+
+def get_blocks(db, block_hashes):
+    """Returns the blocks of the chain with the given hashes, in the same order, leaving out the unknown ones."""
+
+    blocks_by_hash = {validation.get_block_hash(b): b for b in db}
+    return [blocks_by_hash[block_hash] for block_hash in block_hashes if block_hash in blocks_by_hash]
+
+
+def check_blocks(blocks, headers):
+    """Checks that the blocks sent by a neighbor are the ones of the headers it announced, i.e. that they have the
+    same metadata and that their content matches the content hash of the metadata. Raises a ValidationError
+    otherwise."""
+
+    if len(blocks) != len(headers):
+        raise exceptions.ValidationError("Received {} blocks for {} headers.".format(len(blocks), len(headers)))
+
+    for b, header in zip(blocks, headers):
+        if not isinstance(b, classes.Block) or b.metadata != header:
+            raise exceptions.ValidationError("Received block does not match header at height {}."
+                                             .format(header["id"]))
+        if hashlib.sha256(pickle.dumps(b.block_content)).hexdigest() != header["block_content_hash"]:
+            raise exceptions.ValidationError("Content of received block at height {} does not match its hash."
+                                             .format(header["id"]))
+        if merkle.get_merkle_root([t.txhash for t in b.block_content]) != header.get("merkle_root"):
+            raise exceptions.ValidationError("Transactions of received block at height {} do not match its Merkle "
+                                             "root.".format(header["id"]))
+
+
+def get_short_id(txhash):
+    """Returns the short ID of a transaction in a compact block, i.e. the start of its hash."""
+    return txhash[:SHORT_ID_LENGTH]
+
+
+def get_compact_blocks(db, block_hashes):
+    """Returns the compact version of the blocks of the chain with the given hashes : their header and the short IDs
+    of their transactions, which the neighbor most likely has in its mempool already. Unknown blocks are left out."""
+    return [{"header": b.metadata, "short_ids": [get_short_id(t.txhash) for t in b.block_content]}
+            for b in get_blocks(db, block_hashes)]
+
+
+def rebuild_block_contents(compact_blocks, known_transactions):
+    """Rebuilds the content of compact blocks from the known_transactions (short ID -> transaction), e.g. those of
+    the mempool. Returns the list of the contents, with None in place of the unknown transactions, and the positions
+    of these in each block (block hash -> list of positions)."""
+
+    contents = []
+    missing = {}
+    for compact_block in compact_blocks:
+        content = [known_transactions.get(short_id) for short_id in compact_block["short_ids"]]
+        positions = [position for position, t in enumerate(content) if t is None]
+        if positions:
+            missing[validation.get_header_hash(compact_block["header"])] = positions
+        contents.append(content)
+    return contents, missing
+
+
+def get_block_transactions(db, missing):
+    """Returns the transactions a neighbor is missing to rebuild compact blocks (block hash -> list of positions), in
+    the same form (block hash -> list of transactions). Unknown blocks and positions are left out."""
+
+    blocks = get_blocks(db, list(missing))
+    block_transactions = {}
+    for b in blocks:
+        block_hash = validation.get_block_hash(b)
+        block_transactions[block_hash] = [b.block_content[position] for position in missing[block_hash]
+                                          if 0 <= position < len(b.block_content)]
+    return block_transactions
+
+
+def fill_compact_blocks(compact_blocks, contents, block_transactions):
+    """Completes the contents rebuilt from compact blocks with the transactions received from the neighbor, and
+    returns the blocks. They still have to be checked against their headers with check_blocks, since a short ID
+    may match another transaction of the mempool. Raises a ValidationError if transactions are still missing."""
+
+    blocks = []
+    for compact_block, content in zip(compact_blocks, contents):
+        received = iter(block_transactions.get(validation.get_header_hash(compact_block["header"]), []))
+        content = [t if t is not None else next(received, None) for t in content]
+        if any(t is None for t in content):
+            raise exceptions.ValidationError("Transactions missing to rebuild the block at height {}."
+                                             .format(compact_block["header"]["id"]))
+        b = classes.Block(content)
+        b.metadata = dict(compact_block["header"])
+        blocks.append(b)
+    return blocks
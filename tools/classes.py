@@ -1,4 +1,4 @@
-from tools import crypto
+from tools import crypto, merkle
 import hashlib
 import pickle
 
@@ -19,7 +19,9 @@ class Block:
             "id": -1,
             "prev_block_hash": -1,
             "nonce": 0,
-            "block_content_hash": block_content_hash
+            "block_content_hash": block_content_hash,
+            # Lets a lightnode check that a transaction is in the block from the header only, see merkle
+            "merkle_root": merkle.get_merkle_root([t.txhash for t in self.block_content])
         }
 
     def __eq__(self, other):
@@ -41,14 +41,22 @@ def sign_transaction(seed, transaction_hash):
     """This function returns the signature of a transaction hash, signed using a SigningKey generated
     using the seed, as well as the corresponding string-VerifyingKey."""
     signing_key = _get_signing_key(seed)  # aka private key
-    verifying_key = signing_key.get_verifying_key()  # aka public key
-    signature = signing_key.sign(bytes(transaction_hash, encoding="ascii"))
-    return signature, verifying_key.to_string()
+    return sign_with_key(signing_key, transaction_hash), signing_key.get_verifying_key().to_string()
+
+
+def sign_with_key(signing_key, transaction_hash):
+    """Returns the signature of a transaction hash with an already derived SigningKey, e.g. kept by a keyring."""
+    return signing_key.sign(bytes(transaction_hash, encoding="ascii"))
+
+
+def get_address_from_verifying_key(verifying_key_string):
+    """Returns the address corresponding to the verifying key, e.g. of the signer of a transaction."""
+    return hashlib.sha256(pickle.dumps(verifying_key_string)).hexdigest()
 
 
 def verify_address(address, verifying_key_string):
     """Returns True if the address corresponds to the verifying key."""
-    if address == hashlib.sha256(pickle.dumps(verifying_key_string)).hexdigest():
+    if address == get_address_from_verifying_key(verifying_key_string):
         return True
     return False
 
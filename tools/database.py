@@ -1,3 +1,4 @@
+import os
 import pickle
 
 _db_file_path = 0
@@ -25,7 +26,26 @@ def read_from_db():
     return db
 
 
+def open_db_file():
+    """Opens the database file to read it as is, e.g. to send the serialized database to a client. Since the file
+    is replaced at each write (see write_to_db), the opened file keeps the database as it was when opened, however
+    long it takes to read it. Returns the file and its size in bytes."""
+    db_file = open(_db_file_path, 'rb')
+    return db_file, os.fstat(db_file.fileno()).st_size
+
+
+def get_db_file_version():
+    """Returns what identifies the current content of the database file : since the file is replaced at each write
+    (see write_to_db), it changes whenever the database is written, e.g. by another process. Raises a
+    FileNotFoundError if there is no database yet."""
+    stat = os.stat(_db_file_path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
 def write_to_db(db):
-    """Replaces the block list with a new one in the database file."""
-    with open(_db_file_path, 'wb') as db_file:
+    """Replaces the block list with a new one in the database file. The new list is written to a temporary file
+    first, so that a concurrent reader never sees a partially written database."""
+    tmp_file_path = _db_file_path + '.tmp'
+    with open(tmp_file_path, 'wb') as db_file:
         pickle.dump(db, db_file)
+    os.replace(tmp_file_path, _db_file_path)
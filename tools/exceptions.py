@@ -18,3 +18,9 @@ class FullnodeError(Exception):
         self.log = log
         print(log)
 
+
+class MempoolError(Exception):
+    def __init__(self, log):
+        super().__init__()
+        self.log = log
+        print(log)
@@ -4,6 +4,9 @@ import pickle
 import random
 from tools import database, exceptions, validation
 
+# The hash of a mined block starts with this prefix
+PROOF_OF_WORK_PREFIX = "0000"
+
 
 def add_genesis_block(genesis_block):
     """(Re)sets the blockchain and adds the first block."""
@@ -35,18 +38,20 @@ def remove_last_block_from_db(block):
     database.write_to_db(valid_db)
 
 
-def mine_block(block):
-    """Returns a mined copy of the block, meaning the nonce is set so that the hash of the block is valid."""
+def mine_block(block, last_block=None):
+    """Returns a mined copy of the block, meaning the nonce is set so that the hash of the block is valid. The block
+    follows the last block of the chain, read from the database unless given (e.g. by a worker process)."""
 
     mined_block = copy.copy(block)
-    last_block = get_last_block()
+    if last_block is None:
+        last_block = get_last_block()
 
     mined_block.metadata["id"] = last_block.metadata["id"]+1
     mined_block.metadata["prev_block_hash"] = validation.get_block_hash(last_block)
 
     hash_candidate = "1"
 
-    while not hash_candidate.startswith("0000"):
+    while not hash_candidate.startswith(PROOF_OF_WORK_PREFIX):
         nonce = random.randint(0, 1000000)
         mined_block.metadata["nonce"] = nonce
         serialized_mined_block = pickle.dumps(block.metadata)
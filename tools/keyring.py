@@ -0,0 +1,68 @@
+from tools import crypto, exceptions
+import hashlib
+import hmac
+
+
+class Keyring:
+    """This class holds the keys of a wallet, derived from a single seed : the child key at index 0 is the key of the
+    seed itself, so that a wallet of one address keeps it, and the child key at index i > 0 the key of a child seed,
+    the HMAC of the index keyed by the seed (hierarchical deterministic addresses : the seed is all there is to back
+    up). Deriving a key pair costs a scalar multiplication on the curve, hence the signing keys, the verifying keys
+    and the addresses are derived once, then kept, and transactions signed with the kept keys."""
+
+    def __init__(self, seed):
+        self._seed = seed
+        self._keys = []  # index -> (signing key, verifying key string)
+        self._addresses = []  # index -> address
+        self._indexes = {}  # address -> index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, address):
+        return address in self._indexes
+
+    def get_child_seed(self, index):
+        """Returns the seed of the child key at the index, usable with the functions of crypto."""
+        if index == 0:
+            return self._seed
+        return hmac.new(self._seed.encode("ascii"), str(index).encode("ascii"), hashlib.sha256).hexdigest()
+
+    def derive(self, count):
+        """Derives the child keys up to the index count - 1, if not yet done, and returns their addresses."""
+
+        for index in range(len(self._keys), count):
+            signing_key = crypto._get_signing_key(self.get_child_seed(index))
+            verifying_key_string = signing_key.get_verifying_key().to_string()
+            address = crypto.get_address_from_verifying_key(verifying_key_string)
+            self._keys.append((signing_key, verifying_key_string))
+            self._addresses.append(address)
+            self._indexes[address] = index
+        return self._addresses[:count]
+
+    def get_address(self, index):
+        """Returns the address of the child key at the index, derived if need be."""
+        return self.derive(index + 1)[index]
+
+    def get_addresses(self):
+        """Returns the addresses derived so far, in the order of their indexes."""
+        return list(self._addresses)
+
+    def get_index(self, address):
+        """Returns the index of the child key of an address of the keyring, raises an APIError otherwise."""
+        try:
+            return self._indexes[address]
+        except KeyError:
+            raise exceptions.APIError("Address {} is not one of the keyring.".format(address))
+
+    def sign(self, transaction, address):
+        """Signs the transaction with the key of the address, as Transaction.sign does with its seed."""
+        signing_key, verifying_key_string = self._keys[self.get_index(address)]
+        transaction.signature = crypto.sign_with_key(signing_key, transaction.txhash)
+        transaction.verifying_key = verifying_key_string
+
+    def sign_transactions(self, transactions, addresses):
+        """Signs each transaction with the key of the address at the same position, i.e. the address whose outputs
+        the transaction spends."""
+        for transaction, address in zip(transactions, addresses):
+            self.sign(transaction, address)
@@ -1,44 +1,98 @@
-import pandas as pd
-from tools import classes, crypto, database, exceptions, validation
+from tools import chain_columns, chain_index, chain_sync, classes, database, exceptions
+
+# Outputs of a transaction of a batch payment, at most, change included
+MAX_OUTPUTS = 100
+# The coin selection of an address, unless set otherwise, see set_coin_selection
+DEFAULT_COIN_SELECTION = "branch_and_bound"
+# Steps of the search of select_branch_and_bound, at most
+BRANCH_AND_BOUND_TRIES = 100000
 
 
 def init_lightnode_api():
     global stack_of_used_inputs
-    global last_block_height
+    global _index
+    global _columns
 
     # When importing the lightnode_api, we keep the local state of the ledger after the last block.
     stack_of_used_inputs = []  # An UTXO is an output of a tx that is not yet used as input in another tx.
-    last_block_height = database.read_from_db()[-1].metadata["id"]
+    _index = chain_index.ChainIndex()  # The local copy of the chain, indexed
+    _columns = None  # (hash of the last block, the local copy of the chain in columns), see get_chain_columns
+    _load_chain()
 
 
-def get_database():
-    """Returns the whole blockchain as a list of blocks, and updates the local state in case of a new block."""
+def _load_chain():
+    """Loads the local copy of the chain from the database file, if any, into the index. Only the blocks that differ
+    from the ones already indexed are (un)indexed."""
+    global _db_version
+
+    try:
+        _db_version = database.get_db_file_version()
+        db = database.read_from_db()
+    except FileNotFoundError:  # Nothing received from a full node yet
+        _db_version = None
+        db = []
+
+    _index.update(db)
+    _release_used_inputs()
+
+
+def _release_used_inputs():
+    """The inputs we used in our own transactions are released once they are spent in the chain."""
     global stack_of_used_inputs
-    global last_block_height
+    stack_of_used_inputs = [inpt for inpt in stack_of_used_inputs if _index.get_spender(inpt) is None]
 
-    db = database.read_from_db()
 
-    if last_block_height < db[-1].metadata["id"]:  # A new block has been added
-        last_block_height = db[-1].metadata["id"]
-        stack_of_used_inputs = []  # We empty it since everything now appears in the blockchain
+def get_database():
+    """Returns the whole blockchain as a list of blocks, not to be modified. The local copy is kept in memory along
+    with its index, and only loaded again if the database file has been replaced meanwhile, e.g. by a
+    DatabaseRequest."""
 
-    return db
+    try:
+        db_version = database.get_db_file_version()
+    except FileNotFoundError:
+        db_version = None
+    if db_version != _db_version:
+        _load_chain()
 
+    return _index.blocks
 
-def get_transaction_by_txhash(tx_hash):
-    """Returns the transaction using its hash, raises a APIError otherwise."""
 
-    db = get_database()
+def get_locator():
+    """Returns the locator of the local copy of the chain (see chain_sync.get_locator), for a full node to send the
+    blocks we miss, see apply_chain_update. Empty if we have no block yet."""
+    get_database()
+    return chain_sync.get_locator_from_hashes(_index.block_hashes)
+
+
+def apply_chain_update(fork_height, blocks):
+    """Brings the local copy of the chain up to date with the blocks a full node sent, following the block at
+    fork_height of our copy (see chain_sync.get_chain_update). The blocks after fork_height, if any, are first
+    removed, e.g. when the full node has switched to another chain. Only the removed and the new blocks are
+    (un)indexed, and the database file is written only if the chain has changed."""
+    global _db_version
+
+    get_database()  # In case the database file has been replaced meanwhile
+    if fork_height == len(_index) - 1 and not blocks:
+        return
+
+    while len(_index) > fork_height + 1:
+        _index.remove_last_block()
+    for b in blocks:
+        _index.add_block(b)
+    _release_used_inputs()
+
+    database.write_to_db(_index.blocks)
+    _db_version = database.get_db_file_version()
+
 
-    # We loop through the blocks
-    for b in db:
-        # For each block
-        for t in b.block_content:
-            # For each transaction
-            if t.txhash == tx_hash:
-                return t
+def get_transaction_by_txhash(tx_hash):
+    """Returns the transaction using its hash, raises a APIError otherwise."""
 
-    raise exceptions.APIError("Cannot find transaction with txhash {}.".format(tx_hash))
+    get_database()
+    confirmed_transaction = _index.get_transaction(tx_hash)
+    if confirmed_transaction is None:
+        raise exceptions.APIError("Cannot find transaction with txhash {}.".format(tx_hash))
+    return confirmed_transaction[1]
 
 
 def get_amount_from_input(tx_hash, position):
@@ -57,127 +111,262 @@ def get_amount_from_input(tx_hash, position):
 
 
 def get_balance_from_address(address):
-    """Recovers the balance of an address, given the address."""
-    db = get_database()
-
-    # To construct a balance, we need the total output that point to it minus the inputs that come from it
-    balance_in = 0
-    balance_out = 0
-
-    # We loop through the blocks.
-    for b in db:
-        # For each block
-        for t in b.block_content:
-
-            # For each transaction
-            position_of_output = 0
-            stack_of_used_inputs_for_address = []
-            for addr in t.internals["dict_of_outputs"].keys():
-                if addr == address:
-                    balance_in += t.internals["dict_of_outputs"][addr]  # The amount in
-                    stack_of_used_inputs_for_address.append((t.txhash, position_of_output))
-                    position_of_output += 1
-
-            for tx_hash, pos in t.internals["dict_of_inputs"].items():
-                if (tx_hash, pos) in stack_of_used_inputs\
-                        and (tx_hash, pos) in stack_of_used_inputs_for_address:  # One of the inputs is not valid anymore
-                    balance_out += get_amount_from_input(tx_hash, pos)
-
-            if crypto.verify_address(address, t.verifying_key):
-                # The transaction has been signed with the key corresponding to the address : it is an output
-                for output_element in t.internals["dict_of_outputs"].values():
-                    balance_out += output_element
-
-    return balance_in-balance_out
+    """Recovers the balance of an address, given the address : the total of its unspent outputs."""
+    get_database()
+    return _index.get_balance(address)
 
 
 def get_valid_inputs_from_address(address):
     """Returns the list of valid inputs that can be used by an address in a transaction"""
-    db = get_database()
-
-    # We want a list of the transaction outputs that are still valid, in input form
-    all_inputs = []
-    used_inputs = []
-
-    # We loop through the blocks.
-    for b in db:
-        # For each block
-        for t in b.block_content:
-
-            # For each transaction
-            output_pos = 0
-            for addr_to_compare in t.internals["dict_of_outputs"].keys():
-                # If an output points to our address, we keep record of it
-                if addr_to_compare == address:
-                    all_inputs.append((t.txhash, output_pos))
-                output_pos += 1
-
-            if crypto.verify_address(address, t.verifying_key):
-                # The transaction has been signed with the key corresponding to the address : we are burning inputs
-                # We keep record of all the inputs (all of them come from our address)
-                for tx_hash, pos in t.internals["dict_of_inputs"].items():
-                    used_inputs.append((tx_hash, pos))
-
-    # We now have both lists completely, we just need the difference = the valid inputs
-    # We also make sure the stack of previously used inputs is taken into account
-    valid_inputs_list = list(set(all_inputs) - set(used_inputs) - set(stack_of_used_inputs))
+    get_database()
+
+    # The unspent outputs of the address, in input form, except the ones we already used in a transaction of ours
+    valid_inputs_list = list(set(_index.get_unspent_outputs(address)) - set(stack_of_used_inputs))
 
     return valid_inputs_list
 
 
 def create_transaction(from_address, to_address, amount=0):
     """Creates an unsigned transaction. If amount=0, it spends everything.
-    If not everything is spend, returns the remainder to the sender."""
+    If not everything is spend, returns the remainder to the sender. The inputs are chosen by the coin selection of
+    the sender, see set_coin_selection."""
     global stack_of_used_inputs
-    valid_inputs_list = get_valid_inputs_from_address(from_address)
-    balance = get_balance_from_address(from_address)
+    t = build_transaction(from_address, to_address, amount, get_spendable_outputs_from_address(from_address),
+                          get_coin_selection(from_address))
 
-    dict_of_inputs = {}
-    dict_of_outputs = {}
+    # We update the local state of the ledger to include the new tx.
+    for txhash, pos in t.internals["dict_of_inputs"].items():
+        stack_of_used_inputs.append((txhash, pos))
 
-    if amount == 0:  # We spend everything
-        for inpt in valid_inputs_list:
-            dict_of_inputs[inpt[0]] = inpt[1]
-        dict_of_outputs[to_address] = amount
-
-    if balance == amount:  # We spend everything
-        for inpt in valid_inputs_list:
-            dict_of_inputs[inpt[0]] = inpt[1]
-        dict_of_outputs[to_address] = amount
-
-    if balance > amount:  # We return part of the amount to the sender
-        for inpt in valid_inputs_list:
-            dict_of_inputs[inpt[0]] = inpt[1]  # Even when not spending all the balance, we burn all the inputs
-        dict_of_outputs[to_address] = amount
-        dict_of_outputs[from_address] = balance - amount
-
-    if balance < amount:
-        raise exceptions.APIError("Balance of address not sufficient to create transaction")
+    return t
 
-    for txhash, pos in dict_of_inputs.items():  # We update the local state of the ledger to include the new tx.
-        stack_of_used_inputs.append((txhash, pos))
 
-    if not dict_of_inputs:
+def build_transaction(from_address, to_address, amount, spendable_outputs, coin_selection=DEFAULT_COIN_SELECTION):
+    """Builds the unsigned transaction of create_transaction, given the {(txhash, position): amount} outputs the
+    sender can spend, e.g. as known by a lightnode in SPV mode (see spv_api), and the name of the coin selection
+    choosing the ones to spend (see COIN_SELECTIONS)."""
+
+    if sum(spendable_outputs.values()) < amount:
+        raise exceptions.APIError("Balance of address not sufficient to create transaction")
+
+    if amount == 0:  # We spend everything
+        selected_inputs = select_all(spendable_outputs, amount)
+    else:
+        selected_inputs = COIN_SELECTIONS[coin_selection](spendable_outputs, amount)
+    if not selected_inputs:
         raise exceptions.APIError("Trying to create a transaction with no inputs.")
 
+    input_amount = sum(spendable_outputs[inpt] for inpt in selected_inputs)
+    if input_amount < amount:  # Only the outputs of a same transaction are left, see _get_candidates
+        raise exceptions.APIError("Balance of address not sufficient to create transaction")
+
+    dict_of_inputs = dict(selected_inputs)
+    dict_of_outputs = {to_address: amount}
+    if input_amount > amount:  # We return part of the amount to the sender
+        dict_of_outputs[from_address] = dict_of_outputs.get(from_address, 0) + input_amount - amount
+
     return classes.Transaction(dict_of_inputs, dict_of_outputs)
 
 
+def _get_candidates(spendable_outputs):
+    """Returns the (input, amount) outputs a coin selection may spend, from the largest to the smallest. Since the
+    inputs of a transaction are keyed by txhash, it spends at most one output of a given transaction : the largest
+    one is kept."""
+
+    candidates = {}
+    for (tx_hash, pos), amount in spendable_outputs.items():
+        if tx_hash not in candidates or amount > candidates[tx_hash][1]:
+            candidates[tx_hash] = ((tx_hash, pos), amount)
+    return sorted(candidates.values(), key=lambda candidate: candidate[1], reverse=True)
+
+
+def select_all(spendable_outputs, amount):
+    """Coin selection spending every output, whatever the amount : the wallet is consolidated at each payment, at
+    the cost of large transactions."""
+    return [inpt for inpt, _ in _get_candidates(spendable_outputs)]
+
+
+def select_largest_first(spendable_outputs, amount):
+    """Coin selection spending the largest outputs first, until the amount is reached : few inputs, but a change
+    output nearly every time."""
+
+    selected_inputs = []
+    selected_amount = 0
+    for inpt, output_amount in _get_candidates(spendable_outputs):
+        if selected_amount >= amount:
+            break
+        selected_inputs.append(inpt)
+        selected_amount += output_amount
+    return selected_inputs
+
+
+def select_branch_and_bound(spendable_outputs, amount, max_tries=BRANCH_AND_BOUND_TRIES):
+    """Coin selection looking for outputs adding up to the amount exactly, so that the transaction has no change
+    output, by a depth-first search over the outputs from the largest, cut as soon as a branch exceeds the amount or
+    cannot reach it anymore. Falls back to select_largest_first if there is no exact match, or if none is found
+    within max_tries steps."""
+
+    candidates = _get_candidates(spendable_outputs)
+    amounts = [output_amount for _, output_amount in candidates]
+    remaining_amounts = [0] * (len(amounts) + 1)  # What the outputs from each position add up to
+    for i in reversed(range(len(amounts))):
+        remaining_amounts[i] = remaining_amounts[i + 1] + amounts[i]
+
+    selected = []  # Positions of the selected outputs, in increasing order
+    selected_amount = 0
+    i = 0  # Next output to include or exclude
+    for _ in range(max_tries):
+        if selected_amount == amount:
+            return [candidates[j][0] for j in selected]
+        if selected_amount > amount or selected_amount + remaining_amounts[i] < amount:
+            if not selected:
+                break  # Whole tree searched
+            # We go back to the last output included, and exclude it, as well as the following ones of the same
+            # amount, which would lead to the same sums
+            j = selected.pop()
+            selected_amount -= amounts[j]
+            i = j + 1
+            while i < len(amounts) and amounts[i] == amounts[j]:
+                i += 1
+        else:
+            selected.append(i)
+            selected_amount += amounts[i]
+            i += 1
+
+    return select_largest_first(spendable_outputs, amount)
+
+
+# The coin selections, by name. More can be added, as functions of the {input: amount} spendable outputs and of the
+# amount returning the inputs to spend
+COIN_SELECTIONS = {
+    "all": select_all,
+    "largest_first": select_largest_first,
+    "branch_and_bound": select_branch_and_bound
+}
+_coin_selections = {}  # address -> name of its coin selection, if not the default one
+
+
+def set_coin_selection(address, coin_selection):
+    """Sets the coin selection of the transactions of an address (see COIN_SELECTIONS), e.g. "all" for a wallet
+    receiving many small payments, which its payments consolidate."""
+    if coin_selection not in COIN_SELECTIONS:
+        raise exceptions.APIError("Unknown coin selection : {}.".format(coin_selection))
+    _coin_selections[address] = coin_selection
+
+
+def get_coin_selection(address):
+    return _coin_selections.get(address, DEFAULT_COIN_SELECTION)
+
+
+def create_consolidation(address, max_inputs=MAX_OUTPUTS):
+    """Creates an unsigned transaction spending the smallest outputs of an address, at most max_inputs of them, to
+    the address itself, e.g. when the wallet is idle : the following payments then need fewer inputs. Raises an
+    APIError if the address has less than two outputs to consolidate."""
+    global stack_of_used_inputs
+
+    candidates = _get_candidates(get_spendable_outputs_from_address(address))[::-1][:max_inputs]
+    if len(candidates) < 2:
+        raise exceptions.APIError("Nothing to consolidate for address {}.".format(address))
+
+    t = classes.Transaction(dict(inpt for inpt, _ in candidates),
+                            {address: sum(amount for _, amount in candidates)})
+    stack_of_used_inputs.extend(t.internals["dict_of_inputs"].items())
+    return t
+
+
+def get_spendable_outputs_from_address(address):
+    """Returns the {(txhash, position): amount} unspent outputs of an address that can be used in a transaction, i.e.
+    except the ones we already used in a transaction of ours."""
+    get_database()
+    spendable_outputs = _index.get_unspent_outputs(address)
+    for inpt in stack_of_used_inputs:
+        spendable_outputs.pop(inpt, None)
+    return spendable_outputs
+
+
+def create_batch_payment(from_address, payments, max_outputs=MAX_OUTPUTS):
+    """Creates the unsigned transactions paying many recipients from an address at once, given the (address, amount)
+    pairs of the payments. The inputs are selected from the unspent outputs of the address, looked up once, by the
+    coin selection of the address, and the payments split in as few transactions as possible, of at most max_outputs
+    outputs each, change included. Raises an APIError if the balance of the address is not sufficient : then no input
+    is marked as used."""
+    global stack_of_used_inputs
+    transactions = build_batch_payment(from_address, payments, get_spendable_outputs_from_address(from_address),
+                                       max_outputs, get_coin_selection(from_address))
+
+    # All the inputs at once, once all the transactions are built
+    for t in transactions:
+        stack_of_used_inputs.extend(t.internals["dict_of_inputs"].items())
+
+    return transactions
+
+
+def build_batch_payment(from_address, payments, spendable_outputs, max_outputs=MAX_OUTPUTS,
+                        coin_selection=DEFAULT_COIN_SELECTION):
+    """Builds the unsigned transactions of create_batch_payment, given the {(txhash, position): amount} outputs the
+    sender can spend, e.g. as known by a lightnode in SPV mode (see spv_api), and the name of the coin selection
+    (see COIN_SELECTIONS). The payments to a same address are added up."""
+
+    if max_outputs < 2:
+        raise exceptions.APIError("A transaction of a batch payment needs room for a payment and the change.")
+    amounts = {}
+    for to_address, amount in payments:
+        if amount <= 0:
+            raise exceptions.APIError("Trying to pay a non-positive amount to address {}.".format(to_address))
+        amounts[to_address] = amounts.get(to_address, 0) + amount
+    if not amounts:
+        raise exceptions.APIError("Trying to create a batch payment with no payments.")
+    if sum(amounts.values()) > sum(spendable_outputs.values()):
+        raise exceptions.APIError("Balance of address not sufficient to create batch payment")
+
+    available_outputs = dict(spendable_outputs)
+    recipients = list(amounts.items())
+    transactions = []
+    while recipients:
+        chunk = recipients[:max_outputs - 1]  # Room is kept for the change
+        recipients = recipients[len(chunk):]
+        chunk_amount = sum(amount for _, amount in chunk)
+
+        selected_inputs = COIN_SELECTIONS[coin_selection](available_outputs, chunk_amount)
+        input_amount = sum(available_outputs.pop(inpt) for inpt in selected_inputs)
+        if input_amount < chunk_amount:
+            # The change of the previous transactions of the batch cannot be spent, not being confirmed yet
+            raise exceptions.APIError("Balance of address not sufficient to create batch payment")
+
+        dict_of_outputs = dict(chunk)
+        if input_amount > chunk_amount:
+            dict_of_outputs[from_address] = dict_of_outputs.get(from_address, 0) + input_amount - chunk_amount
+        transactions.append(classes.Transaction(dict(selected_inputs), dict_of_outputs))
+
+    return transactions
+
+
+def get_chain_columns():
+    """Returns the local copy of the chain in columns, for analytics over the whole chain (see chain_columns). It is
+    only exported again once the chain has changed."""
+    global _columns
+
+    get_database()
+    tip_hash = _index.block_hashes[-1] if _index.block_hashes else None
+    if _columns is None or _columns[0] != tip_hash:
+        _columns = (tip_hash, chain_columns.export_chain(_index.blocks, _index.block_hashes))
+    return _columns[1]
+
+
+def get_all_balances():
+    """Returns the balances of all the addresses having unspent outputs, as a pandas Series indexed by address."""
+    return get_chain_columns().get_balances()
+
+
 def show_blockchain_summary():
-    list_of_blocks = get_database()
-    block_heights = []
-    block_hashes = []
-    prev_block_hashes = []
-    for b in list_of_blocks:
-        block_heights.append(b.metadata["id"])
-        block_hashes.append(validation.get_block_hash(b))
-        prev_block_hashes.append(b.metadata["prev_block_hash"])
-
-    table = pd.DataFrame()
-    table["Block Height"] = block_heights
-    table["Block Hash"] = block_hashes
-    table["Previous Block Hash"] = prev_block_hashes
-    table.set_index("Block Height", inplace=True)
+    table = get_chain_columns().get_summary()
+    print("###########################################")
+    print(table)
+    print("###########################################")
+
+
+def show_rich_list(n=10):
+    table = get_chain_columns().get_rich_list(n)
     print("###########################################")
     print(table)
-    print("###########################################")
\ No newline at end of file
+    print("###########################################")
@@ -0,0 +1,287 @@
+import collections
+import pickle
+import time
+from tools import exceptions
+
+
+class Mempool:
+    """This class holds the transactions received by a full node and not yet included in a block. Transactions are
+    indexed by txhash and by the outputs they spend, so that duplicates and double-spends are rejected on admission.
+    When the pool is full, the oldest transactions are evicted first."""
+    # An outpoint is a pair of (txhash, position) referencing the output of a previous transaction, i.e. an input
+
+    def __init__(self, max_transactions=1000, max_bytes=1000000):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+
+        # Ordered by admission, so that the first entry is always the oldest one (used for eviction)
+        self._entries = collections.OrderedDict()  # txhash -> {"transaction", "size", "admission_time"}
+        self._spent_outpoints = {}  # outpoint -> txhash of the transaction of the pool that spends it
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, txhash):
+        return txhash in self._entries
+
+    def get(self, txhash):
+        """Returns the transaction of the pool with the given hash, None if it is not in the pool."""
+        entry = self._entries.get(txhash)
+        if entry is None:
+            return None
+        return entry["transaction"]
+
+    def get_transactions(self, max_transactions=None, max_bytes=None):
+        """Returns the list of the transactions of the pool, oldest first. If limits are given, returns only the
+        oldest transactions that fit in them."""
+
+        transactions = []
+        selected_bytes = 0
+        for entry in self._entries.values():
+            if max_transactions is not None and len(transactions) >= max_transactions:
+                break
+            if max_bytes is not None and selected_bytes + entry["size"] > max_bytes:
+                break
+            transactions.append(entry["transaction"])
+            selected_bytes += entry["size"]
+        return transactions
+
+    def get_oldest_admission_time(self):
+        """Returns the time.monotonic() admission time of the oldest transaction of the pool, None if it is empty."""
+        for entry in self._entries.values():
+            return entry["admission_time"]
+        return None
+
+    def get_spender(self, outpoint):
+        """Returns the txhash of the transaction of the pool spending the outpoint, None if it is not spent."""
+        return self._spent_outpoints.get(outpoint)
+
+    def check(self, transaction):
+        """Raises a MempoolError if the transaction is already in the pool or if it spends an output already spent in
+        the pool. Cheap, so it can be called before the (costly) validation of the transaction."""
+
+        if transaction.txhash in self._entries:
+            raise exceptions.MempoolError("Transaction with hash {} is already in the mempool."
+                                          .format(transaction.txhash))
+
+        for outpoint in transaction.internals["dict_of_inputs"].items():
+            if outpoint in self._spent_outpoints:
+                raise exceptions.MempoolError("Transaction with hash {} conflicts with transaction with hash {} "
+                                              "of the mempool.".format(transaction.txhash,
+                                                                       self._spent_outpoints[outpoint]))
+
+    def add(self, transaction, size=None):
+        """Admits a transaction in the pool and returns the list of transactions evicted to make room for it. Raises
+        a MempoolError if the transaction is already in the pool or if it spends an output already spent in the
+        pool."""
+
+        if size is None:
+            size = len(pickle.dumps(transaction))
+
+        self.check(transaction)
+
+        if size > self.max_bytes:
+            raise exceptions.MempoolError("Transaction with hash {} is larger than the mempool."
+                                          .format(transaction.txhash))
+
+        # We make room for the new transaction by evicting the oldest ones, with the transactions spending from them.
+        # The evictions are planned first, since the transaction cannot be admitted without its parents of the pool
+        ancestors = self._get_ancestors(transaction)
+        txhashes_to_evict = []
+        remaining_transactions = len(self._entries)
+        remaining_bytes = self.total_bytes
+        for txhash in self._entries:
+            if remaining_transactions < self.max_transactions and remaining_bytes + size <= self.max_bytes:
+                break
+            if txhash in txhashes_to_evict:
+                continue  # Already evicted as the descendant of an older transaction
+
+            evicted_txhashes = self._get_descendants(txhash)
+            if ancestors.intersection(evicted_txhashes):
+                raise exceptions.MempoolError("Transaction with hash {} cannot be admitted, the mempool is full and "
+                                              "its parents would be evicted.".format(transaction.txhash))
+            for evicted_txhash in evicted_txhashes:
+                if evicted_txhash not in txhashes_to_evict:
+                    txhashes_to_evict.append(evicted_txhash)
+                    remaining_transactions -= 1
+                    remaining_bytes -= self._entries[evicted_txhash]["size"]
+
+        evicted_transactions = [self.remove(txhash) for txhash in txhashes_to_evict]
+
+        self._entries[transaction.txhash] = {
+            "transaction": transaction,
+            "size": size,
+            "admission_time": time.monotonic()
+        }
+        for outpoint in transaction.internals["dict_of_inputs"].items():
+            self._spent_outpoints[outpoint] = transaction.txhash
+        self.total_bytes += size
+
+        return evicted_transactions
+
+    def remove(self, txhash):
+        """Removes a transaction from the pool and returns it, None if it was not in the pool."""
+
+        entry = self._entries.pop(txhash, None)
+        if entry is None:
+            return None
+
+        transaction = entry["transaction"]
+        for outpoint in transaction.internals["dict_of_inputs"].items():
+            if self._spent_outpoints.get(outpoint) == txhash:
+                del self._spent_outpoints[outpoint]
+        self.total_bytes -= entry["size"]
+
+        return transaction
+
+    def remove_with_descendants(self, txhash):
+        """Removes a transaction from the pool, as well as the transactions of the pool spending its outputs (and so
+        on), since they cannot be confirmed without it. Returns the list of removed transactions."""
+        return [self.remove(descendant_txhash) for descendant_txhash in self._get_descendants(txhash)]
+
+    def _get_descendants(self, txhash):
+        """Returns the list of the txhashes of a transaction of the pool and of the transactions of the pool spending
+        its outputs (and so on), parents first. Empty if the transaction is not in the pool."""
+
+        descendants = []
+        txhashes_to_visit = [txhash]
+        while txhashes_to_visit:
+            visited_txhash = txhashes_to_visit.pop(0)
+            if visited_txhash in descendants or visited_txhash not in self._entries:
+                continue
+            descendants.append(visited_txhash)
+
+            transaction = self._entries[visited_txhash]["transaction"]
+            for position in range(len(transaction.internals["dict_of_outputs"])):
+                child_txhash = self._spent_outpoints.get((visited_txhash, position))
+                if child_txhash is not None:
+                    txhashes_to_visit.append(child_txhash)
+
+        return descendants
+
+    def _get_ancestors(self, transaction):
+        """Returns the set of the txhashes of the transactions of the pool a transaction spends from, directly or
+        not."""
+
+        ancestors = set()
+        transactions_to_visit = [transaction]
+        while transactions_to_visit:
+            for parent_txhash in transactions_to_visit.pop().internals["dict_of_inputs"]:
+                if parent_txhash in self._entries and parent_txhash not in ancestors:
+                    ancestors.add(parent_txhash)
+                    transactions_to_visit.append(self._entries[parent_txhash]["transaction"])
+
+        return ancestors
+
+    def remove_confirmed(self, block):
+        """Removes the transactions of the block from the pool, as well as the transactions of the pool that
+        conflict with them, since they can never be confirmed anymore. Returns the list of removed transactions."""
+
+        removed_transactions = []
+        for t in block.block_content:
+            if t.txhash in self._entries:
+                removed_transactions.append(self.remove(t.txhash))
+
+            # A transaction of the pool spending the same output as the block is a lost double-spend
+            for outpoint in t.internals["dict_of_inputs"].items():
+                conflicting_txhash = self._spent_outpoints.get(outpoint)
+                if conflicting_txhash is not None:
+                    removed_transactions.extend(self.remove_with_descendants(conflicting_txhash))
+
+        return removed_transactions
+
+    def clear(self):
+        """Removes every transaction from the pool."""
+        self._entries.clear()
+        self._spent_outpoints.clear()
+        self.total_bytes = 0
+
+
+class OrphanPool:
+    """This class holds the transactions spending outputs of transactions that the full node does not know yet,
+    neither in the chain nor in the mempool. They are indexed by missing parent txhash, and released when one of
+    their parents is admitted in the mempool or confirmed. The pool is bounded in count, the oldest orphans being
+    evicted first, and orphans expire after max_age seconds."""
+
+    def __init__(self, max_transactions=1000, max_age=600):
+        self.max_transactions = max_transactions
+        self.max_age = max_age
+
+        # Ordered by admission, so that the first entry is always the oldest one (used for eviction and expiry) :
+        # txhash -> {"transaction", "size", "missing_parents", "admission_time"}
+        self._entries = collections.OrderedDict()
+        self._orphans_by_parent = {}  # missing parent txhash -> set of txhashes of the orphans waiting for it
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, txhash):
+        return txhash in self._entries
+
+    def add(self, transaction, missing_parents, size=None):
+        """Holds a transaction until one of its missing parents is known. Returns the list of orphans evicted to make
+        room for it. Raises a MempoolError if the transaction is already held."""
+
+        if size is None:
+            size = len(pickle.dumps(transaction))
+
+        if transaction.txhash in self._entries:
+            raise exceptions.MempoolError("Transaction with hash {} is already in the orphan pool."
+                                          .format(transaction.txhash))
+
+        evicted_transactions = []
+        while len(self._entries) >= self.max_transactions:
+            oldest_txhash = next(iter(self._entries))
+            evicted_transactions.append(self.remove(oldest_txhash)["transaction"])
+
+        self._entries[transaction.txhash] = {
+            "transaction": transaction,
+            "size": size,
+            "missing_parents": set(missing_parents),
+            "admission_time": time.monotonic()
+        }
+        for parent_txhash in missing_parents:
+            self._orphans_by_parent.setdefault(parent_txhash, set()).add(transaction.txhash)
+
+        return evicted_transactions
+
+    def remove(self, txhash):
+        """Removes an orphan from the pool and returns its entry, None if it was not in the pool."""
+
+        entry = self._entries.pop(txhash, None)
+        if entry is None:
+            return None
+
+        for parent_txhash in entry["missing_parents"]:
+            orphans = self._orphans_by_parent.get(parent_txhash)
+            if orphans is not None:
+                orphans.discard(txhash)
+                if not orphans:
+                    del self._orphans_by_parent[parent_txhash]
+
+        return entry
+
+    def release(self, parent_txhash):
+        """Removes from the pool the orphans waiting for the given parent, and returns them as a list of
+        (transaction, size) pairs, oldest first. They should then be submitted again for admission, since they
+        may still miss another parent."""
+
+        released_entries = [self.remove(txhash) for txhash in list(self._orphans_by_parent.get(parent_txhash, ()))]
+        released_entries.sort(key=lambda entry: entry["admission_time"])
+        return [(entry["transaction"], entry["size"]) for entry in released_entries]
+
+    def expire(self, now=None):
+        """Removes the orphans older than max_age seconds and returns them."""
+
+        if now is None:
+            now = time.monotonic()
+
+        expired_transactions = []
+        while self._entries:
+            oldest_txhash, oldest_entry = next(iter(self._entries.items()))
+            if now - oldest_entry["admission_time"] < self.max_age:
+                break
+            expired_transactions.append(self.remove(oldest_txhash)["transaction"])
+
+        return expired_transactions
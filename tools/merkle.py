@@ -0,0 +1,50 @@
+import hashlib
+
+
+def _hash_pair(left_hash, right_hash):
+    return hashlib.sha256((left_hash + right_hash).encode("ascii")).hexdigest()
+
+
+def get_merkle_levels(txhashes):
+    """Returns the levels of the Merkle tree of the hashes of the transactions of a block, from the hashes themselves
+    up to the root. At each level, the hashes are hashed two by two, the last one with itself if they are odd in
+    number. A block without transactions has the hash of nothing as root."""
+
+    if not txhashes:
+        return [[hashlib.sha256(b"").hexdigest()]]
+
+    levels = [list(txhashes)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([_hash_pair(level[i], level[min(i + 1, len(level) - 1)]) for i in range(0, len(level), 2)])
+    return levels
+
+
+def get_merkle_root(txhashes):
+    """Returns the Merkle root of the hashes of the transactions of a block, kept in its metadata."""
+    return get_merkle_levels(txhashes)[-1][0]
+
+
+def get_merkle_proof(levels, index):
+    """Returns the Merkle proof of the transaction at the given index of a block, given the levels of the Merkle tree
+    of the block (see get_merkle_levels) : the hashes it is paired with, from its own level up to the root."""
+
+    proof = []
+    for level in levels[:-1]:
+        proof.append(level[min(index ^ 1, len(level) - 1)])
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(txhash, index, proof, merkle_root):
+    """Returns True if the Merkle proof leads from the hash of the transaction at the given index of a block to the
+    Merkle root of the block, i.e. if the transaction is in the block, False otherwise."""
+
+    current_hash = txhash
+    for paired_hash in proof:
+        if index % 2:
+            current_hash = _hash_pair(paired_hash, current_hash)
+        else:
+            current_hash = _hash_pair(current_hash, paired_hash)
+        index //= 2
+    return index == 0 and current_hash == merkle_root
@@ -0,0 +1,185 @@
+from tools import chain_sync, database, exceptions, lightnode_api, merkle, validation
+
+
+def init_spv_api(addresses):
+    """Simplified payment verification (SPV) mode of a lightnode : it only keeps the headers of the chain, checked as
+    they are received (proof of work and linkage), and the transactions concerning the given addresses, each proven
+    to be in a block of the chain by its Merkle proof. Both are kept in the local database."""
+    global stack_of_used_inputs
+    global _addresses
+
+    stack_of_used_inputs = []  # As in lightnode_api, the inputs used by our transactions not yet in the chain
+    _addresses = set(addresses)
+    _load_state()
+
+
+def _load_state():
+    """Loads the headers and the proven transactions from the database file, if any, and indexes them."""
+    global _headers, _header_hashes, _proven_transactions, _proofs_height
+
+    _headers = []
+    _header_hashes = []
+    _proven_transactions = {}  # txhash -> (height, index in the block, transaction)
+    _proofs_height = -1  # The height up to which we have the transactions concerning our addresses
+    try:
+        state = database.read_from_db()
+    except FileNotFoundError:  # Nothing received from a full node yet
+        state = None
+
+    if state is not None:
+        _headers = state["headers"]
+        _header_hashes = [validation.get_header_hash(header) for header in _headers]
+        _proven_transactions = state["transactions"]
+        # The transactions of new addresses are requested from the start of the chain
+        _proofs_height = state["proofs_height"] if _addresses.issubset(state["addresses"]) else -1
+    _index_transactions()
+
+
+def _save_state():
+    database.write_to_db({"headers": _headers, "transactions": _proven_transactions,
+                          "proofs_height": _proofs_height, "addresses": sorted(_addresses)})
+
+
+def _index_transactions():
+    """Indexes the proven transactions, in the order of the chain, in the manner of lightnode_api : by hash, and the
+    unspent outputs by address. The inputs we used are released once spent by a proven transaction."""
+    global _transactions, _unspent_outputs, stack_of_used_inputs
+
+    _transactions = {}
+    _unspent_outputs = {}
+    spent_inputs = set()
+    for height, index, t in sorted(_proven_transactions.values(), key=lambda proven: proven[:2]):
+        _transactions[t.txhash] = t
+        for tx_hash, pos in t.internals["dict_of_inputs"].items():
+            spent_inputs.add((tx_hash, pos))
+            if tx_hash in _transactions:  # Otherwise an output of another address, paying one of ours
+                address = list(_transactions[tx_hash].internals["dict_of_outputs"])[pos]
+                _unspent_outputs.get(address, {}).pop((tx_hash, pos), None)
+        for pos, (address, amount) in enumerate(t.internals["dict_of_outputs"].items()):
+            if address in _addresses:
+                _unspent_outputs.setdefault(address, {})[(t.txhash, pos)] = amount
+
+    stack_of_used_inputs = [inpt for inpt in stack_of_used_inputs if inpt not in spent_inputs]
+
+
+def get_locator():
+    """Returns the locator of our headers, for a full node to send the headers we miss, see apply_header_update."""
+    return chain_sync.get_locator_from_hashes(_header_hashes)
+
+
+def get_height():
+    """Returns the height of the last header, -1 if we have none yet."""
+    return len(_headers) - 1
+
+
+def get_addresses():
+    return sorted(_addresses)
+
+
+def get_proofs_height():
+    """Returns the height up to which we have the transactions concerning our addresses, see apply_merkle_proofs."""
+    return _proofs_height
+
+
+def apply_header_update(fork_height, headers):
+    """Brings our headers up to date with the headers a full node sent, following the block at fork_height (see
+    chain_sync.get_header_update). They must follow one another from our header at fork_height, with a valid proof
+    of work each, and make a better chain than ours : a ValidationError is raised otherwise. Our headers after
+    fork_height, if any, are replaced, and the transactions proven in their blocks dropped. The first header
+    received, the genesis block, is trusted."""
+    global _headers, _header_hashes, _proofs_height, _proven_transactions
+
+    if not headers:
+        return
+    if fork_height >= len(_headers) or (fork_height < 0 and _headers):
+        raise exceptions.ValidationError("Received headers do not follow any of our headers.")
+
+    if fork_height < 0:
+        chain_sync.check_header_chain(headers[1:], 0, validation.get_header_hash(headers[0]))
+    else:
+        chain_sync.check_header_chain(headers, fork_height, _header_hashes[fork_height])
+
+    new_header_hashes = _header_hashes[:fork_height + 1] + [validation.get_header_hash(header) for header in headers]
+    if _headers and not chain_sync.is_better_tip(len(new_header_hashes), new_header_hashes[-1], len(_headers),
+                                                 _header_hashes[-1]):
+        raise exceptions.ValidationError("Received headers do not make a better chain than ours.")
+
+    _headers = _headers[:fork_height + 1] + headers
+    _header_hashes = new_header_hashes
+    if _proofs_height > fork_height:
+        _proofs_height = fork_height
+        _proven_transactions = {txhash: proven for txhash, proven in _proven_transactions.items()
+                                if proven[0] <= fork_height}
+        _index_transactions()
+    _save_state()
+
+
+def apply_merkle_proofs(proofs, to_height):
+    """Keeps the transactions concerning our addresses a full node sent, up to to_height (see
+    chain_sync.get_merkle_proofs). Each of them must match its hash, and its Merkle proof lead to the Merkle root of
+    our header at its height : a ValidationError is raised otherwise, e.g. if the chain of the full node has changed
+    meanwhile."""
+    global _proofs_height
+
+    if to_height >= len(_headers):
+        raise exceptions.ValidationError("Merkle proofs received for blocks whose headers we do not have.")
+
+    for proof in proofs:
+        t = proof["transaction"]
+        height = proof["height"]
+        if not _proofs_height < height <= to_height or validation.get_tx_hash(t) != t.txhash \
+                or not merkle.verify_merkle_proof(t.txhash, proof["index"], proof["proof"],
+                                                  _headers[height].get("merkle_root")):
+            raise exceptions.ValidationError("Invalid Merkle proof received for transaction with hash {}."
+                                             .format(t.txhash))
+
+    for proof in proofs:
+        _proven_transactions[proof["transaction"].txhash] = (proof["height"], proof["index"], proof["transaction"])
+    _proofs_height = max(_proofs_height, to_height)
+    _index_transactions()
+    _save_state()
+
+
+def get_transaction_by_txhash(tx_hash):
+    """Returns the proven transaction using its hash, raises a APIError otherwise."""
+    try:
+        return _transactions[tx_hash]
+    except KeyError:
+        raise exceptions.APIError("Cannot find transaction with txhash {}.".format(tx_hash))
+
+
+def get_balance_from_address(address):
+    """Recovers the balance of one of our addresses : the total of its unspent outputs."""
+    return sum(_unspent_outputs.get(address, {}).values())
+
+
+def get_valid_inputs_from_address(address):
+    """Returns the list of valid inputs that can be used by one of our addresses in a transaction"""
+    return list(set(_unspent_outputs.get(address, {})) - set(stack_of_used_inputs))
+
+
+def get_spendable_outputs_from_address(address):
+    """Returns the {(txhash, position): amount} unspent outputs of one of our addresses that can be used in a
+    transaction, see lightnode_api.get_spendable_outputs_from_address."""
+    used_inputs = set(stack_of_used_inputs)
+    return {inpt: amount for inpt, amount in _unspent_outputs.get(address, {}).items() if inpt not in used_inputs}
+
+
+def create_transaction(from_address, to_address, amount=0):
+    """Creates an unsigned transaction from one of our addresses, see lightnode_api.create_transaction."""
+    t = lightnode_api.build_transaction(from_address, to_address, amount,
+                                        get_spendable_outputs_from_address(from_address),
+                                        lightnode_api.get_coin_selection(from_address))
+    stack_of_used_inputs.extend(t.internals["dict_of_inputs"].items())
+    return t
+
+
+def create_batch_payment(from_address, payments, max_outputs=lightnode_api.MAX_OUTPUTS):
+    """Creates the unsigned transactions paying many recipients from one of our addresses at once, see
+    lightnode_api.create_batch_payment."""
+    transactions = lightnode_api.build_batch_payment(from_address, payments,
+                                                     get_spendable_outputs_from_address(from_address), max_outputs,
+                                                     lightnode_api.get_coin_selection(from_address))
+    for t in transactions:
+        stack_of_used_inputs.extend(t.internals["dict_of_inputs"].items())
+    return transactions
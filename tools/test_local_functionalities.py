@@ -1,6 +1,18 @@
-from tools import classes, crypto, database, exceptions, fullnode_api, validation
+from network import framing, fullnode_connections, fullnode_processing, fullnode_socket_manager, fullnode_workers, \
+    json_tools, lightnode, lightnode_connections, memory_transport, peer_manager, response_cache
+from tools import block_assembly, chain_columns, chain_index, chain_sync, classes, crypto, database, exceptions, \
+    fullnode_api, keyring, lightnode_api, mempool, merkle, spv_api, validation
+import asyncio
+import contextlib
+import gzip
 import hashlib
+import io
+import os
 import pickle
+import selectors
+import socket
+import tempfile
+import threading
 import unittest
 
 
@@ -104,6 +116,42 @@ class TransactionTests(unittest.TestCase):
         database.reinit_database_path()
 
 
+class KeyringTests(unittest.TestCase):
+    """Keys derived from a single seed tests."""
+
+    def setUp(self):
+        self.seed = crypto.new_seed()
+        self.keyring = keyring.Keyring(self.seed)
+
+    def test_derivation(self):
+        addresses = self.keyring.derive(3)
+        self.assertEqual(3, len(set(addresses)))
+        # The first key is the key of the seed, and the others are those of the child seeds
+        self.assertEqual(crypto.get_address(self.seed), addresses[0])
+        self.assertEqual(crypto.get_address(self.keyring.get_child_seed(2)), addresses[2])
+        # Derived again from the same seed
+        self.assertEqual(addresses, keyring.Keyring(self.seed).derive(3))
+        self.assertEqual(addresses[1], self.keyring.get_address(1))
+        self.assertEqual(5, len(self.keyring.derive(5)))
+        self.assertEqual(addresses, self.keyring.get_addresses()[:3])
+
+    def test_signing(self):
+        addresses = self.keyring.derive(2)
+        transactions = [classes.Transaction({}, {address: 1}) for address in addresses]
+        self.keyring.sign_transactions(transactions, addresses)
+        for t, address in zip(transactions, addresses):
+            self.assertTrue(crypto.verify_signing(t.txhash, t.signature, t.verifying_key))
+            self.assertTrue(crypto.verify_address(address, t.verifying_key))
+
+        # The same verifying key as when signed with the seed
+        t = classes.Transaction({}, {addresses[0]: 2})
+        t.sign(self.keyring.get_child_seed(1))
+        self.assertEqual(transactions[1].verifying_key, t.verifying_key)
+
+        with self.assertRaises(exceptions.APIError):
+            self.keyring.sign(t, crypto.get_address(crypto.new_seed()))
+
+
 class BlockTests(unittest.TestCase):
     """Block mining and chaining tests."""
 
@@ -336,11 +384,1019 @@ class ValidationTests(unittest.TestCase):
         with self.assertRaises(exceptions.ValidationError):
             validation.validate_block(second_mined_block)
 
+    def test_transaction_validation_cache(self):
+        # (Re)Starting from GenBlock
+        genesis_block = classes.GenesisBlock(self.address)
+        fullnode_api.add_genesis_block(genesis_block)
+
+        # Tx1 -> valid, admitted before Tx2 spends the same output in a new block
+        dict_of_inputs = {genesis_block.block_content[0].txhash: 0}
+        first_tx = classes.Transaction(dict_of_inputs, {self.address2: 100})
+        first_tx.sign(self.seed)
+        self.assertTrue(validation.validate_transaction(first_tx))
+
+        # Unsigned version of the same transaction : the kept result must not be reused
+        with self.assertRaises(exceptions.ValidationError):
+            validation.validate_block(classes.Block([classes.Transaction(dict_of_inputs, {self.address2: 100})]))
+
+        # Tx2 -> spends the same output, and is confirmed first
+        second_tx = classes.Transaction(dict_of_inputs, {self.address: 100})
+        second_tx.sign(self.seed)
+        fullnode_api.add_block_to_db(fullnode_api.mine_block(classes.Block([second_tx])))
+
+        # The new tip has spent the input of Tx1
+        with self.assertRaises(exceptions.ValidationError):
+            validation.validate_block(classes.Block([first_tx]))
+
+        validation.forget_transaction(first_tx.txhash)
+        self.assertNotIn(first_tx.txhash, validation._validated_transactions)
+
+    def test_unconfirmed_parent(self):
+        # (Re)Starting from GenBlock
+        genesis_block = classes.GenesisBlock(self.address)
+        fullnode_api.add_genesis_block(genesis_block)
+        pool = mempool.Mempool()
+
+        # Tx1 -> admitted in the mempool, not yet confirmed
+        first_tx = classes.Transaction({genesis_block.block_content[0].txhash: 0}, {self.address2: 100})
+        first_tx.sign(self.seed)
+        validation.validate_transaction(first_tx, unconfirmed_transactions=pool)
+        pool.add(first_tx)
+
+        # Tx2 -> spends the output of Tx1, which is unknown without the mempool
+        second_tx = classes.Transaction({first_tx.txhash: 0}, {self.address: 100})
+        second_tx.sign(self.seed2)
+        self.assertEqual({first_tx.txhash}, validation.get_missing_parents(second_tx))
+        self.assertEqual(set(), validation.get_missing_parents(second_tx, unconfirmed_transactions=pool))
+        self.assertTrue(validation.validate_transaction(second_tx, unconfirmed_transactions=pool))
+
+        # Both can be confirmed in the same block, but only with the parent first
+        self.assertTrue(validation.validate_block(classes.Block([first_tx, second_tx])))
+        with self.assertRaises(exceptions.ValidationError):
+            validation.validate_block(classes.Block([second_tx]))
+
+        validation.clear_validation_cache()
+
     def tearDown(self):
         # We reset the database to the initial (empty) value.
         database.reinit_database_path()
 
 
+class MempoolTests(unittest.TestCase):
+    """Mempool admission and eviction tests."""
+
+    def setUp(self):
+        self.address = crypto.get_address(crypto.new_seed())
+        self.mempool = mempool.Mempool(max_transactions=3, max_bytes=100000)
+
+        # Three transactions spending different (fake) outputs, and one spending the same output as the first one
+        self.first_tx = classes.Transaction({"a" * 64: 0}, {self.address: 10})
+        self.second_tx = classes.Transaction({"b" * 64: 0}, {self.address: 20})
+        self.third_tx = classes.Transaction({"c" * 64: 0}, {self.address: 30})
+        self.conflicting_tx = classes.Transaction({"a" * 64: 0}, {self.address: 40})
+
+    def test_duplicate(self):
+        self.mempool.add(self.first_tx)
+        with self.assertRaises(exceptions.MempoolError):
+            self.mempool.add(self.first_tx)
+        self.assertEqual(1, len(self.mempool))
+
+    def test_double_spend(self):
+        self.mempool.add(self.first_tx)
+        with self.assertRaises(exceptions.MempoolError):
+            self.mempool.add(self.conflicting_tx)
+        self.assertNotIn(self.conflicting_tx.txhash, self.mempool)
+
+    def test_eviction(self):
+        self.mempool.add(self.first_tx)
+        self.mempool.add(self.second_tx)
+        self.mempool.add(self.third_tx)
+
+        # The pool is full, the oldest transaction is evicted and its output is not spent in the pool anymore
+        evicted_transactions = self.mempool.add(classes.Transaction({"d" * 64: 0}, {self.address: 40}))
+        self.assertEqual([self.first_tx], evicted_transactions)
+        self.assertEqual(3, len(self.mempool))
+        self.assertIsNone(self.mempool.get_spender(("a" * 64, 0)))
+
+    def test_eviction_of_parent(self):
+        small_mempool = mempool.Mempool(max_transactions=2, max_bytes=100000)
+        small_mempool.add(self.first_tx)
+        small_mempool.add(self.second_tx)
+
+        # Making room for the child would evict its parent, the oldest transaction : it is refused instead
+        child_tx = classes.Transaction({self.first_tx.txhash: 0}, {self.address: 10})
+        with self.assertRaises(exceptions.MempoolError):
+            small_mempool.add(child_tx)
+        self.assertEqual([self.first_tx, self.second_tx], small_mempool.get_transactions())
+
+    def test_remove_confirmed(self):
+        self.mempool.add(self.first_tx)
+        self.mempool.add(self.second_tx)
+
+        # A block confirming the first transaction and spending the output of the second one
+        block = classes.Block([self.first_tx, classes.Transaction({"b" * 64: 0}, {self.address: 50})])
+        removed_transactions = self.mempool.remove_confirmed(block)
+
+        self.assertEqual([self.first_tx, self.second_tx], removed_transactions)
+        self.assertEqual(0, len(self.mempool))
+        self.assertEqual(0, self.mempool.total_bytes)
+
+    def test_remove_with_descendants(self):
+        self.mempool.add(self.first_tx)
+        child_tx = classes.Transaction({self.first_tx.txhash: 0}, {self.address: 10})
+        self.mempool.add(child_tx)
+        self.mempool.add(self.second_tx)
+
+        self.assertEqual([self.first_tx, child_tx], self.mempool.remove_with_descendants(self.first_tx.txhash))
+        self.assertEqual([self.second_tx], self.mempool.get_transactions())
+
+
+class OrphanPoolTests(unittest.TestCase):
+    """Orphan pool tests."""
+
+    def setUp(self):
+        self.address = crypto.get_address(crypto.new_seed())
+        self.orphan_pool = mempool.OrphanPool(max_transactions=2, max_age=60)
+
+        self.first_orphan = classes.Transaction({"a" * 64: 0}, {self.address: 10})
+        self.second_orphan = classes.Transaction({"a" * 64: 1, "b" * 64: 0}, {self.address: 20})
+        self.third_orphan = classes.Transaction({"c" * 64: 0}, {self.address: 30})
+
+    def test_release(self):
+        self.orphan_pool.add(self.first_orphan, {"a" * 64})
+        self.orphan_pool.add(self.second_orphan, {"a" * 64, "b" * 64})
+
+        released_transactions = [t for t, size in self.orphan_pool.release("a" * 64)]
+        self.assertEqual([self.first_orphan, self.second_orphan], released_transactions)
+        self.assertEqual(0, len(self.orphan_pool))
+        self.assertEqual([], self.orphan_pool.release("b" * 64))
+
+    def test_bound_and_expiry(self):
+        self.orphan_pool.add(self.first_orphan, {"a" * 64})
+        self.orphan_pool.add(self.second_orphan, {"a" * 64, "b" * 64})
+
+        # The pool is full, the oldest orphan is evicted
+        self.assertEqual([self.first_orphan], self.orphan_pool.add(self.third_orphan, {"c" * 64}))
+        self.assertNotIn(self.first_orphan.txhash, self.orphan_pool)
+
+        # Far in the future, every orphan has expired
+        expired_transactions = self.orphan_pool.expire(now=self.orphan_pool._entries[self.third_orphan.txhash]
+                                                       ["admission_time"] + 60)
+        self.assertEqual([self.second_orphan, self.third_orphan], expired_transactions)
+        self.assertEqual([], self.orphan_pool.release("c" * 64))
+
+
+class BlockAssemblyTests(unittest.TestCase):
+    """Block assembly policy tests."""
+
+    def setUp(self):
+        self.address = crypto.get_address(crypto.new_seed())
+        self.mempool = mempool.Mempool()
+        self.policy = block_assembly.BlockAssemblyPolicy(max_transactions=3, max_bytes=100000, max_wait=10)
+
+        for i in range(5):
+            self.mempool.add(classes.Transaction({str(i) * 64: 0}, {self.address: 10}))
+
+    def test_count_threshold(self):
+        self.assertTrue(self.policy.is_ready(self.mempool))
+        self.assertEqual(self.mempool.get_transactions()[:3], self.policy.select_transactions(self.mempool))
+
+    def test_wait_threshold(self):
+        single_tx_mempool = mempool.Mempool()
+        single_tx_mempool.add(classes.Transaction({"a" * 64: 0}, {self.address: 10}))
+        admission_time = single_tx_mempool.get_oldest_admission_time()
+
+        self.assertFalse(self.policy.is_ready(single_tx_mempool, now=admission_time + 1))
+        self.assertTrue(self.policy.is_ready(single_tx_mempool, now=admission_time + 10))
+
+    def test_size_threshold(self):
+        transactions = self.mempool.get_transactions()
+        one_tx_bytes = len(pickle.dumps(transactions[0]))
+        small_policy = block_assembly.BlockAssemblyPolicy(max_transactions=10, max_bytes=2 * one_tx_bytes)
+
+        self.assertTrue(small_policy.is_ready(self.mempool))
+        self.assertEqual(transactions[:2], small_policy.select_transactions(self.mempool))
+
+    def test_transaction_larger_than_block(self):
+        one_tx_bytes = len(pickle.dumps(self.mempool.get_transactions()[0]))
+        small_policy = block_assembly.BlockAssemblyPolicy(max_transactions=10, max_bytes=one_tx_bytes - 1)
+
+        # No empty block is assembled, even though the mempool holds more bytes than a block
+        self.assertFalse(small_policy.fits_in_block(one_tx_bytes))
+        self.assertFalse(small_policy.is_ready(self.mempool))
+
+
+class ChainSyncTests(unittest.TestCase):
+    """Header-first synchronization tests."""
+
+    def setUp(self):
+        self.address = crypto.get_address(crypto.new_seed())
+
+        # Db
+        self.db_path = 'database/db_test'
+        database.init_database_path(self.db_path)
+
+        # GenBlock and 3 mined blocks
+        fullnode_api.add_genesis_block(classes.GenesisBlock(self.address))
+        for i in range(3):
+            block = classes.Block([classes.Transaction({str(i) * 64: 0}, {self.address: 100})])
+            fullnode_api.add_block_to_db(fullnode_api.mine_block(block))
+        self.db = fullnode_api.get_database()
+
+    def test_fork_point(self):
+        locator = chain_sync.get_locator(self.db)
+        self.assertEqual([validation.get_block_hash(b) for b in reversed(self.db)], locator)
+
+        # A neighbor with the first 2 blocks only and another block of its own
+        self.assertEqual(1, chain_sync.find_fork_point(self.db, ["f" * 64] + locator[2:]))
+        self.assertIsNone(chain_sync.find_fork_point(self.db, ["f" * 64]))
+
+    def test_better_chain(self):
+        tip_hash = validation.get_block_hash(self.db[-1])
+        self.assertTrue(chain_sync.is_better_chain(len(self.db) + 1, "f" * 64, self.db))
+        self.assertFalse(chain_sync.is_better_chain(len(self.db) - 1, "0" * 64, self.db))
+        # Between chains of the same length, the smallest tip hash wins
+        self.assertTrue(chain_sync.is_better_chain(len(self.db), "0" * 64, self.db))
+        self.assertFalse(chain_sync.is_better_chain(len(self.db), tip_hash, self.db))
+
+    def test_headers(self):
+        headers = chain_sync.get_headers(self.db, 1)
+        self.assertEqual(2, len(headers))
+        self.assertEqual(1, chain_sync.check_headers(self.db[:2], headers))
+
+        # A header that has not been mined
+        headers[-1] = dict(headers[-1], nonce=headers[-1]["nonce"] + 1)
+        with self.assertRaises(exceptions.ValidationError):
+            chain_sync.check_headers(self.db[:2], headers)
+
+    def test_blocks(self):
+        headers = chain_sync.get_headers(self.db, 1)
+        blocks = chain_sync.get_blocks(self.db, [validation.get_header_hash(header) for header in headers])
+        chain_sync.check_blocks(pickle.loads(pickle.dumps(blocks)), headers)
+
+        # A block whose content is not the one of its header
+        blocks[0] = classes.Block([classes.Transaction({"f" * 64: 0}, {self.address: 100})])
+        blocks[0].metadata = headers[0]
+        with self.assertRaises(exceptions.ValidationError):
+            chain_sync.check_blocks(blocks, headers)
+
+    def test_compact_blocks(self):
+        headers = chain_sync.get_headers(self.db, 1)
+        block_hashes = [validation.get_header_hash(header) for header in headers]
+        compact_blocks = pickle.loads(pickle.dumps(chain_sync.get_compact_blocks(self.db, block_hashes)))
+
+        # Only the transaction of the first block is in our mempool
+        t = self.db[2].block_content[0]
+        contents, missing = chain_sync.rebuild_block_contents(compact_blocks, {chain_sync.get_short_id(t.txhash): t})
+        self.assertEqual({block_hashes[1]: [0]}, missing)
+        with self.assertRaises(exceptions.ValidationError):
+            chain_sync.fill_compact_blocks(compact_blocks, contents, {})
+
+        block_transactions = pickle.loads(pickle.dumps(chain_sync.get_block_transactions(self.db, missing)))
+        blocks = chain_sync.fill_compact_blocks(compact_blocks, contents, block_transactions)
+        chain_sync.check_blocks(blocks, headers)
+        self.assertEqual(self.db[2:], blocks)
+
+    def tearDown(self):
+        # We reset the database to the initial (empty) value.
+        database.reinit_database_path()
+
+
+class LightnodeApiTests(unittest.TestCase):
+    """Local copy of the chain of a lightnode tests, kept up to date with the chain updates of a full node."""
+
+    def setUp(self):
+        self.seed = crypto.new_seed()
+        self.address = crypto.get_address(self.seed)
+        self.address2 = crypto.get_address(crypto.new_seed())
+
+        # Db of the lightnode, empty
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        database.init_database_path(os.path.join(self.directory.name, "db"))
+        lightnode_api.init_lightnode_api()
+
+        # The chain of the full node : the genesis output is spent, 60 to address2 and 40 back to address
+        genesis_block = classes.GenesisBlock(self.address)
+        self.spending_tx = classes.Transaction({genesis_block.block_content[0].txhash: 0},
+                                               {self.address2: 60, self.address: 40})
+        self.db = [genesis_block, self._chain_block([self.spending_tx], genesis_block)]
+
+    @staticmethod
+    def _chain_block(block_content, previous_block):
+        block = classes.Block(block_content)
+        block.metadata["id"] = previous_block.metadata["id"] + 1
+        block.metadata["prev_block_hash"] = validation.get_block_hash(previous_block)
+        return block
+
+    def _synchronize(self, db):
+        chain_update = chain_sync.get_chain_update(db, lightnode_api.get_locator())
+        lightnode_api.apply_chain_update(chain_update["fork_height"], chain_update["blocks"])
+        return chain_update
+
+    def test_chain_update(self):
+        self.assertEqual([], lightnode_api.get_locator())
+        self.assertEqual(-1, self._synchronize(self.db)["fork_height"])
+        self.assertEqual(self.db, lightnode_api.get_database())
+        self.assertEqual(40, lightnode_api.get_balance_from_address(self.address))
+        self.assertEqual(60, lightnode_api.get_balance_from_address(self.address2))
+
+        # Up to date : nothing is sent
+        self.assertEqual([], self._synchronize(self.db)["blocks"])
+
+        # The full node switches to another chain, where the genesis output is not spent
+        fork_db = [self.db[0], self._chain_block([classes.Transaction({}, {self.address2: 100})], self.db[0])]
+        chain_update = self._synchronize(fork_db)
+        self.assertEqual((0, 1), (chain_update["fork_height"], len(chain_update["blocks"])))
+        self.assertEqual(100, lightnode_api.get_balance_from_address(self.address))
+        self.assertEqual(100, lightnode_api.get_balance_from_address(self.address2))
+        with self.assertRaises(exceptions.APIError):
+            lightnode_api.get_transaction_by_txhash(self.spending_tx.txhash)
+
+        # The local copy is kept on disk
+        self.assertEqual(fork_db, database.read_from_db())
+        lightnode_api.init_lightnode_api()
+        self.assertEqual(fork_db, lightnode_api.get_database())
+
+    def test_used_inputs(self):
+        self._synchronize(self.db[:1])
+        t = lightnode_api.create_transaction(self.address, self.address2, amount=60)
+        self.assertEqual([], lightnode_api.get_valid_inputs_from_address(self.address))
+
+        # Once the transaction is confirmed, its inputs are spent in the chain, and the change can be spent
+        self.assertEqual(self.spending_tx.txhash, t.txhash)
+        self._synchronize(self.db)
+        self.assertEqual([], lightnode_api.stack_of_used_inputs)
+        self.assertEqual([(t.txhash, 1)], lightnode_api.get_valid_inputs_from_address(self.address))
+
+    def test_batch_payment(self):
+        # Outputs of 50, 30 and 20 for address, besides the 40 of the spending transaction
+        funding_txs = [classes.Transaction({}, {self.address: amount}) for amount in (50, 30, 20)]
+        self._synchronize(self.db + [self._chain_block(funding_txs, self.db[-1])])
+        recipients = [crypto.get_address(str(n)) for n in range(5)]
+        lightnode_api.set_coin_selection(self.address, "largest_first")
+
+        payments = [(recipient, 10) for recipient in recipients] + [(recipients[0], 5)]
+        transactions = lightnode_api.create_batch_payment(self.address, payments, max_outputs=4)
+        self.assertEqual(2, len(transactions))
+        self.assertEqual({recipients[0]: 15, recipients[1]: 10, recipients[2]: 10, self.address: 15},
+                         transactions[0].internals["dict_of_outputs"])
+        self.assertEqual({recipients[3]: 10, recipients[4]: 10, self.address: 20},
+                         transactions[1].internals["dict_of_outputs"])
+        # Largest outputs first
+        self.assertEqual([(funding_txs[0].txhash, 0)], list(transactions[0].internals["dict_of_inputs"].items()))
+        self.assertEqual([(self.spending_tx.txhash, 1)], list(transactions[1].internals["dict_of_inputs"].items()))
+        self.assertEqual(50, sum(lightnode_api.get_spendable_outputs_from_address(self.address).values()))
+
+        # Not enough left : no input is used
+        with self.assertRaises(exceptions.APIError):
+            lightnode_api.create_batch_payment(self.address, [(recipients[0], 30), (recipients[1], 30)])
+        self.assertEqual(2, len(lightnode_api.stack_of_used_inputs))
+
+    def test_coin_selection(self):
+        # At most one output of a transaction is spent : the 25 of "d"
+        spendable_outputs = {("a", 0): 50, ("b", 0): 40, ("c", 0): 30, ("d", 0): 20, ("d", 1): 25}
+        self.assertEqual([("a", 0), ("b", 0)], lightnode_api.select_largest_first(spendable_outputs, 70))
+        self.assertEqual([("b", 0), ("c", 0)], lightnode_api.select_branch_and_bound(spendable_outputs, 70))
+        self.assertEqual([("a", 0), ("d", 1)], lightnode_api.select_branch_and_bound(spendable_outputs, 75))
+        # No exact match
+        self.assertEqual([("a", 0), ("b", 0)], lightnode_api.select_branch_and_bound(spendable_outputs, 89))
+        self.assertEqual(4, len(lightnode_api.select_all(spendable_outputs, 10)))
+
+        # The coin selection of the sender is used : an exact match needs no change output
+        self._synchronize(self.db + [self._chain_block([classes.Transaction({}, {self.address: 20})], self.db[-1])])
+        self.assertEqual({self.address2: 20},
+                         lightnode_api.create_transaction(self.address, self.address2, 20).internals["dict_of_outputs"])
+        with self.assertRaises(exceptions.APIError):
+            lightnode_api.set_coin_selection(self.address, "smallest_first")
+
+    def test_consolidation(self):
+        funding_txs = [classes.Transaction({}, {self.address: amount}) for amount in (5, 3, 2)]
+        self._synchronize(self.db + [self._chain_block(funding_txs, self.db[-1])])
+
+        t = lightnode_api.create_consolidation(self.address, max_inputs=3)
+        self.assertEqual({self.address: 10}, t.internals["dict_of_outputs"])
+        self.assertEqual([(self.spending_tx.txhash, 1)], lightnode_api.get_valid_inputs_from_address(self.address))
+        with self.assertRaises(exceptions.APIError):
+            lightnode_api.create_consolidation(self.address)
+
+    def tearDown(self):
+        # We reset the database to the initial (empty) value.
+        database.reinit_database_path()
+
+
+class ChainIndexTests(unittest.TestCase):
+    """Chain index and client queries tests."""
+
+    def setUp(self):
+        self.address = crypto.get_address(crypto.new_seed())
+        self.address2 = crypto.get_address(crypto.new_seed())
+
+        # Db
+        database.init_database_path('database/db_test')
+
+        # The genesis output is spent, 60 to address2 and 40 back to address
+        genesis_block = classes.GenesisBlock(self.address)
+        fullnode_api.add_genesis_block(genesis_block)
+        self.genesis_outpoint = (genesis_block.block_content[0].txhash, 0)
+        self.spending_tx = classes.Transaction(dict([self.genesis_outpoint]), {self.address2: 60, self.address: 40})
+        fullnode_api.add_block_to_db(classes.Block([self.spending_tx]))
+
+    def test_update(self):
+        index = chain_index.ChainIndex()
+        db = fullnode_api.get_database()
+        self.assertEqual(-1, index.update(db))
+        self.assertEqual((40, 60), (index.get_balance(self.address), index.get_balance(self.address2)))
+        self.assertEqual(self.spending_tx.txhash, index.get_spender(self.genesis_outpoint))
+        self.assertEqual((1, self.spending_tx), index.get_transaction(self.spending_tx.txhash))
+
+        # Another chain, where the genesis output is not spent
+        other_block = classes.Block([classes.Transaction({}, {self.address2: 1})])
+        self.assertEqual(0, index.update(db[:1] + [other_block]))
+        self.assertEqual((100, 1), (index.get_balance(self.address), index.get_balance(self.address2)))
+        self.assertIsNone(index.get_spender(self.genesis_outpoint))
+        self.assertIsNone(index.get_transaction(self.spending_tx.txhash))
+
+    def test_queries(self):
+        def answer(content_type, query):
+            return fullnode_processing._answer_query(content_type, json_tools.json_encode(query, "utf-8"))
+
+        content_type, content = answer("get_balance", {"address": self.address})
+        self.assertEqual(("balance", 40), (content_type, json_tools.json_decode(content, "utf-8")["balance"]))
+        content_type, content = answer("get_utxos", {"address": self.address2})
+        self.assertEqual([[self.spending_tx.txhash, 0, 60]], json_tools.json_decode(content, "utf-8")["utxos"])
+        content_type, content = answer("get_tx", {"txhash": self.spending_tx.txhash})
+        self.assertEqual({"transaction": self.spending_tx, "height": 1}, pickle.loads(content))
+        content_type, content = answer("get_tx", {"txhash": "f" * 64})
+        self.assertEqual({"transaction": None, "height": None}, pickle.loads(content))
+
+        # The index follows the chain
+        fullnode_api.add_block_to_db(classes.Block([classes.Transaction({}, {self.address: 1})]))
+        content_type, content = answer("get_tip", {})
+        self.assertEqual({"height": 2, "hash": validation.get_block_hash(fullnode_api.get_last_block())},
+                         json_tools.json_decode(content, "utf-8"))
+        content_type, content = answer("get_balance", {"address": self.address})
+        self.assertEqual(41, json_tools.json_decode(content, "utf-8")["balance"])
+
+    def test_columns(self):
+        # address2 pays 25 back to address
+        payment_tx = classes.Transaction({self.spending_tx.txhash: 0}, {self.address: 25, self.address2: 35})
+        fullnode_api.add_block_to_db(classes.Block([payment_tx]))
+        db = fullnode_api.get_database()
+        columns = chain_columns.export_chain(db)
+
+        self.assertEqual([True, True, False, False, False], columns.outputs["spent"].tolist())
+        self.assertEqual([0, 1], columns.inputs["prev_tx_id"].tolist())
+        self.assertEqual({self.address: 65, self.address2: 35}, columns.get_balances().to_dict())
+        self.assertEqual([self.address], columns.get_rich_list(1).index.tolist())
+        self.assertEqual([(self.address, self.address2, 60), (self.address2, self.address, 25)],
+                         list(columns.get_flows().itertuples(index=False, name=None)))
+
+        summary = columns.get_summary()
+        self.assertEqual([validation.get_block_hash(b) for b in db], summary["Block Hash"].tolist())
+        self.assertEqual([1, 1, 1], summary["Transactions"].tolist())
+        self.assertEqual([100, 100, 60], summary["Amount"].tolist())
+
+        # The local copy of a lightnode, exported once per chain
+        lightnode_api.init_lightnode_api()
+        self.assertEqual(columns.get_balances().to_dict(), lightnode_api.get_all_balances().to_dict())
+        self.assertIs(lightnode_api.get_chain_columns(), lightnode_api.get_chain_columns())
+
+    def tearDown(self):
+        # We reset the database to the initial (empty) value.
+        database.reinit_database_path()
+
+
+class MerkleTests(unittest.TestCase):
+    """Merkle root and inclusion proofs tests."""
+
+    def test_proofs(self):
+        for nb_of_transactions in range(1, 8):
+            txhashes = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(nb_of_transactions)]
+            levels = merkle.get_merkle_levels(txhashes)
+            merkle_root = merkle.get_merkle_root(txhashes)
+            for index, txhash in enumerate(txhashes):
+                proof = merkle.get_merkle_proof(levels, index)
+                self.assertTrue(merkle.verify_merkle_proof(txhash, index, proof, merkle_root))
+                self.assertFalse(merkle.verify_merkle_proof(txhash, index + 2 ** len(proof), proof, merkle_root))
+                if index ^ 1 < nb_of_transactions:  # Otherwise the transaction is paired with itself
+                    self.assertFalse(merkle.verify_merkle_proof(txhash, index ^ 1, proof, merkle_root))
+
+    def test_block(self):
+        t = classes.Transaction({}, {crypto.get_address(crypto.new_seed()): 100})
+        block = classes.Block([t, t])
+        headers = [block.metadata]
+        chain_sync.check_blocks([block], headers)
+
+        block.block_content.pop()
+        block.metadata["block_content_hash"] = hashlib.sha256(pickle.dumps(block.block_content)).hexdigest()
+        with self.assertRaises(exceptions.ValidationError):
+            chain_sync.check_blocks([block], [dict(headers[0])])
+
+
+class SpvApiTests(unittest.TestCase):
+    """Lightnode in SPV mode tests : headers only, and the transactions of its address with their Merkle proofs."""
+
+    def setUp(self):
+        self.seed = crypto.new_seed()
+        self.address = crypto.get_address(self.seed)
+        other_address = crypto.get_address(crypto.new_seed())
+
+        # The chain of the full node : the genesis output is spent, 60 to another address and 40 back to address,
+        # then a block without any transaction of address
+        database.init_database_path('database/db_test')
+        genesis_block = classes.GenesisBlock(self.address)
+        fullnode_api.add_genesis_block(genesis_block)
+        self.spending_tx = classes.Transaction({genesis_block.block_content[0].txhash: 0},
+                                               {other_address: 60, self.address: 40})
+        self.spending_tx.sign(self.seed)
+        for block_content in ([self.spending_tx, classes.Transaction({"f" * 64: 0}, {other_address: 1})],
+                              [classes.Transaction({"e" * 64: 0}, {other_address: 1})]):
+            fullnode_api.add_block_to_db(fullnode_api.mine_block(classes.Block(block_content)))
+        self.db = fullnode_api.get_database()
+        database.reinit_database_path()
+
+        # Db of the lightnode, empty
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        database.init_database_path(os.path.join(self.directory.name, "db"))
+        spv_api.init_spv_api([self.address])
+
+    def _synchronize_headers(self, db):
+        header_update = chain_sync.get_header_update(db, spv_api.get_locator())
+        spv_api.apply_header_update(header_update["fork_height"], header_update["headers"])
+
+    def test_headers_and_proofs(self):
+        self._synchronize_headers(self.db)
+        self.assertEqual(2, spv_api.get_height())
+
+        proofs = chain_sync.get_merkle_proofs(self.db, spv_api.get_addresses(), 0, 2)
+        self.assertEqual([(0, 0), (1, 0)], [(proof["height"], proof["index"]) for proof in proofs])
+        spv_api.apply_merkle_proofs(proofs, 2)
+        self.assertEqual(40, spv_api.get_balance_from_address(self.address))
+        self.assertEqual(self.spending_tx, spv_api.get_transaction_by_txhash(self.spending_tx.txhash))
+
+        # Kept in the local database
+        spv_api.init_spv_api([self.address])
+        self.assertEqual((2, 2), (spv_api.get_height(), spv_api.get_proofs_height()))
+        self.assertEqual([(self.spending_tx.txhash, 1)], spv_api.get_valid_inputs_from_address(self.address))
+
+    def test_invalid_answers(self):
+        # A header that has not been mined
+        headers = chain_sync.get_headers(self.db, -1)
+        headers[2] = dict(headers[2], nonce=headers[2]["nonce"] + 1)
+        with self.assertRaises(exceptions.ValidationError):
+            spv_api.apply_header_update(-1, headers)
+        self.assertEqual(-1, spv_api.get_height())
+
+        # A transaction that is not in the block
+        self._synchronize_headers(self.db)
+        proofs = chain_sync.get_merkle_proofs(self.db, [self.address], 1, 2)
+        proofs[0]["transaction"] = self.db[2].block_content[0]
+        with self.assertRaises(exceptions.ValidationError):
+            spv_api.apply_merkle_proofs(proofs, 2)
+        self.assertEqual(-1, spv_api.get_proofs_height())
+
+    def tearDown(self):
+        # We reset the database to the initial (empty) value.
+        database.reinit_database_path()
+
+
+class ResponseCacheTests(unittest.TestCase):
+    """Encoded database responses cache tests."""
+
+    def test_invalidation(self):
+        cache = response_cache.ResponseCache()
+        cache.set_tip("a")
+        cache.put("a", "gzip", b"database at a")
+        self.assertEqual(b"database at a", cache.get("a", "gzip"))
+
+        # Encoded before the chain changed, it is not kept
+        cache.set_tip("b")
+        self.assertIsNone(cache.get("a", "gzip"))
+        cache.put("a", "gzip", b"database at a")
+        self.assertIsNone(cache.get("b", "gzip"))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+
+class WorkerStageTests(unittest.TestCase):
+    """Pipeline stages run by worker processes tests."""
+
+    def setUp(self):
+        self.seed = crypto.new_seed()
+        self.address = crypto.get_address(self.seed)
+        self.stage = fullnode_workers.Stage("test", workers=2)
+
+    def tearDown(self):
+        self.stage.shutdown()
+
+    def test_signatures(self):
+        valid_tx = classes.Transaction({"0" * 64: 0}, {self.address: 100})
+        valid_tx.sign(self.seed)
+        tampered_tx = classes.Transaction({"1" * 64: 0}, {self.address: 100})
+        tampered_tx.sign(self.seed)
+        tampered_tx.txhash = valid_tx.txhash[::-1]
+
+        transactions = [valid_tx, tampered_tx]
+        with self.stage.measure(len(transactions)):
+            results = self.stage.map(crypto.verify_signing, [t.txhash for t in transactions],
+                                     [t.signature for t in transactions], [t.verifying_key for t in transactions])
+        self.assertEqual([True, False], results)
+        self.assertEqual(2, self.stage.get_stats()["items"])
+
+    def test_mining(self):
+        genesis_block = classes.GenesisBlock(self.address)
+        block = classes.Block([classes.Transaction({"0" * 64: 0}, {self.address: 100})])
+
+        # No database in the worker process : the last block is given
+        mined_block = self.stage.run(fullnode_api.mine_block, block, genesis_block)
+        self.assertEqual(1, mined_block.metadata["id"])
+        self.assertEqual(validation.get_block_hash(genesis_block), mined_block.metadata["prev_block_hash"])
+        self.assertTrue(validation.get_block_hash(mined_block).startswith(fullnode_api.PROOF_OF_WORK_PREFIX))
+
+
+class PeerManagerTests(unittest.TestCase):
+    """Neighbors table and seen messages tests."""
+
+    def setUp(self):
+        self.peers = peer_manager.PeerManager(peers=[("127.0.0.1", 1), ("127.0.0.1", 2)], fanout=2, seen_cache_size=2,
+                                              max_peers=3)
+
+    def test_fanout(self):
+        self.peers.add_peer(("127.0.0.1", 3))
+        self.assertFalse(self.peers.add_peer(("127.0.0.1", 4)))  # No room left for discovered neighbors
+        self.peers.record_transfer(("127.0.0.1", 1), latency=0.5)
+        self.peers.record_transfer(("127.0.0.1", 2), latency=0.1)
+
+        # The neighbor not yet measured first, then the fastest one
+        self.assertEqual([("127.0.0.1", 3), ("127.0.0.1", 2)], self.peers.select_peers())
+        self.assertEqual([("127.0.0.1", 2), ("127.0.0.1", 1)], self.peers.select_peers(exclude=[("127.0.0.1", 3)]))
+
+    def test_failures(self):
+        self.peers.add_peer(("127.0.0.1", 3))
+        for _ in range(self.peers.max_failures):
+            self.peers.record_failure(("127.0.0.1", 1))
+            self.peers.record_failure(("127.0.0.1", 3))
+
+        # A configured neighbor is kept, but comes last
+        self.assertEqual([("127.0.0.1", 2), ("127.0.0.1", 1)], self.peers.select_peers())
+
+    def test_seen(self):
+        self.assertIsNone(self.peers.mark_seen("a", "accepted"))
+        self.assertEqual("accepted", self.peers.mark_seen("a"))
+        self.peers.mark_seen("b")
+        self.peers.mark_seen("a")  # Seen again, so "b" is now the least recently seen
+        self.peers.mark_seen("c")
+        self.assertTrue(self.peers.is_seen("a"))
+        self.assertFalse(self.peers.is_seen("b"))
+
+
+class FramingTests(unittest.TestCase):
+    """Receive and send buffers tests."""
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.sender.setblocking(False)
+        self.addCleanup(self.sender.close)
+        self.addCleanup(self.receiver.close)
+
+    def test_message_larger_than_buffer(self):
+        content = bytes(range(256)) * 1000
+        send_buffer = framing.FrameWriter()
+        send_buffer.append(framing.create_header("database_content", len(content)), content)
+        recv_buffer = framing.FrameReader(initial_size=1024)
+
+        while send_buffer:
+            try:
+                send_buffer.send_to(self.sender)
+            except BlockingIOError:
+                recv_buffer.recv_from(self.receiver)  # The socket buffers are full
+        while len(recv_buffer) < 2:
+            recv_buffer.recv_from(self.receiver)
+        jsonheader_len = recv_buffer.unpack(">H")[0]
+        while len(recv_buffer) < jsonheader_len + len(content):
+            recv_buffer.recv_from(self.receiver)
+
+        recv_buffer.read(jsonheader_len)
+        self.assertEqual(content, recv_buffer.read(len(content)))
+
+    def test_messages_received_at_once(self):
+        send_buffer = framing.FrameWriter()
+        send_buffer.append(b"first", b"", b"second")
+        self.assertEqual(11, len(send_buffer))
+        while send_buffer:
+            send_buffer.send_to(self.sender)
+
+        recv_buffer = framing.FrameReader(initial_size=8)
+        while len(recv_buffer) < 11:
+            recv_buffer.recv_from(self.receiver)
+        self.assertEqual(b"first", recv_buffer.read(5))
+        self.assertIsNone(recv_buffer.read(7))
+        self.assertEqual(b"second", recv_buffer.read(6))
+        self.assertEqual(0, len(recv_buffer))
+
+
+class MemoryTransportTests(unittest.TestCase):
+    """In-memory transport driven by a virtual clock tests."""
+
+    def setUp(self):
+        self.clock = memory_transport.VirtualClock()
+        self.network = memory_transport.MemoryNetwork(self.clock, latency=0.1, bandwidth=1000)
+        self.accepted = []
+        self.network.listen(("node1", 1), lambda sock, address_tuple: self.accepted.append(sock))
+
+    def test_latency_and_bandwidth(self):
+        sock = self.network.connect("node0", ("node1", 1))
+        sock.send(b"a" * 500)
+        sock.send(b"b" * 500)  # Sent once the link is done with the first 500 bytes
+        self.clock.run(until=0.61)
+        self.assertEqual(b"a" * 500, self.accepted[0].recv(1000))
+        self.clock.run()
+        self.assertEqual(1.1, round(self.clock.now, 6))
+        self.assertEqual(b"b" * 500, self.accepted[0].recv(1000))
+
+        with self.assertRaises(ConnectionRefusedError):
+            self.network.connect("node0", ("node2", 1))
+
+    def test_neighbor_connections(self):
+        received = []
+
+        def process(c):
+            if c.message_received is not None:
+                received.append((self.clock.now, c.message_received))
+
+        def accept(sock, address_tuple):
+            connection = fullnode_connections.NeighborConnection(sock, sock, address_tuple)
+            memory_transport.drive(connection, sock, process=process)
+
+        self.network.listen(("node1", 2), accept)
+        sock = self.network.connect("node0", ("node1", 2))
+        sock.events = selectors.EVENT_WRITE
+        connection = fullnode_connections.NeighborConnection(sock, sock, ("node1", 2),
+                                                             first_message=("tip_announcement", b"{}"))
+        memory_transport.drive(connection, sock)
+        self.clock.run(until=5)
+
+        at, (content_type, content) = received[0]
+        self.assertEqual(("tip_announcement", b"{}"), (content_type, bytes(content)))
+        self.assertLess(at, 0.2)  # Latency and the time to send the message at 1000 bytes/s
+
+
+class PersistentConnectionTests(unittest.TestCase):
+    """Request-id tagged client connections tests, the full node and the lightnode being at both ends of a
+    socketpair."""
+
+    def setUp(self):
+        lightnode_sock, fullnode_sock = socket.socketpair()
+        lightnode_sock.setblocking(False)
+        fullnode_sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.addCleanup(self.selector.close)
+        self.sockets = (lightnode_sock, fullnode_sock)
+
+        self.client_connection = fullnode_connections.ClientConnection(self.selector, fullnode_sock, "lightnode")
+        self.selector.register(fullnode_sock, selectors.EVENT_READ, data=self.client_connection)
+
+    def _connect_lightnode(self, connection_type, transaction_bytes=None):
+        connection = lightnode_connections.FullNodeConnection(self.selector, self.sockets[0], "fullnode",
+                                                              connection_type, transaction_bytes=transaction_bytes)
+        self.selector.register(self.sockets[0], selectors.EVENT_READ | selectors.EVENT_WRITE, data=connection)
+        return connection
+
+    def _database_file(self, db):
+        database_file = tempfile.TemporaryFile()
+        pickle.dump(db, database_file)
+        database_file.flush()
+        return database_file, database_file.tell()
+
+    def _run_until(self, condition):
+        """Serves both ends of the socketpair until the condition is met, in the manner of the selector loops."""
+        for _ in range(100):
+            if condition():
+                return
+            for key, mask in self.selector.select(timeout=0.1):
+                key.data.process_events(mask)
+        self.fail("Condition not met.")
+
+    def test_pipelined_requests(self):
+        full_node = self._connect_lightnode("persistent")
+        transaction_bytes = pickle.dumps("transaction")
+        database_request_id = full_node.queue_request("db_request")
+        transaction_request_id = full_node.queue_request("transaction_content", transaction_bytes)
+
+        # Both requests may already be in the receive buffer : the second one waits for the first to be answered
+        self._run_until(lambda: self.client_connection.database_requested)
+        self.assertIsNone(self.client_connection.transaction_received)
+        self.client_connection.queue_database(framing.FilePart(*self._database_file(["block"])))
+
+        self._run_until(lambda: self.client_connection.transaction_received is not None)
+        self.assertEqual(transaction_bytes, self.client_connection.transaction_received)
+        self.client_connection.acknowledge_transaction("accepted")
+
+        self._run_until(lambda: len(full_node.responses) == 2)
+        self.assertEqual([database_request_id, transaction_request_id], list(full_node.responses))
+        jsonheader, content = full_node.responses[database_request_id]
+        self.assertEqual("database_content", jsonheader["content-type"])
+        self.assertEqual(["block"], pickle.loads(content))
+        jsonheader, content = full_node.responses[transaction_request_id]
+        self.assertEqual("transaction_result", jsonheader["content-type"])
+        self.assertEqual({"status": "accepted"}, json_tools.json_decode(content, "utf-8"))
+        self.assertFalse(self.client_connection.is_closed)
+
+    def test_transaction_batch(self):
+        full_node = self._connect_lightnode("persistent")
+        transactions_bytes = [pickle.dumps("transaction {}".format(i)) for i in range(3)] + [b""]
+        request_id = full_node.queue_request("transaction_batch", framing.pack_batch(transactions_bytes))
+
+        self._run_until(lambda: self.client_connection.transaction_batch_received is not None)
+        self.assertEqual(transactions_bytes, [bytes(t) for t in self.client_connection.transaction_batch_received])
+        self.client_connection.acknowledge_transaction_batch(["accepted", "orphaned", "rejected", "rejected"])
+
+        self._run_until(lambda: request_id in full_node.responses)
+        jsonheader, content = full_node.responses[request_id]
+        self.assertEqual("transaction_batch_result", jsonheader["content-type"])
+        self.assertEqual(["accepted", "orphaned", "rejected", "rejected"],
+                         json_tools.json_decode(content, "utf-8")["statuses"])
+
+        with self.assertRaises(ValueError):
+            framing.unpack_batch(framing.pack_batch(transactions_bytes)[:-1] + b"\x00\x00")
+
+    def test_streamed_database(self):
+        # A database much larger than the receive buffer is written to the sink as it arrives
+        full_node = self._connect_lightnode("persistent")
+        db = ["block {}".format(i) * 100 for i in range(5000)]
+        with tempfile.TemporaryFile() as sink:
+            request_id = full_node.queue_request("db_request", sink=sink)
+            self._run_until(lambda: self.client_connection.database_requested)
+            database_file, database_size = self._database_file(db)
+            self.client_connection.queue_database(framing.FilePart(database_file, database_size))
+
+            self._run_until(lambda: request_id in full_node.responses)
+            self.assertIsNone(full_node.responses[request_id][1])
+            self.assertLess(len(full_node._recv_buffer._buffer), database_size)
+            self.assertTrue(database_file.closed)  # Once sent
+            sink.seek(0)
+            self.assertEqual(db, pickle.load(sink))
+
+    def test_encoded_database(self):
+        full_node = self._connect_lightnode("persistent")
+        request_id = full_node.queue_request("db_request", json_tools.json_encode({"encoding": "gzip"}, "utf-8"))
+        self._run_until(lambda: self.client_connection.database_requested)
+        self.assertEqual("gzip", self.client_connection.database_encoding)
+        database_file, database_size = self._database_file(["block"])
+        database_file.seek(0)
+        self.client_connection.queue_database(response_cache.encode_database(database_file, "gzip"),
+                                              content_encoding="gzip")
+
+        self._run_until(lambda: request_id in full_node.responses)
+        jsonheader, content = full_node.responses[request_id]
+        self.assertEqual("gzip", jsonheader["content-encoding"])
+        self.assertEqual(["block"], pickle.loads(gzip.decompress(content)))
+
+    def test_one_shot_request(self):
+        # Without request-id, the connection is closed once the database is sent
+        full_node = self._connect_lightnode("database_request")
+        self._run_until(lambda: self.client_connection.database_requested)
+        self.assertFalse(self.client_connection.persistent)
+        self.client_connection.queue_database(framing.FilePart(*self._database_file(["block"])))
+
+        self._run_until(lambda: full_node.database_received is not None)
+        self.assertEqual(["block"], full_node.database_received)
+        self.assertTrue(self.client_connection.is_closed)
+
+
+    def test_query(self):
+        full_node = self._connect_lightnode("persistent")
+        request_id = full_node.queue_request("chain_update_request",
+                                             json_tools.json_encode({"locator": ["f" * 64]}, "utf-8"))
+        self._run_until(lambda: self.client_connection.query_received is not None)
+        content_type, content = self.client_connection.query_received
+        self.assertEqual("chain_update_request", content_type)
+        self.assertEqual({"locator": ["f" * 64]}, json_tools.json_decode(content, "utf-8"))
+        self.client_connection.answer_query("chain_update", pickle.dumps({"blocks": []}))
+
+        self._run_until(lambda: request_id in full_node.responses)
+        jsonheader, content = full_node.responses[request_id]
+        self.assertEqual("chain_update", jsonheader["content-type"])
+        self.assertEqual({"blocks": []}, pickle.loads(content))
+        self.assertIsNone(self.client_connection.query_received)
+        self.assertFalse(self.client_connection.is_closed)
+
+
+class SocketManagerTests(unittest.TestCase):
+    """Connections of the full node driven by its event loop tests. The loop runs in debug mode, where asyncio raises
+    on any of its non-thread-safe operations called from another thread, e.g. the processing thread."""
+
+    def setUp(self):
+        database.init_database_path('database/db_test')
+        self.db = [fullnode_api.add_genesis_block(classes.GenesisBlock(crypto.get_address(crypto.new_seed())))]
+
+    def test_sync_exchange(self):
+        errors = []
+
+        async def exchange():
+            loop = asyncio.get_running_loop()
+            loop.set_debug(True)
+            loop.set_exception_handler(lambda loop, context: errors.append(context))
+            gossip = fullnode_socket_manager.threadsafe_gossip(loop)
+            server = await asyncio.start_server(
+                lambda reader, writer: fullnode_socket_manager.serve_neighbor(reader, writer, gossip), "127.0.0.1", 0)
+            async with server:
+                # Our own tip : the node has nothing to request and finishes the connection from the processing thread
+                announcement = {"length": len(self.db), "tip_hash": validation.get_block_hash(self.db[-1])}
+                await asyncio.wait_for(fullnode_socket_manager._gossip(
+                    server.sockets[0].getsockname(), "tip_announcement",
+                    json_tools.json_encode(announcement, "utf-8"), gossip), 10)
+                await asyncio.sleep(0.1)  # The node closes its end
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            asyncio.run(exchange())
+        self.assertEqual([], errors)
+        self.assertNotIn("Non-thread-safe operation", output.getvalue())
+        self.assertNotIn("error", output.getvalue())
+        self.assertEqual(2, output.getvalue().count("closing connection to neighbor"))
+
+    def test_client_closed_by_processing(self):
+        errors = []
+
+        async def exchange():
+            loop = asyncio.get_running_loop()
+            loop.set_debug(True)
+            loop.set_exception_handler(lambda loop, context: errors.append(context))
+            gossip = fullnode_socket_manager.threadsafe_gossip(loop)
+            server = await asyncio.start_server(
+                lambda reader, writer: fullnode_socket_manager.serve_client(reader, writer, gossip), "127.0.0.1", 0)
+            async with server:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+                # The unrecognized message is interpreted once the query is answered, by the processing thread
+                query_bytes = json_tools.json_encode({}, "utf-8")
+                writer.write(framing.create_header("get_tip", len(query_bytes), {"request-id": 1}) + query_bytes
+                             + framing.create_header("nonsense", 0, {"request-id": 2}))
+                await asyncio.wait_for(reader.read(), 10)  # Until the node closes the connection
+                writer.close()
+                await asyncio.sleep(0.1)  # The node is done with the connection
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            asyncio.run(exchange())
+        self.assertEqual([], errors)
+        self.assertNotIn("Non-thread-safe operation", output.getvalue())
+        self.assertIn("Unrecognized content-type", output.getvalue())
+
+    def tearDown(self):
+        database.reinit_database_path()
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    """Lightnode connection pool tests, against a listening socket."""
+
+    def setUp(self):
+        self.listening_sock = socket.socket()
+        self.addCleanup(self.listening_sock.close)
+        self.listening_sock.bind(("127.0.0.1", 0))
+        self.listening_sock.listen()
+        self.pool = lightnode.ConnectionPool(*self.listening_sock.getsockname(), max_connections=1, timeout=0.2)
+        self.addCleanup(self.pool.close)
+
+    def test_reuse(self):
+        with self.pool.connection() as first_conn:
+            pass
+        with self.pool.connection() as second_conn:
+            self.assertIs(first_conn, second_conn)
+
+    def test_exhaustion(self):
+        with self.pool.connection():
+            with self.assertRaises(TimeoutError):
+                with self.pool.connection():
+                    pass
+
+    def test_replacement_of_idle_connection_closed_by_full_node(self):
+        with self.pool.connection() as first_conn:
+            server_sock, address = self.listening_sock.accept()
+        server_sock.close()  # As after the idle timeout of the full node
+
+        with self.pool.connection() as second_conn:
+            self.assertIsNot(first_conn, second_conn)
+            self.assertFalse(second_conn.is_closed)
+        self.assertTrue(first_conn.is_closed)
+
+    def test_replacement_of_lost_connection(self):
+        self.pool.timeout = 5
+        waiting_conns = []
+        lent_conn = self.pool._acquire()
+        waiting_thread = threading.Thread(target=lambda: waiting_conns.append(self.pool._acquire()))
+        waiting_thread.start()
+
+        # The lent connection is lost : the waiting request gets a new one instead of waiting forever
+        lent_conn.connection.close()
+        self.pool._release(lent_conn)
+        waiting_thread.join(timeout=5)
+        self.assertEqual(1, len(waiting_conns))
+        self.assertIsNot(lent_conn, waiting_conns[0])
+        self.pool._release(waiting_conns[0])
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -2,6 +2,11 @@ from tools import crypto, fullnode_api, exceptions
 import hashlib
 import pickle
 
+# Results of the validations of transactions at admission, kept until the transactions leave the mempool.
+# txhash -> {"tip_hash": hash of the last block when last validated, "signature": (signature, verifying key),
+#            "unconfirmed_parents": hashes of the unconfirmed transactions it spends from}
+_validated_transactions = {}
+
 
 def _is_spendable(tx_hash, position):
     """Controls whether the input can be spent. The tx_hash corresponds to the previous transaction
@@ -40,12 +45,14 @@ def _has_valid_signature(tx):
         raise exceptions.ValidationError("Invalid Signature detected in transaction with hash {}.".format(tx.txhash))
 
 
-def _is_owned(tx_hash, position, verifying_key):
+def _is_owned(tx_hash, position, verifying_key, previous_tx=None):
     """Controls whether the signature of the block proves ownership of the inputs. The tx_hash corresponds
-    to the previous transaction from which we want to spend the output."""
+    to the previous transaction from which we want to spend the output. If this transaction is not yet confirmed,
+    it is given as previous_tx."""
     # Returns true if the signature corresponds, raises corresponding exceptions otherwise.
 
-    previous_tx = fullnode_api.get_transaction_by_txhash(tx_hash)  # See corresponding exceptions
+    if previous_tx is None:
+        previous_tx = fullnode_api.get_transaction_by_txhash(tx_hash)  # See corresponding exceptions
 
     try:
         address_of_output = list(previous_tx.internals["dict_of_outputs"].keys())[position]
@@ -64,9 +71,77 @@ def _has_correct_hash(tx):
                                      .format(tx.txhash))
 
 
+def _get_amount_of_unconfirmed_output(previous_tx, position):
+    """Returns the amount of an output of a transaction not yet confirmed, in the manner of
+    fullnode_api.get_amount_from_input."""
+    try:
+        amount = list(previous_tx.internals["dict_of_outputs"].values())[position]
+    except IndexError:
+        raise exceptions.APIError("Incorrect input position for input no. {} of transaction with hash {} when "
+                                  "trying to get amount.".format(position, previous_tx.txhash))
+    return amount
+
+
+def _validate_transaction(t, unconfirmed_transactions=None, signature_checked=False):
+    """Validates a single transaction against the chain, using the first 5 checking mechanisms of
+    _validate_transactions_of_block. The outputs it spends may also belong to the unconfirmed_transactions (anything
+    with a get(txhash) method, like a dict or the mempool). Returns the set of hashes of the unconfirmed transactions
+    it spends from, or raises the corresponding exceptions."""
+
+    # We control the tx_hash: [check 1]
+    _has_correct_hash(t)
+
+    # We control the signature [check 2], unless the caller already did, e.g. in a worker process
+    if not signature_checked:
+        _has_valid_signature(t)
+
+    # For the transaction, we keep record of the input and output amounts
+    input_amount = 0
+    output_amount = 0
+
+    unconfirmed_parents = set()
+
+    # Remember : inputs of a transaction are of format (hash of tx where we find the spendable output, its position)
+    for tx_hash, position in t.internals["dict_of_inputs"].items():
+
+        previous_tx = None
+        if unconfirmed_transactions is not None:
+            previous_tx = unconfirmed_transactions.get(tx_hash)
+
+        if previous_tx is None:
+            # For each input element of a given tx, we check if it is spendable [check 3]
+            _is_spendable(tx_hash, position)
+
+            input_amount += fullnode_api.get_amount_from_input(tx_hash, position)
+        else:
+            # The output belongs to an unconfirmed transaction, so it cannot have been spent in the chain [check 3].
+            # Conflicts between unconfirmed transactions are controlled by the mempool and by [check 6]
+            unconfirmed_parents.add(tx_hash)
+            input_amount += _get_amount_of_unconfirmed_output(previous_tx, position)
+
+        # We control the ownership [check 4]. We can trust the verifying key since we are after [2] and the
+        # existence of tx and input since we are after [3]
+        if not _is_owned(tx_hash, position, t.verifying_key, previous_tx=previous_tx):
+            raise exceptions.ValidationError("Verifying key of transaction with hash {} does not own input "
+                                             "({}, {}).".format(t.txhash, tx_hash, position))
+
+    # Outputs of a transaction are of format (destination address, amount)
+    for amount in t.internals["dict_of_outputs"].values():
+        output_amount += amount
+
+    # Last thing to check for the tx : does the input total match the output total ? [check 5]
+    if input_amount != output_amount:
+        raise exceptions.ValidationError("Unbalanced input and output amounts in transaction with hash {} "
+                                         "detected. Inputs : {}, Outputs : {}."
+                                         .format(t.txhash, input_amount, output_amount))
+
+    return unconfirmed_parents
+
+
 def _validate_transactions_of_block(block):
     """Validates the transactions in the given block, using 5 checking mechanisms. In addition, ensures that
-    there is no conflict between the transactions."""
+    there is no conflict between the transactions. The transactions already validated at admission are only checked
+    again for what a new block could have changed, i.e. whether their inputs are still spendable."""
 
     # The first block is by definition always valid.
     if block.metadata["id"] == 1:
@@ -83,45 +158,36 @@ def _validate_transactions_of_block(block):
     # [6] In addition to that, we have to ensure that the transactions of a new block do not conflict.
 
     list_of_used_inputs = []  # For [check 6]
+    tip_hash = get_block_hash(fullnode_api.get_last_block())
 
-    for t in block.block_content:
-
-        # We control the tx_hash: [check 1]
-        _has_correct_hash(t)
-
-        # We control the signature [check 2]
-        _has_valid_signature(t)
-
-        # For each transaction in the block, we keep record of the input and output amounts
-        input_amount = 0
-        output_amount = 0
-
-        # Remember : inputs of a transaction are of format (hash of tx where we find the spendable output, its position)
-        tx_input_no = 0
-        for tx_hash, position in t.internals["dict_of_inputs"].items():
-
-            # We add it to the list of used inputs, for [check 6]
-            list_of_used_inputs.append((tx_hash, position))
-
-            # For each input element of a given tx, we check if it is spendable [check 3]
-            _is_spendable(tx_hash, position)
+    # A transaction may spend the outputs of a transaction placed before it in the same block
+    block_transactions = {}
 
-            input_amount += fullnode_api.get_amount_from_input(tx_hash, position)
-            tx_input_no += 1
-
-            # We control the ownership [check 4]. We can trust the verifying key since we are after [2] and the
-            # existence of tx and input since we are after [3]
-            _is_owned(tx_hash, position, t.verifying_key)
-
-        # Outputs of a transaction are of format (destination address, amount)
-        for amount in t.internals["dict_of_outputs"].values():
-            output_amount += amount
+    for t in block.block_content:
 
-        # Last thing to check for the tx : does the input total match the output total ? [check 5]
-        if input_amount != output_amount:
-            raise exceptions.ValidationError("Unbalanced input and output amounts in transaction with hash {} "
-                                             "detected. Inputs : {}, Outputs : {}."
-                                             .format(t.txhash, input_amount, output_amount))
+        cached_validation = _validated_transactions.get(t.txhash)
+        if cached_validation is None or cached_validation["signature"] != (t.signature, t.verifying_key):
+            # Never validated (or not this signed version of it) : we run checks [1] to [5]
+            _validate_transaction(t, unconfirmed_transactions=block_transactions)
+
+        else:
+            # Checks [1], [2], [4] and [5] only depend on the transaction and on the outputs it spends, which existed
+            # at admission. Since then, new blocks may only have spent these outputs [check 3]
+            for tx_hash, position in t.internals["dict_of_inputs"].items():
+                if tx_hash in block_transactions:
+                    continue
+                if cached_validation["tip_hash"] != tip_hash:
+                    _is_spendable(tx_hash, position)
+                elif tx_hash in cached_validation["unconfirmed_parents"]:
+                    raise exceptions.ValidationError("Transaction with hash {} spends an output of transaction with "
+                                                     "hash {}, which is neither confirmed nor before it in the "
+                                                     "block.".format(t.txhash, tx_hash))
+            cached_validation["tip_hash"] = tip_hash
+
+        block_transactions[t.txhash] = t
+
+        # We add the inputs to the list of used inputs, for [check 6]
+        list_of_used_inputs.extend(t.internals["dict_of_inputs"].items())
 
     # Looking for double spends in the block [check 6]
     control_set = set(list_of_used_inputs)  # Creating a set will eliminate duplicates
@@ -134,8 +200,13 @@ def _validate_transactions_of_block(block):
 
 def get_block_hash(block):
     """Returns the "hash of a block", which is in fact the hash of the metadata of the block."""
+    return get_header_hash(block.metadata)
+
+
+def get_header_hash(metadata):
+    """Returns the hash of a block from its metadata only, e.g. for a header received from a neighbor."""
     # With this function we can obtain the SHA256 hash
-    serialized_block_metadata = pickle.dumps(block.metadata)
+    serialized_block_metadata = pickle.dumps(metadata)
     block_hash = hashlib.sha256(serialized_block_metadata).hexdigest()
     return block_hash
 
@@ -153,3 +224,47 @@ def validate_block(block):
     checks that the block has the correct structure."""
     # TODO : implementation
     return _validate_transactions_of_block(block)
+
+
+def validate_transaction(tx, unconfirmed_transactions=None, signature_checked=False):
+    """This function can be used to validate a single transaction against the chain, typically when it is received
+    by a full node. The outputs it spends may also belong to the unconfirmed_transactions, e.g. the mempool. The
+    signature is not verified again if signature_checked, i.e. if the caller already did. The result is kept, so
+    that validate_block only checks again what a new block could have changed."""
+
+    unconfirmed_parents = _validate_transaction(tx, unconfirmed_transactions=unconfirmed_transactions,
+                                                signature_checked=signature_checked)
+    _validated_transactions[tx.txhash] = {
+        "tip_hash": get_block_hash(fullnode_api.get_last_block()),
+        "signature": (tx.signature, tx.verifying_key),
+        "unconfirmed_parents": unconfirmed_parents
+    }
+    return True
+
+
+def get_missing_parents(tx, unconfirmed_transactions=None):
+    """Returns the set of hashes of the transactions whose outputs the transaction spends, but which are neither in
+    the chain nor among the unconfirmed_transactions."""
+
+    missing_parents = set()
+    for tx_hash in tx.internals["dict_of_inputs"].keys():
+        if unconfirmed_transactions is None or unconfirmed_transactions.get(tx_hash) is None:
+            missing_parents.add(tx_hash)
+
+    if missing_parents:
+        for b in fullnode_api.get_database():
+            for t in b.block_content:
+                missing_parents.discard(t.txhash)
+
+    return missing_parents
+
+
+def forget_transaction(tx_hash):
+    """Discards the kept validation result of a transaction, e.g. once it has left the mempool."""
+    _validated_transactions.pop(tx_hash, None)
+
+
+def clear_validation_cache():
+    """Discards all the kept validation results, e.g. when the chain is replaced and the outputs spent by the
+    validated transactions may not exist anymore."""
+    _validated_transactions.clear()